@@ -1,13 +1,17 @@
 import numpy as np
 from matplotlib import pyplot as plt
-
-f = np.zeros((64,64))
+from python_visual_mpc.visual_mpc_core.algorithm.distance_fields import make_distance_field
 
 g = np.array([25, 60])
-for i in range(64):
-    for j in range(64):
-        f[i,j] = np.linalg.norm(np.array([i,j])- g)
+f = make_distance_field(g)
 
+# obstacle aware field with a wall between the goal and the left half of the image
+obstacle_mask = np.zeros((64, 64), dtype=np.bool)
+obstacle_mask[10:54, 40] = True
+f_obstacle = make_distance_field(g, metric='obstacle', obstacle_mask=obstacle_mask)
 
+plt.subplot(121)
 plt.imshow(f, zorder=0, cmap=plt.get_cmap('jet'), interpolation='none')
+plt.subplot(122)
+plt.imshow(f_obstacle, zorder=0, cmap=plt.get_cmap('jet'), interpolation='none')
 plt.show()
\ No newline at end of file
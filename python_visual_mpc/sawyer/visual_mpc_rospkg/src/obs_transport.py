@@ -0,0 +1,80 @@
+"""
+Encoding of the 64x64 RGB views sent with get_action requests.
+
+encoding '' : the views are sent as sensor_msgs/Image in BGR, as done by the original client
+'raw'       : uint8 RGB pixels in main_data and aux1_data
+'png'/'jpeg': compressed RGB frames
+'shm'       : the pixels are written to files in /dev/shm, the data fields only hold the file names,
+              used when client and server run on the same host
+An empty aux1_data means the client has no aux1 view.
+"""
+import os
+import socket
+import numpy as np
+import rospy
+
+from python_visual_mpc.video_prediction.utils_vpred.numpy_tfrecord import encode_frame, decode_frame
+
+SHM_DIR = '/dev/shm'
+IMAGE_SHAPE = (64, 64, 3)
+
+
+def service_is_local(service_name):
+    """
+    :return: True if the ROS service is provided by a node on this host
+    """
+    uri = rospy.get_master().lookupService(service_name)[2]  # rosrpc://host:port
+    host = uri.split('//')[1].split(':')[0]
+    return host in ['localhost', '127.0.0.1', socket.gethostname(), socket.getfqdn()]
+
+
+class ObservationEncoder(object):
+    def __init__(self, encoding, jpeg_quality=95):
+        if encoding not in ['raw', 'png', 'jpeg', 'shm']:
+            raise ValueError('unknown image encoding {}'.format(encoding))
+        self.encoding = encoding
+        self.jpeg_quality = jpeg_quality
+        self._shm = {}
+
+    def _shm_array(self, view):
+        if view not in self._shm:
+            filename = os.path.join(SHM_DIR, 'visual_mpc_{}_{}.npy'.format(os.getpid(), view))
+            self._shm[view] = np.lib.format.open_memmap(filename, mode='w+', dtype=np.uint8, shape=IMAGE_SHAPE)
+        return self._shm[view]
+
+    def encode(self, image, view):
+        """
+        :param image: 64 x 64 x 3 uint8 RGB image or None
+        :param view: 'main' or 'aux1'
+        :return: content of the data field of the view
+        """
+        if image is None:
+            return ''
+        if self.encoding == 'raw':
+            return np.ascontiguousarray(image, dtype=np.uint8).tostring()
+        elif self.encoding == 'shm':
+            # one buffer per view suffices, the client waits for every reply before sending the next request
+            shm = self._shm_array(view)
+            shm[:] = image
+            return shm.filename
+        return encode_frame(image, self.encoding, self.jpeg_quality)
+
+    def close(self):
+        for shm in self._shm.values():
+            os.remove(shm.filename)
+        self._shm = {}
+
+
+def decode_image(encoding, data):
+    """
+    :return: 64 x 64 x 3 uint8 RGB image, None for an empty data field
+    """
+    if len(data) == 0:
+        return None
+    if encoding == 'raw':
+        return np.frombuffer(data, dtype=np.uint8).reshape(IMAGE_SHAPE)
+    elif encoding == 'shm':
+        return np.array(np.load(data, mmap_mode='r'))
+    elif encoding in ['png', 'jpeg']:
+        return decode_frame(data)
+    raise ValueError('unknown image encoding {}'.format(encoding))
@@ -332,6 +332,8 @@ class RobotRecorder(object):
             rospy.wait_for_service('get_kinectdata', 0.1)
             resp1 = self.get_kinectdata_func()
             self.ltob_aux1.img_msg = resp1.image
+            # the aux1 recorder already sends its cropped 64x64 BGR view
+            self.ltob_aux1.img_cropped = self.bridge.imgmsg_to_cv2(resp1.image)
         except (rospy.ServiceException, rospy.ROSException), e:
             rospy.logerr("Service call failed: %s" % (e,))
             raise ValueError('get_kinectdata service failed')
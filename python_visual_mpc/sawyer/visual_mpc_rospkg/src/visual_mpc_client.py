@@ -14,8 +14,10 @@ from intera_core_msgs.srv import (
 import intera_external_devices
 
 import argparse
+import atexit
 import imutils
 from sensor_msgs.msg import JointState
+from sensor_msgs.msg import Image as Image_msg
 from std_msgs.msg import String
 
 import cv2
@@ -24,6 +26,7 @@ from cv_bridge import CvBridge, CvBridgeError
 from PIL import Image
 import inverse_kinematics
 import robot_controller
+from obs_transport import ObservationEncoder, service_is_local
 from recorder import robot_recorder
 import os
 import cPickle
@@ -33,6 +36,8 @@ from std_msgs.msg import Int64
 from berkeley_sawyer.srv import *
 import copy
 import imp
+import sys
+import threading
 
 class Traj_aborted_except(Exception):
     pass
@@ -114,6 +119,28 @@ class Visual_MPC_Client():
         self.bridge = CvBridge()
 
         self.action_interval = 1 #Hz
+        # seconds the server may plan before it answers with the best action so far, 0 waits for the complete plan
+        if 'action_deadline' in self.agentparams:
+            self.action_deadline = self.agentparams['action_deadline']
+        else: self.action_deadline = 0.
+
+        # pipelined mode: the observation for the next step is sent pipeline_capture_delay*action_interval
+        # seconds after the current action started, the server plans while the robot moves.
+        # With manual_correction the designated pixel is marked right before each query, so it is synchronous
+        self.pipelined = 'pipelined' in self.agentparams and 'manual_correction' not in self.agentparams
+        if 'pipelined' in self.agentparams and not self.pipelined:
+            print 'manual_correction requires synchronous queries, pipelining is disabled'
+        if 'pipeline_capture_delay' in self.agentparams:
+            self.pipeline_capture_delay = self.agentparams['pipeline_capture_delay']
+        else: self.pipeline_capture_delay = 0.5
+        self.pending_query = None
+
+        # '' sends BGR sensor_msgs/Image views, else 'raw', 'png' or 'jpeg' RGB views, see obs_transport.py,
+        # raw views go through shared memory if the server runs on this host
+        if 'image_encoding' in self.agentparams:
+            self.image_encoding = self.agentparams['image_encoding']
+        else: self.image_encoding = ''
+        self.encoder = None
         self.traj_duration = self.action_sequence_length*self.action_interval
         self.action_rate = rospy.Rate(self.action_interval)
         self.control_rate = rospy.Rate(1000)
@@ -262,6 +289,10 @@ class Visual_MPC_Client():
             raise ValueError('get_kinectdata service failed')
 
     def run_trajectory(self, i_tr):
+        if self.pending_query is not None:
+            # request of an aborted trajectory, it has to reach the server before the next init_traj
+            self.pending_query['thread'].join()
+            self.pending_query = None
 
         if self.use_robot:
             print 'setting neutral'
@@ -354,7 +385,10 @@ class Visual_MPC_Client():
                 print 'current position error', self.des_pos - self.get_endeffector_pos(pos_only=True)
 
                 self.previous_des_pos = copy.deepcopy(self.des_pos)
-                action_vec = self.query_action()
+                if self.pending_query is not None:
+                    action_vec = self.collect_query()
+                else:
+                    action_vec = self.query_action()
                 print 'action vec', action_vec
 
                 self.des_pos = self.apply_act(action_vec, i_step, move=False)
@@ -375,6 +409,11 @@ class Visual_MPC_Client():
 
                 print 'applying action{}'.format(i_step)
 
+            if self.pipelined and self.pending_query is None and i_step < self.action_sequence_length:
+                if rospy.get_time() - start_time > self.pipeline_capture_delay * self.action_interval:
+                    # the end effector is still moving, send the commanded position as predicted state
+                    self.start_query(state=copy.deepcopy(self.des_pos))
+
             des_joint_angles = self.get_interpolated_joint_angles()
 
             if self.save_active:
@@ -446,7 +485,62 @@ class Visual_MPC_Client():
 
         return des_joint_angles
 
-    def query_action(self):
+    def query_action(self, state=None):
+        return self.request_action(self.capture_observation(state))
+
+    def start_query(self, state=None):
+        """
+        captures the observation and requests the next action in the background, see collect_query.
+        The capture is done by the thread too, the get_kinectdata call and the image encoding
+        would otherwise stall the impedance control loop which calls this
+        """
+        query = {'thread': None, 'action': None, 'error': None}
+
+        def run():
+            try:
+                query['action'] = self.request_action(self.capture_observation(state))
+            except Exception:
+                query['error'] = sys.exc_info()
+
+        query['thread'] = threading.Thread(target=run)
+        query['thread'].start()
+        self.pending_query = query
+
+    def collect_query(self):
+        """
+        waits for the action requested by start_query
+        """
+        query = self.pending_query
+        self.pending_query = None
+        tstart = rospy.get_time()
+        query['thread'].join()
+        print 'waited {:.3f} s for the pipelined action'.format(rospy.get_time() - tstart)
+        if query['error'] is not None:
+            exc_type, exc_value, exc_traceback = query['error']
+            raise exc_type, exc_value, exc_traceback
+        return query['action']
+
+    def make_encoder(self):
+        encoding = self.image_encoding
+        if encoding == 'raw' and 'no_shm' not in self.agentparams:
+            rospy.wait_for_service('get_action', timeout=240)
+            if service_is_local('get_action'):
+                print 'server runs on this host, sending images through shared memory'
+                encoding = 'shm'
+        if 'jpeg_quality' in self.agentparams:
+            encoder = ObservationEncoder(encoding, self.agentparams['jpeg_quality'])
+        else: encoder = ObservationEncoder(encoding)
+        # removes the shared memory files when the client exits
+        atexit.register(encoder.close)
+        return encoder
+
+    def capture_observation(self, state=None):
+        """
+        :param state: the state sent to the server, by default the measured end effector position
+        :return: the image fields of the get_action request and the state
+        """
+        if self.image_encoding != '':
+            return self.capture_encoded_observation(state)
 
         if self.use_robot:
             if self.use_aux:
@@ -457,21 +551,49 @@ class Visual_MPC_Client():
                 imageaux1 = self.bridge.cv2_to_imgmsg(imageaux1)
 
             imagemain = self.bridge.cv2_to_imgmsg(self.recorder.ltob.img_cropped)
-            state = self.get_endeffector_pos()
+            if state is None:
+                state = self.get_endeffector_pos()
         else:
             imagemain = np.zeros((64,64,3))
             imagemain = self.bridge.cv2_to_imgmsg(imagemain)
             imageaux1 = self.bridge.cv2_to_imgmsg(self.test_img)
             state = np.zeros(3)
+        return (imagemain, imageaux1, '', '', ''), state
+
+    def capture_encoded_observation(self, state=None):
+        """
+        only the cropped views are sent, in RGB, without aux1 if there is no aux1 camera
+        """
+        if self.encoder is None:
+            self.encoder = self.make_encoder()
+
+        imageaux1 = None
+        if self.use_robot:
+            if self.use_aux:
+                self.recorder.get_aux_img()
+                imageaux1 = cv2.cvtColor(self.recorder.ltob_aux1.img_cropped, cv2.COLOR_BGR2RGB)
+            imagemain = cv2.cvtColor(self.recorder.ltob.img_cropped, cv2.COLOR_BGR2RGB)
+            if state is None:
+                state = self.get_endeffector_pos()
+        else:
+            imagemain = np.zeros((64, 64, 3), dtype=np.uint8)
+            state = np.zeros(3)
+        fields = (Image_msg(), Image_msg(), self.encoder.encoding,
+                  self.encoder.encode(imagemain, 'main'), self.encoder.encode(imageaux1, 'aux1'))
+        return fields, state
 
+    def request_action(self, observation):
+        image_fields, state = observation
         try:
             rospy.wait_for_service('get_action', timeout=240)
-            get_action_resp = self.get_action_func(imagemain, imageaux1,
+            get_action_resp = self.get_action_func(*(image_fields + (
                                               tuple(state),
                                               tuple(self.desig_pos_main.flatten()),
-                                              tuple(self.goal_pos_main.flatten()))
+                                              tuple(self.goal_pos_main.flatten()),
+                                              self.action_deadline)))
 
             action_vec = get_action_resp.action
+            print 'planned with {} iterations, score {}'.format(get_action_resp.iterations, get_action_resp.score)
 
         except (rospy.ServiceException, rospy.ROSException), e:
             rospy.logerr("Service call failed: %s" % (e,))
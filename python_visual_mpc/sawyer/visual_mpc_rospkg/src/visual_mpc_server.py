@@ -2,7 +2,9 @@
 import os
 import shutil
 import socket
+import sys
 import thread
+import threading
 import numpy as np
 import pdb
 from PIL import Image
@@ -23,6 +25,7 @@ from visual_mpc_rospkg.srv import *
 import cv2
 from cv_bridge import CvBridge, CvBridgeError
 from sensor_msgs.msg import Image as Image_msg
+from obs_transport import decode_image
 
 class Visual_MPC_Server(object):
     def __init__(self):
@@ -103,6 +106,13 @@ class Visual_MPC_Server(object):
 
         self.save_subdir = None
 
+        # planning thread of the anytime mode, the result of its cem_controller.act call or the exc_info of
+        # its exception, and the plan status sent back when the deadline was reached
+        self.planner = None
+        self.plan_result = None
+        self.plan_error = None
+        self.sent_status = None
+
         if self.use_robot:
             # initializing the servives:
             rospy.Service('get_action', get_action, self.get_action_handler)
@@ -137,6 +147,7 @@ class Visual_MPC_Server(object):
                                                                         goal_pix)
 
     def init_traj_visualmpc_handler(self, req):
+        self.wait_for_planner()
         self.igrp = req.igrp
         self.i_traj = req.itr
 
@@ -163,46 +174,116 @@ class Visual_MPC_Server(object):
         return init_traj_visualmpcResponse()
 
     def get_action_handler(self, req):
+        self.wait_for_planner()
 
         self.traj.X_full[self.t, :] = req.state
-        main_img = self.bridge.imgmsg_to_cv2(req.main)
-        main_img = cv2.cvtColor(main_img, cv2.COLOR_BGR2RGB)
-        aux1_img = self.bridge.imgmsg_to_cv2(req.aux1)
-        aux1_img = cv2.cvtColor(aux1_img, cv2.COLOR_BGR2RGB)
+        main_img, aux1_img = self.decode_views(req)
 
         if 'single_view' in self.netconf:
             self.traj._sample_images[self.t] = main_img
         else:
+            if aux1_img is None:
+                aux1_img = np.zeros_like(main_img)
             # flip order of main and aux1 to match training of double view architecture
             self.traj._sample_images[self.t] = np.concatenate((aux1_img, main_img), 2)
 
         self.desig_pos_aux1 = req.desig_pos_aux1
         self.goal_pos_aux1 = req.goal_pos_aux1
 
-        if 'ndesig' in self.policyparams:
-            mj_U, pos, best_ind, init_pix_distrib1, init_pix_distrib2  = self.cem_controller.act(self.traj, self.t,
-                                                                                  req.desig_pos_aux1,
-                                                                                  req.goal_pos_aux1)
-
-            if 'predictor_propagation' in self.policyparams and self.t > 0:
-                self.initial_pix_distrib1.append(init_pix_distrib1[-1][0])
-                self.initial_pix_distrib2.append(init_pix_distrib2[-1][0])
+        self.plan_result = None
+        self.sent_status = None
+        self.cem_controller.plan_status = None
+        self.planner = threading.Thread(target=self.plan, args=(self.t, req.desig_pos_aux1, req.goal_pos_aux1))
+        self.planner.start()
+
+        if req.deadline > 0:
+            # anytime mode: answer with the best action of the iterations completed until the deadline,
+            # but with at least one completed iteration
+            self.planner.join(req.deadline)
+            while self.planner.is_alive() and self.cem_controller.plan_status is None:
+                self.planner.join(.01)
         else:
-            mj_U, pos, best_ind, init_pix_distrib = self.cem_controller.act(self.traj, self.t,
-                                                                            req.desig_pos_aux1,
-                                                                            req.goal_pos_aux1)
+            self.planner.join()
 
-            if 'predictor_propagation' in self.policyparams and self.t > 0:
-                self.initial_pix_distrib.append(init_pix_distrib[-1][0])
+        if self.planner.is_alive():
+            self.cem_controller.termination.stop()
+            self.sent_status = self.cem_controller.plan_status
+            iterations, score, mj_U = self.sent_status[:3]
+            print 'deadline of {} s reached after {} iterations'.format(req.deadline, iterations)
+        else:
+            self.raise_plan_error()
+            mj_U = self.plan_result[0]
+            if self.cem_controller.plan_status is not None:
+                iterations, score = self.cem_controller.plan_status[:2]
+            else: iterations, score = 0, 0.
 
         self.traj.U[self.t, :] = mj_U
 
         if self.t == self.agentparams['T'] -1:
+            self.wait_for_planner()
             if 'no_pixdistrib_video' not in self.policyparams:
                 self.save_video()
 
         self.t += 1
-        return get_actionResponse(tuple(mj_U))
+        return get_actionResponse(tuple(mj_U), iterations, score)
+
+    def decode_views(self, req):
+        """
+        :return: main and aux1 view in RGB, aux1 is None in single_view mode or if the client sent none
+        """
+        if req.encoding != '':
+            aux1_img = None
+            if 'single_view' not in self.netconf:
+                aux1_img = decode_image(req.encoding, req.aux1_data)
+            return decode_image(req.encoding, req.main_data), aux1_img
+
+        main_img = self.bridge.imgmsg_to_cv2(req.main)
+        main_img = cv2.cvtColor(main_img, cv2.COLOR_BGR2RGB)
+        if 'single_view' in self.netconf:
+            return main_img, None
+        aux1_img = self.bridge.imgmsg_to_cv2(req.aux1)
+        aux1_img = cv2.cvtColor(aux1_img, cv2.COLOR_BGR2RGB)
+        return main_img, aux1_img
+
+    def plan(self, t, desig_pos_aux1, goal_pos_aux1):
+        try:
+            self.plan_result = self.cem_controller.act(self.traj, t, desig_pos_aux1, goal_pos_aux1)
+        except Exception:
+            self.plan_error = sys.exc_info()
+
+    def raise_plan_error(self):
+        """
+        re-raises an exception of the planning thread in the thread of the service handler
+        """
+        if self.plan_error is not None:
+            exc_type, exc_value, exc_traceback = self.plan_error
+            self.plan_error = None
+            self.planner = None
+            raise exc_type, exc_value, exc_traceback
+
+    def wait_for_planner(self):
+        """
+        waits until the optimization of the last request stopped and stores its pixel distributions
+        """
+        if self.planner is None:
+            return
+        self.planner.join()
+        self.planner = None
+        self.raise_plan_error()
+        t = len(self.cem_controller.action_list) - 1
+        # the controller logs the action of its last iteration, the robot executed the one sent back
+        self.cem_controller.action_list[-1] = self.traj.U[t]
+        if self.sent_status is not None and 'predictor_propagation' in self.policyparams:
+            self.cem_controller.replace_last_record(self.sent_status[3])
+
+        if 'predictor_propagation' in self.policyparams and t > 0:
+            if 'ndesig' in self.policyparams:
+                init_pix_distrib1, init_pix_distrib2 = self.plan_result[3:5]
+                self.initial_pix_distrib1.append(init_pix_distrib1[-1][0])
+                self.initial_pix_distrib2.append(init_pix_distrib2[-1][0])
+            else:
+                init_pix_distrib = self.plan_result[3]
+                self.initial_pix_distrib.append(init_pix_distrib[-1][0])
 
     def save_video(self):
         file_path = self.netconf['current_dir'] + '/videos'
@@ -0,0 +1,93 @@
+""" Measures size, encode and decode cost of the image codecs of trajectory_record on frames of a dataset. """
+import argparse
+import time
+import numpy as np
+import tensorflow as tf
+
+from python_visual_mpc.video_prediction.utils_vpred.numpy_tfrecord import encode_frame, decode_frame, \
+    read_trajectories
+
+
+def load_frames(data_dir, ntraj):
+    """
+    :return: N x H x W x 3 uint8 frames of the first ntraj trajectories
+    """
+    frames = []
+    for itraj, traj in enumerate(read_trajectories(data_dir)):
+        frames.append(traj['image'] if 'image' in traj else traj['image_aux1'])
+        if itraj + 1 == ntraj:
+            break
+    return np.concatenate(frames)
+
+
+def psnr(a, b):
+    mse = np.mean((a.astype(np.float64) - b.astype(np.float64))**2)
+    if mse == 0:
+        return np.inf
+    return 10*np.log10(255.**2/mse)
+
+
+def benchmark(frames, codec, jpeg_quality):
+    n = frames.shape[0]
+    if codec == 'raw':
+        t_start = time.time()
+        encoded = [f.tostring() for f in frames]
+        t_enc = time.time() - t_start
+        t_start = time.time()
+        decoded = np.stack([np.frombuffer(e, np.uint8).reshape(frames.shape[1:]) for e in encoded])
+        t_dec = time.time() - t_start
+        t_dec_tf = None
+    else:
+        t_start = time.time()
+        encoded = [encode_frame(f, codec, jpeg_quality) for f in frames]
+        t_enc = time.time() - t_start
+        t_start = time.time()
+        decoded = np.stack([decode_frame(e) for e in encoded])
+        t_dec = time.time() - t_start
+
+        # in-graph decoding as done by the training input pipeline
+        with tf.Graph().as_default():
+            pl = tf.placeholder(tf.string, shape=[])
+            if codec == 'png':
+                op = tf.image.decode_png(pl, channels=3)
+            else: op = tf.image.decode_jpeg(pl, channels=3)
+            with tf.Session() as sess:
+                sess.run(op, {pl: encoded[0]})
+                t_start = time.time()
+                for e in encoded:
+                    sess.run(op, {pl: e})
+                t_dec_tf = time.time() - t_start
+
+    nbytes = sum(len(e) for e in encoded)
+    return {'bytes_per_frame': nbytes / float(n),
+            'encode_ms': 1e3*t_enc/n,
+            'decode_ms': 1e3*t_dec/n,
+            'decode_tf_ms': None if t_dec_tf is None else 1e3*t_dec_tf/n,
+            'psnr': psnr(frames, decoded)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the image codecs on a dataset')
+    parser.add_argument('data_dir', type=str, help='directory with tfrecords, e.g. pushing_data/<name>/train')
+    parser.add_argument('--ntraj', type=int, default=32, help='number of trajectories to use')
+    parser.add_argument('--jpeg_quality', type=int, nargs='+', default=[95, 85, 75])
+    args = parser.parse_args()
+
+    frames = load_frames(args.data_dir, args.ntraj)
+    print 'benchmarking on {} frames of shape {}'.format(frames.shape[0], frames.shape[1:])
+
+    settings = [('raw', None), ('png', None)] + [('jpeg', q) for q in args.jpeg_quality]
+    raw_size = float(frames[0].nbytes)
+    print '{:>10} {:>12} {:>8} {:>10} {:>10} {:>13} {:>8}'.format(
+        'codec', 'bytes/frame', 'ratio', 'enc ms', 'dec ms', 'tf dec ms', 'psnr')
+    for codec, quality in settings:
+        res = benchmark(frames, codec, quality)
+        name = codec if quality is None else '{}{}'.format(codec, quality)
+        tf_dec = '-' if res['decode_tf_ms'] is None else '{:.3f}'.format(res['decode_tf_ms'])
+        print '{:>10} {:>12.0f} {:>8.2f} {:>10.3f} {:>10.3f} {:>13} {:>8.1f}'.format(
+            name, res['bytes_per_frame'], raw_size / res['bytes_per_frame'], res['encode_ms'],
+            res['decode_ms'], tf_dec, res['psnr'])
+
+
+if __name__ == '__main__':
+    main()
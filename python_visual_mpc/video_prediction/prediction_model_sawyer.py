@@ -83,6 +83,9 @@ class Prediction_Model(object):
 
         self.trafos = []
 
+        # batch-1 encodings of the context frames, see build()
+        self.context_enc = []
+
 
     def build(self):
 
@@ -124,6 +127,10 @@ class Prediction_Model(object):
         lstm_state1, lstm_state2, lstm_state3, lstm_state4 = None, None, None, None
         lstm_state5, lstm_state6, lstm_state7 = None, None, None
 
+        # for control all samples share the same context frames, therefore the action-independent
+        # encoder layers are computed on a single sample during the context steps and tiled to the batch
+        cache_context = 'cache_context' in self.conf
+
         t = -1
         for image, action in zip(self.images[:-1], self.actions[:-1]):
             t +=1
@@ -174,6 +181,10 @@ class Prediction_Model(object):
                 if not 'ignore_state_action' in self.conf:
                     state_action = tf.concat(axis=1, values=[action, current_state])
 
+                encode_context = cache_context and not done_warm_start
+                if encode_context:
+                    input_image = input_image[:1]
+
                 enc0 = slim.layers.conv2d(    #32x32x32
                     input_image,
                     32, [5, 5],
@@ -196,6 +207,14 @@ class Prediction_Model(object):
                 enc2 = slim.layers.conv2d(  # 8x8x32
                     hidden3, hidden3.get_shape()[3], [3, 3], stride=2, scope='conv3')
 
+                if encode_context:
+                    self.context_enc += [enc0, enc1, enc2]
+                    enc0, enc1, enc2 = [tile_batch(e, batch_size) for e in [enc0, enc1, enc2]]
+                    if t == self.context_frames - 1:
+                        self.context_enc += [lstm_state1, lstm_state3]
+                        lstm_state1 = tile_batch(lstm_state1, batch_size)
+                        lstm_state3 = tile_batch(lstm_state3, batch_size)
+
                 if not 'ignore_state_action' in self.conf:
                     # Pass in state and action.
                     if 'ignore_state' in self.conf:
@@ -521,6 +540,11 @@ class Prediction_Model(object):
         return transformed, cdna_kerns_summary
 
 
+def tile_batch(tensor, batch_size):
+    """Repeat a tensor with batch dimension 1 batch_size times along the batch dimension."""
+    return tf.tile(tensor, [int(batch_size)] + [1] * (len(tensor.get_shape()) - 1))
+
+
 def scheduled_sample(ground_truth_x, generated_x, batch_size, num_ground_truth):
     """Sample batch with specified mix of ground truth and generated data_files points.
 
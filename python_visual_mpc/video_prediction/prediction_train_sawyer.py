@@ -25,6 +25,7 @@ VAL_INTERVAL = 200
 SAVE_INTERVAL = 2000
 
 from prediction_model_sawyer import Prediction_Model
+from python_visual_mpc.video_prediction.utils_vpred.input_pipeline import INPUT_INITIALIZERS
 
 from PIL import Image
 
@@ -75,7 +76,8 @@ class Model(object):
 
         self.conf = conf
 
-        if 'use_len' in conf:
+        # the memory-mapped reader already returns shifted sequences of length use_len
+        if 'use_len' in conf and images.get_shape()[1] > conf['use_len']:
             print 'randomly shift videos for data augmentation'
             images, states, actions  = self.random_shift(images, states, actions)
 
@@ -294,6 +296,7 @@ def main(unused_argv, conf_script= None):
 
     tf.train.start_queue_runners(sess)
     sess.run(tf.global_variables_initializer())
+    sess.run(tf.get_collection(INPUT_INITIALIZERS))
 
     if conf['visualize']:
         print '-------------------------------------------------------------------'
@@ -0,0 +1,243 @@
+"""
+Prediction service shared by several controllers, e.g. parallel benchmark workers or several robots.
+
+The server process owns the gpu sessions of one model. Requests of all connected clients are queued and
+coalesced into full device batches of conf['batch_size'] samples: a batch is run when it is full or when the
+oldest queued request waited max_latency seconds. Every sample carries the index of its context, so requests
+with different context frames share a batch, requests larger than a batch are split across batches.
+
+usage: python predictor_server.py <netconf> [--port 6000] [--gpu_id 0] [--ngpu 1] [--max_contexts 8]
+                                            [--max_latency 0.01] [--batch_size 400]
+controllers connect by setting 'setup_predictor': setup_predictor_client and 'predictor_server': (host, port)
+in their netconf, their batch_size is the number of samples per request and may differ from the device batch.
+A failing batch is answered with the error to the requests in it, the client raises it, the server keeps running.
+"""
+import argparse
+import imp
+import threading
+import time
+import traceback
+from multiprocessing.connection import Listener, Client
+from Queue import Queue, Empty
+import numpy as np
+
+AUTHKEY = 'visual_mpc'
+OUTPUTS = ['gen_images', 'gen_distrib1', 'gen_distrib2', 'gen_states']
+
+
+class PredictionRequest(object):
+    def __init__(self, conn, inputs):
+        self.conn = conn
+        self.inputs = inputs
+        self.nsamples = inputs['actions'].shape[0]
+        self.nqueued = 0  # samples which are already part of a device batch
+        self.ndone = 0
+        self.outputs = None
+        self.t_arrival = time.time()
+
+    def store(self, outputs, start, pos, n):
+        """
+        :param outputs: dict name -> T x batch_size x ... array of the device batch, or None
+        copies the results of the samples start to start + n from position pos of the device batch
+        """
+        if self.outputs is None:
+            self.outputs = {}
+            for name in self.inputs['outputs']:
+                if outputs[name] is not None:
+                    self.outputs[name] = np.zeros((outputs[name].shape[0], self.nsamples) + outputs[name].shape[2:],
+                                                  dtype=outputs[name].dtype)
+        for name in self.outputs:
+            self.outputs[name][:, start:start + n] = outputs[name][:, pos:pos + n]
+        self.ndone += n
+        return self.ndone == self.nsamples
+
+    def reply(self):
+        # lists over time as returned by predictor_func
+        self.send(dict((name, list(value)) for name, value in self.outputs.items()))
+
+    def fail(self, message):
+        self.send({'error': message})
+
+    def send(self, result):
+        try:
+            self.conn.send(result)
+        except (IOError, EOFError), e:
+            # the client disconnected, receive closes the connection
+            print 'dropping the reply to a disconnected client: {}'.format(e)
+
+
+class PredictorServer(object):
+    def __init__(self, conf, predictor, max_contexts, max_latency):
+        self.conf = conf
+        self.predictor = predictor
+        self.batch_size = conf['batch_size']
+        self.max_contexts = max_contexts
+        self.max_latency = max_latency
+        self.requests = Queue()
+        self.nbatches, self.nsamples = 0, 0
+
+    def serve(self, address):
+        listener = Listener(address, authkey=AUTHKEY)
+        worker = threading.Thread(target=self.run_batches)
+        worker.daemon = True
+        worker.start()
+        print 'prediction server listening on {}'.format(address)
+        while True:
+            conn = listener.accept()
+            print 'client connected from', listener.last_accepted
+            client = threading.Thread(target=self.receive, args=(conn,))
+            client.daemon = True
+            client.start()
+
+    def receive(self, conn):
+        try:
+            while True:
+                self.requests.put(PredictionRequest(conn, conn.recv()))
+        except (IOError, EOFError):
+            conn.close()
+
+    def run_batches(self):
+        pending = []
+        while True:
+            if not pending:
+                pending.append(self.requests.get())
+            # wait for more requests until the batch is full or the oldest request waited max_latency
+            while sum(r.nsamples - r.nqueued for r in pending) < self.batch_size:
+                timeout = pending[0].t_arrival + self.max_latency - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    pending.append(self.requests.get(timeout=timeout))
+                except Empty:
+                    break
+            self.run_batch(pending)
+
+    def run_batch(self, pending):
+        """
+        runs one device batch with the samples of the first requests in pending, removes the requests
+        which are completely queued. If the batch fails, its requests are answered with the error and removed.
+        """
+        batch = []  # requests with samples in this batch
+        try:
+            self._run_batch(pending, batch)
+        except Exception:
+            message = traceback.format_exc()
+            print 'batch failed:\n' + message
+            for request in batch:
+                if request.ndone < request.nsamples:  # not answered yet
+                    request.fail(message)
+                # a request split across batches may still have samples pending
+                if request in pending:
+                    pending.remove(request)
+
+    def _run_batch(self, pending, batch):
+        first = pending[0]
+        batch.append(first)
+        inputs = first.inputs
+        actions = np.zeros((self.batch_size,) + inputs['actions'].shape[1:], dtype=np.float32)
+        context_index = np.zeros(self.batch_size, dtype=np.int32)
+        distrib_shape = (self.max_contexts, self.conf['context_frames'], 64, 64, 1)
+        contexts = {'images': np.zeros((self.max_contexts,) + inputs['images'].shape, dtype=np.uint8),
+                    'states': np.zeros((self.max_contexts,) + np.shape(inputs['states']), dtype=np.float32),
+                    'one_hot_images1': np.zeros(distrib_shape, dtype=np.float32),
+                    'one_hot_images2': np.zeros(distrib_shape, dtype=np.float32)}
+
+        parts = []
+        filled = 0
+        while pending and filled < self.batch_size and len(parts) < self.max_contexts:
+            request = pending[0]
+            if request not in batch:
+                batch.append(request)
+            n = min(request.nsamples - request.nqueued, self.batch_size - filled)
+            actions[filled:filled + n] = request.inputs['actions'][request.nqueued:request.nqueued + n]
+            context_index[filled:filled + n] = len(parts)
+            for key in contexts:
+                if request.inputs[key] is not None:
+                    contexts[key][len(parts)] = request.inputs[key]
+            parts.append((request, request.nqueued, filled, n))
+            request.nqueued += n
+            filled += n
+            if request.nqueued == request.nsamples:
+                pending.pop(0)
+
+        gen_images, gen_distrib1, gen_distrib2, gen_states, _ = self.predictor(
+            input_images=contexts['images'], input_state=contexts['states'], input_actions=actions,
+            input_one_hot_images1=contexts['one_hot_images1'], input_one_hot_images2=contexts['one_hot_images2'],
+            context_index=context_index)
+        outputs = {'gen_images': gen_images, 'gen_distrib1': gen_distrib1, 'gen_distrib2': gen_distrib2,
+                   'gen_states': gen_states}
+        for name in outputs:
+            if outputs[name] is not None:
+                outputs[name] = np.stack(outputs[name])
+
+        for request, start, pos, n in parts:
+            if request.store(outputs, start, pos, n):
+                request.reply()
+        self.nbatches += 1
+        self.nsamples += filled
+        print 'batch {}: {} requests, {} of {} samples used'.format(self.nbatches, len(parts), filled,
+                                                                   self.batch_size)
+
+
+def setup_predictor_client(conf, gpu_id=0, ngpu=1):
+    """
+    connects to the prediction server at conf['predictor_server'], gpu_id and ngpu are set by the server
+    :return: function with the arguments of the predictor_func of setup_predictor_towers
+    """
+    conn = Client(tuple(conf['predictor_server']), authkey=AUTHKEY)
+    if 'predictor_outputs' in conf:
+        outputs = list(conf['predictor_outputs'])
+    else: outputs = ['gen_distrib1', 'gen_distrib2', 'gen_states']
+
+    def predictor_func(input_images=None, input_one_hot_images1=None, input_one_hot_images2=None, input_state=None,
+                       input_actions=None, **kwargs):
+        """
+        only the outputs listed in predictor_func.outputs are sent back, the others are None
+        """
+        conn.send({'images': input_images, 'states': input_state, 'actions': input_actions,
+                   'one_hot_images1': input_one_hot_images1, 'one_hot_images2': input_one_hot_images2,
+                   'outputs': outputs})
+        result = conn.recv()
+        if 'error' in result:
+            raise RuntimeError('prediction server failed:\n' + result['error'])
+        return tuple(result.get(name) for name in OUTPUTS) + (None,)
+
+    # conf['predictor_outputs'] or the default, controllers add the outputs they need with require_outputs
+    predictor_func.outputs = outputs
+    return predictor_func
+
+
+def require_outputs(predictor, names):
+    """
+    adds names to the outputs requested by a predictor of setup_predictor_client,
+    other predictors return all outputs and are left unchanged
+    """
+    if hasattr(predictor, 'outputs'):
+        for name in names:
+            if name not in predictor.outputs:
+                predictor.outputs.append(name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='run a prediction server for several controllers')
+    parser.add_argument('netconf', type=str, help='conf file of the network')
+    parser.add_argument('--port', type=int, default=6000)
+    parser.add_argument('--gpu_id', type=int, default=0)
+    parser.add_argument('--ngpu', type=int, default=1)
+    parser.add_argument('--max_contexts', type=int, default=8, help='maximum number of requests in one batch')
+    parser.add_argument('--max_latency', type=float, default=0.01,
+                        help='seconds a request may wait for other requests to fill the batch')
+    parser.add_argument('--batch_size', type=int, default=None, help='device batch size, default from netconf')
+    args = parser.parse_args()
+
+    from python_visual_mpc.video_prediction.setup_predictor_towers import setup_predictor
+    conf = imp.load_source('params', args.netconf).configuration
+    conf['batched_contexts'] = args.max_contexts
+    if args.batch_size is not None:
+        conf['batch_size'] = args.batch_size
+    predictor = setup_predictor(conf, args.gpu_id, args.ngpu)
+    PredictorServer(conf, predictor, args.max_contexts, args.max_latency).serve(('', args.port))
+
+
+if __name__ == '__main__':
+    main()
@@ -10,6 +10,9 @@ import os
 
 from datetime import datetime
 import ray
+from python_visual_mpc.visual_mpc_core.algorithm.cem_scoring import get_tstep_weights, calc_expected_distance
+from python_visual_mpc.visual_mpc_core.algorithm.distance_fields import get_distance_field
+from python_visual_mpc.video_prediction.utils_vpred.context_inputs import ContextPlaceholders
 
 @ray.remote(num_gpus=1)
 class LocalServer(object):
@@ -19,6 +22,7 @@ class LocalServer(object):
         self.policyparams = policyparams
         self.local_batch_size = local_batch_size
         self.netconf = netconf
+        self.tstep_weights = get_tstep_weights(policyparams, netconf['sequence_length'] - 1)
         if 'prediction_model' in netconf:
             Model = netconf['prediction_model']
         else:
@@ -54,18 +58,15 @@ class LocalServer(object):
             numcam = 1
         else:
             numcam = 2
-        self.start_images_pl = tf.placeholder(tf.float32, name='images',  # with zeros extension
-                                        shape=(local_batch_size, netconf['sequence_length'], 64, 64, 3*numcam))
         self.actions_pl = tf.placeholder(tf.float32, name='actions',
                                         shape=(local_batch_size,netconf['sequence_length'], 4))
-        self.start_states_pl = tf.placeholder(tf.float32, name='states',
-                                              shape=(local_batch_size,netconf['context_frames'], 3))
-        self.pix_distrib_1_pl = tf.placeholder(tf.float32, shape=(local_batch_size, netconf['context_frames'], 64, 64, numcam))
-        self.pix_distrib_2_pl = tf.placeholder(tf.float32, shape=(local_batch_size, netconf['context_frames'], 64, 64, numcam))
+        # the context is the same for all samples, it is broadcast inside the graph
+        self.context = ContextPlaceholders(netconf, sdim=3, img_channels=3*numcam, distrib_channels=numcam)
+        start_images, start_states, pix_distrib1, _ = self.context.broadcast(local_batch_size)
 
         with tf.variable_scope('model', reuse=None):
-            self.model = Model(netconf, self.start_images_pl, self.actions_pl, self.start_states_pl,
-                               pix_distrib=self.pix_distrib_1_pl)
+            self.model = Model(netconf, start_images, self.actions_pl, start_states,
+                               pix_distrib=pix_distrib1)
 
         self.sess.run(tf.global_variables_initializer())
 
@@ -83,29 +84,14 @@ class LocalServer(object):
 
 
     def predict(self, last_frames=None, input_distrib=None, last_states=None, input_actions=None, goal_pix=None):
-
-        input_distrib = np.expand_dims(input_distrib, axis=0)
-        input_distrib = np.repeat(input_distrib, self.local_batch_size, 0)
-
         t_startiter = datetime.now()
 
-        last_states = np.expand_dims(last_states, axis=0)
-        input_state = np.repeat(last_states, self.local_batch_size, axis=0)
-        img_channels = 3
-        last_frames = np.expand_dims(last_frames, axis=0)
-        last_frames = np.repeat(last_frames, self.local_batch_size, axis=0)
-
-        app_zeros = np.zeros(shape=(self.local_batch_size, self.netconf['sequence_length'] -
-                                    self.netconf['context_frames'], 64, 64, img_channels))
-        last_frames = np.concatenate((last_frames, app_zeros), axis=1)
-        input_images = last_frames.astype(np.float32) / 255.
-
         feed_dict = {}
-        feed_dict[self.start_images_pl] = input_images
-        feed_dict[self.start_states_pl] = input_state
+        feed_dict[self.context.images] = last_frames
+        feed_dict[self.context.states] = last_states
         feed_dict[self.actions_pl] = input_actions
 
-        feed_dict[self.pix_distrib_1_pl] = input_distrib
+        feed_dict[self.context.pix_distrib1] = input_distrib
 
         distance_grid = self.get_distancegrid(goal_pix)
         gen_images, gen_distrib, gen_states = self.sess.run([self.model.gen_images,
@@ -126,37 +112,15 @@ class LocalServer(object):
         return (best_gen_distrib, scores[bestind]), scores
 
     def calc_scores(self, gen_distrib, distance_grid):
-        expected_distance = np.zeros(self.local_batch_size)
-        if 'rew_all_steps' in self.policyparams:
-            for tstep in range(self.netconf['sequence_length'] - 1):
-                t_mult = 1
-                if 'finalweight' in self.policyparams:
-                    if tstep == self.netconf['sequence_length'] - 2:
-                        t_mult = self.policyparams['finalweight']
-
-                for b in range(self.local_batch_size):
-                    gen = gen_distrib[tstep][b].squeeze() / np.sum(gen_distrib[tstep][b])
-                    expected_distance[b] += np.sum(np.multiply(gen, distance_grid)) * t_mult
-            scores = expected_distance
-        else:
-            for b in range(self.local_batch_size):
-                gen = gen_distrib[-1][b].squeeze() / np.sum(gen_distrib[-1][b])
-                expected_distance[b] = np.sum(np.multiply(gen, distance_grid))
-            scores = expected_distance
-        return scores
+        return calc_expected_distance(gen_distrib, distance_grid, self.tstep_weights)
 
     def get_distancegrid(self, goal_pix):
-        distance_grid = np.empty((64, 64))
-        for i in range(64):
-            for j in range(64):
-                pos = np.array([i, j])
-                distance_grid[i, j] = np.linalg.norm(goal_pix - pos)
-
-        print 'making distance grid with goal_pix', goal_pix
-        return distance_grid
+        return get_distance_field(goal_pix, self.policyparams)
 
 
 def setup_predictor(netconf, policyparams, ngpu, redis_address=''):
+    if 'normalize_state_action' in netconf:
+        raise ValueError("'normalize_state_action' is not supported by the ray predictor")
     if redis_address == '':
         ray.init(num_gpus=ngpu)
     else:
@@ -17,6 +17,11 @@ ACION_DIM = 2
 OBJECT_POS_DIM = 3
 
 from python_visual_mpc.video_prediction.utils_vpred.create_gif_lib import *
+from python_visual_mpc.video_prediction.utils_vpred.trajectory_record import FORMAT_VERSION, record_format_version, \
+    record_codecs, parse_trajectory, parse_trajectory_batch
+from python_visual_mpc.video_prediction.utils_vpred.input_pipeline import split_filenames, parse_timesteps_batch, \
+    make_batched_dataset, skip_bad_shards, normalize_state_action
+from python_visual_mpc.video_prediction.utils_vpred.mmap_dataset import build_mmap_input
 
 def build_tfrecord_input(conf, training=True, gtruth_pred = False, shuffle_vis = False):
     """Create input tfrecord tensors.
@@ -31,7 +36,14 @@ def build_tfrecord_input(conf, training=True, gtruth_pred = False, shuffle_vis =
     Raises:
       RuntimeError: if no files found.
     """
-    filenames = gfile.Glob(os.path.join(conf['data_dir'], '*'))
+    if 'normalize_state_action' in conf and ('mmap_cache' in conf or not 'tf_data' in conf or gtruth_pred):
+        raise ValueError("'normalize_state_action' is only supported with 'tf_data'")
+    if 'mmap_cache' in conf and not gtruth_pred:
+        return batch_outputs(conf, build_mmap_input(conf, training))
+    if 'tf_data' in conf and not gtruth_pred:
+        return build_dataset_input(conf, training, shuffle_vis)
+
+    filenames = gfile.Glob(os.path.join(conf['data_dir'], '*.tfrecords'))
     if not filenames:
         raise RuntimeError('No data_files files found.')
 
@@ -46,6 +58,9 @@ def build_tfrecord_input(conf, training=True, gtruth_pred = False, shuffle_vis =
         else:
             filenames = filenames[index:]
 
+    if not filenames:
+        raise RuntimeError('No data_files files found for the {} split with train_val_split {}.'.format(
+            'training' if training else 'validation', conf['train_val_split']))
     filename_queue = tf.train.string_input_producer(filenames, shuffle=shuffle)
     reader = tf.TFRecordReader()
     _, serialized_example = reader.read(filename_queue)
@@ -56,75 +71,79 @@ def build_tfrecord_input(conf, training=True, gtruth_pred = False, shuffle_vis =
     load_indx = load_indx[:conf['sequence_length']]
     print 'using frame sequence: ', load_indx
 
-    for i in load_indx:
-        if gtruth_pred:
-            image_pred_name = 'move/' + str(i) + '/image_pred/encoded'
-            image_gtruth_name = 'move/' + str(i) + '/image_gtruth/encoded'
-
-            features = {
-                image_pred_name: tf.FixedLenFeature([1], tf.string),
-                image_gtruth_name: tf.FixedLenFeature([1], tf.string),
-            }
-        else:
-            image_name = 'move/' + str(i) + '/image/encoded'
-            action_name = 'move/' + str(i) + '/action'
-            state_name = 'move/' + str(i) + '/state'
-            object_pos_name = 'move/' + str(i) + '/object_pos'
-            max_move_pos_name = 'move/' + str(i) + '/max_move_pose'
-
-            features = {
-                        image_name: tf.FixedLenFeature([1], tf.string),
-                        action_name: tf.FixedLenFeature([ACION_DIM], tf.float32),
-                        state_name: tf.FixedLenFeature([STATE_DIM], tf.float32)
-            }
-        if 'use_object_pos' in conf.keys():
-            if 'num_obj' in conf:
-                num_obj = conf['num_obj']
-            else: num_obj = 1
-            features[object_pos_name] = tf.FixedLenFeature([OBJECT_POS_DIM*num_obj], tf.float32)
-            features[max_move_pos_name] = tf.FixedLenFeature([OBJECT_POS_DIM], tf.float32)
+    if not gtruth_pred and record_format_version(filenames[0]) == FORMAT_VERSION:
+        image_seq, retina_seq, state_seq, action_seq, touch_seq, object_pos_seq, max_move_pos_seq = \
+            parse_tfrecord_v2(serialized_example, conf, load_indx, record_codecs(filenames[0]))
+    else:
+        for i in load_indx:
+            if gtruth_pred:
+                image_pred_name = 'move/' + str(i) + '/image_pred/encoded'
+                image_gtruth_name = 'move/' + str(i) + '/image_gtruth/encoded'
+
+                features = {
+                    image_pred_name: tf.FixedLenFeature([1], tf.string),
+                    image_gtruth_name: tf.FixedLenFeature([1], tf.string),
+                }
+            else:
+                image_name = 'move/' + str(i) + '/image/encoded'
+                action_name = 'move/' + str(i) + '/action'
+                state_name = 'move/' + str(i) + '/state'
+                object_pos_name = 'move/' + str(i) + '/object_pos'
+                max_move_pos_name = 'move/' + str(i) + '/max_move_pose'
+
+                features = {
+                            image_name: tf.FixedLenFeature([1], tf.string),
+                            action_name: tf.FixedLenFeature([ACION_DIM], tf.float32),
+                            state_name: tf.FixedLenFeature([STATE_DIM], tf.float32)
+                }
+            if 'use_object_pos' in conf.keys():
+                if 'num_obj' in conf:
+                    num_obj = conf['num_obj']
+                else: num_obj = 1
+                features[object_pos_name] = tf.FixedLenFeature([OBJECT_POS_DIM*num_obj], tf.float32)
+                features[max_move_pos_name] = tf.FixedLenFeature([OBJECT_POS_DIM], tf.float32)
 
-        if 'retina' in conf:
-            retina_name = 'move/' + str(i) + '/retina/encoded'
-            features[retina_name] = tf.FixedLenFeature([1], tf.string)
-            if i == 0:
-                initial_retpos_name = 'initial_retpos'
-                features[initial_retpos_name] = tf.FixedLenFeature([2], tf.int64)
+            if 'retina' in conf:
+                retina_name = 'move/' + str(i) + '/retina/encoded'
+                features[retina_name] = tf.FixedLenFeature([1], tf.string)
+                if i == 0:
+                    initial_retpos_name = 'initial_retpos'
+                    features[initial_retpos_name] = tf.FixedLenFeature([2], tf.int64)
 
-        if 'touch' in conf:
-            touchdata_name = 'touchdata/' + str(i)
-            TOUCH_DIM = 20
-            features[touchdata_name] =  tf.FixedLenFeature([TOUCH_DIM], tf.float32)
+            if 'touch' in conf:
+                touchdata_name = 'touchdata/' + str(i)
+                TOUCH_DIM = 20
+                features[touchdata_name] =  tf.FixedLenFeature([TOUCH_DIM], tf.float32)
 
-        features = tf.parse_single_example(serialized_example, features=features)
+            features = tf.parse_single_example(serialized_example, features=features)
 
-        if gtruth_pred:
-            predimage_seq.append(resize_im( features, image_pred_name, conf))
-            gtruthimage_seq.append(resize_im( features, image_gtruth_name, conf))
+            if gtruth_pred:
+                predimage_seq.append(resize_im( features, image_pred_name, conf))
+                gtruthimage_seq.append(resize_im( features, image_gtruth_name, conf))
 
-        else:
+            else:
 
-            image_seq.append(resize_im( features, image_name, conf))
-            if 'retina' in conf:
-                retina_seq.append(resize_im(features, retina_name, conf, height=conf['retina']))
-                if i == 0:
-                    initial_retpos = tf.cast(features[initial_retpos_name], tf.int32)
+                image_seq.append(resize_im( features, image_name, conf))
+                if 'retina' in conf:
+                    retina_seq.append(resize_im(features, retina_name, conf, height=conf['retina']))
+                    if i == 0:
+                        initial_retpos = tf.cast(features[initial_retpos_name], tf.int32)
 
-            state = tf.reshape(features[state_name], shape=[1, STATE_DIM])
-            state_seq.append(state)
-            action = tf.reshape(features[action_name], shape=[1, ACION_DIM])
-            action_seq.append(action)
+                state = tf.reshape(features[state_name], shape=[1, STATE_DIM])
+                state_seq.append(state)
+                action = tf.reshape(features[action_name], shape=[1, ACION_DIM])
+                action_seq.append(action)
 
-            if 'touch' in conf:
-                touchdata = tf.reshape(features[touchdata_name], shape=[1, TOUCH_DIM])
-                touch_seq.append(touchdata)
+                if 'touch' in conf:
+                    touchdata = tf.reshape(features[touchdata_name], shape=[1, TOUCH_DIM])
+                    touch_seq.append(touchdata)
 
-            if 'use_object_pos' in conf:
-                object_pos = tf.reshape(features[object_pos_name], shape=[1, OBJECT_POS_DIM*num_obj])
-                object_pos_seq.append(object_pos)
+                if 'use_object_pos' in conf:
+                    object_pos = tf.reshape(features[object_pos_name], shape=[1, OBJECT_POS_DIM*num_obj])
+                    object_pos_seq.append(object_pos)
 
-                max_move_pos = tf.reshape(features[max_move_pos_name], shape=[1, OBJECT_POS_DIM])
-                max_move_pos_seq.append(max_move_pos)
+                    max_move_pos = tf.reshape(features[max_move_pos_name], shape=[1, OBJECT_POS_DIM])
+                    max_move_pos_seq.append(max_move_pos)
 
     if gtruth_pred:
         gtruthimage_seq = tf.concat(axis=0, values=gtruthimage_seq)
@@ -188,6 +207,131 @@ def build_tfrecord_input(conf, training=True, gtruth_pred = False, shuffle_vis =
             return image_batch, action_batch, state_batch
 
 
+def record_specs(conf, v2):
+    """
+    :return: the modalities used with conf, in the form of the specs of trajectory_record.parse_trajectory
+    for the compact layout or of input_pipeline.parse_timesteps_batch for the per-timestep layout
+    """
+    if '128x128' in conf:
+        img_size = 128
+    else: img_size = 64
+    COLOR_CHAN = 3
+    if 'num_obj' in conf:
+        num_obj = conf['num_obj']
+    else: num_obj = 1
+
+    specs = {'image': ('move/{}/image/encoded', tf.uint8, [img_size, img_size, COLOR_CHAN]),
+             'action': ('move/{}/action', tf.float32, [ACION_DIM]),
+             'state': ('move/{}/state', tf.float32, [STATE_DIM])}
+    if 'use_object_pos' in conf:
+        specs['object_pos'] = ('move/{}/object_pos', tf.float32, [OBJECT_POS_DIM*num_obj])
+        specs['max_move_pose'] = ('move/{}/max_move_pose', tf.float32, [OBJECT_POS_DIM])
+    if 'retina' in conf:
+        specs['retina'] = ('move/{}/retina/encoded', tf.uint8, [conf['retina'], conf['retina'], COLOR_CHAN])
+    if 'touch' in conf:
+        specs['touchdata'] = ('touchdata/{}', tf.float32, [20])
+
+    if v2:
+        return {name: (dtype, [-1] + shape) for name, (key, dtype, shape) in specs.items()}
+    return specs
+
+
+def build_dataset_input(conf, training=True, shuffle_vis=False):
+    """
+    same outputs as build_tfrecord_input, read with the tf.data pipeline of utils_vpred.input_pipeline.
+    The files are split into training and validation set by a hash of their names.
+    """
+    filenames = gfile.Glob(os.path.join(conf['data_dir'], '*.tfrecords'))
+    if not filenames:
+        raise RuntimeError('No data_files files found.')
+
+    if conf['visualize']:
+        print 'using input file', filenames
+        filenames = sorted(filenames)
+        shuffle = shuffle_vis
+    else:
+        filenames = split_filenames(filenames, conf['train_val_split'], training)
+        shuffle = True
+    if 'skip_bad_shards' in conf:
+        filenames = skip_bad_shards(filenames, conf['data_dir'])
+    if not filenames:
+        raise RuntimeError('No data_files files found.')
+
+    load_indx = range(0, 30, conf['skip_frame'])
+    load_indx = load_indx[:conf['sequence_length']]
+    print 'using frame sequence: ', load_indx
+
+    v2 = record_format_version(filenames[0]) == FORMAT_VERSION
+    specs = record_specs(conf, v2)
+    codecs = record_codecs(filenames[0]) if v2 else None
+
+    def parse_batch(serialized_batch):
+        if v2:
+            batch = parse_trajectory_batch(serialized_batch, specs, load_indx, codecs)
+        else:
+            batch = parse_timesteps_batch(serialized_batch, specs, load_indx)
+        # the images are stored at the resolution used for training, no resizing is needed
+        for name in ['image', 'retina']:
+            if name in batch:
+                batch[name] = tf.cast(batch[name], tf.float32) / 255.0
+        if 'normalize_state_action' in conf:
+            normalize_state_action(batch, conf)
+        return batch
+
+    return batch_outputs(conf, make_batched_dataset(filenames, conf, parse_batch, shuffle))
+
+
+def batch_outputs(conf, batch):
+    """
+    :param batch: dict name -> batch x time x ... tensor
+    :return: the tensors in the order returned by build_tfrecord_input
+    """
+    image_batch, action_batch, state_batch = batch['image'], batch['action'], batch['state']
+
+    if 'use_object_pos' in conf:
+        # list of batch x 1 x dim tensors, as returned by build_tfrecord_input
+        seqlen = int(batch['object_pos'].get_shape()[1])
+        object_pos_batch = tf.split(batch['object_pos'], seqlen, axis=1)
+        max_move_pos_batch = tf.split(batch['max_move_pose'], seqlen, axis=1)
+    else:
+        object_pos_batch = []
+
+    if 'use_object_pos' in conf and not 'retina' in conf:
+        return image_batch, action_batch, state_batch, object_pos_batch, max_move_pos_batch
+    elif 'retina' in conf:
+        return image_batch, batch['retina'], action_batch, state_batch, object_pos_batch
+    elif 'touch' in conf:
+        return image_batch, action_batch, state_batch, batch['touchdata']
+    else:
+        return image_batch, action_batch, state_batch
+
+
+def parse_tfrecord_v2(serialized_example, conf, load_indx, codecs=None):
+    """
+    decodes a record written with the compact layout of trajectory_record,
+    returns the sequences in the same form as the per-timestep parsing above
+    :param codecs: image codecs of the dataset, see trajectory_record.record_codecs
+    """
+    seq = parse_trajectory(serialized_example, record_specs(conf, v2=True), load_indx, codecs)
+    seqlen = len(load_indx)
+
+    # the images are stored at the resolution used for training, no resizing is needed
+    image_seq = [tf.cast(seq['image'], tf.float32) / 255.0]
+    state_seq = [seq['state']]
+    action_seq = [seq['action']]
+
+    retina_seq, touch_seq, object_pos_seq, max_move_pos_seq = [], [], [], []
+    if 'retina' in conf:
+        retina_seq = [tf.cast(seq['retina'], tf.float32) / 255.0]
+    if 'touch' in conf:
+        touch_seq = [seq['touchdata']]
+    if 'use_object_pos' in conf:
+        object_pos_seq = tf.split(seq['object_pos'], seqlen, axis=0)
+        max_move_pos_seq = tf.split(seq['max_move_pose'], seqlen, axis=0)
+
+    return image_seq, retina_seq, state_seq, action_seq, touch_seq, object_pos_seq, max_move_pos_seq
+
+
 def resize_im(features, image_name, conf, height = None):
     COLOR_CHAN = 3
     if '128x128' in conf:
@@ -214,7 +358,8 @@ def resize_im(features, image_name, conf, height = None):
     crop_size = min(ORIGINAL_HEIGHT, ORIGINAL_WIDTH)
     image = tf.image.resize_image_with_crop_or_pad(image, crop_size, crop_size)
     image = tf.reshape(image, [1, crop_size, crop_size, COLOR_CHAN])
-    image = tf.image.resize_bicubic(image, [IMG_HEIGHT, IMG_WIDTH])
+    if crop_size != IMG_HEIGHT:
+        image = tf.image.resize_bicubic(image, [IMG_HEIGHT, IMG_WIDTH])
     image = tf.cast(image, tf.float32) / 255.0
 
     return image
@@ -10,6 +10,11 @@ from PIL import Image
 import imp
 
 import cPickle
+from python_visual_mpc.video_prediction.utils_vpred.trajectory_record import FORMAT_VERSION, record_format_version, \
+    record_codecs, parse_trajectory, parse_trajectory_batch
+from python_visual_mpc.video_prediction.utils_vpred.input_pipeline import split_filenames, parse_timesteps_batch, \
+    make_batched_dataset, skip_bad_shards, normalize_state_action
+from python_visual_mpc.video_prediction.utils_vpred.mmap_dataset import build_mmap_input
 
 # Dimension of the state and action.
 STATE_DIM = 3
@@ -28,7 +33,14 @@ def build_tfrecord_input(conf, training=True):
     Raises:
       RuntimeError: if no files found.
     """
-    filenames = gfile.Glob(os.path.join(conf['data_dir'], '*'))
+    if 'normalize_state_action' in conf and ('mmap_cache' in conf or not 'tf_data' in conf):
+        raise ValueError("'normalize_state_action' is only supported with 'tf_data'")
+    if 'mmap_cache' in conf:
+        return batch_outputs(conf, build_mmap_input(conf, training))
+    if 'tf_data' in conf:
+        return build_dataset_input(conf, training)
+
+    filenames = gfile.Glob(os.path.join(conf['data_dir'], '*.tfrecords'))
     if not filenames:
         raise RuntimeError('No data_files files found.')
 
@@ -39,12 +51,15 @@ def build_tfrecord_input(conf, training=True):
         filenames = filenames[index:]
 
     if conf['visualize']:
-        filenames = gfile.Glob(os.path.join(conf['data_dir'], '*'))
+        filenames = gfile.Glob(os.path.join(conf['data_dir'], '*.tfrecords'))
         print 'using input file', filenames
         shuffle = False
     else: shuffle = True
 
 
+    if not filenames:
+        raise RuntimeError('No data_files files found for the {} split with train_val_split {}.'.format(
+            'training' if training else 'validation', conf['train_val_split']))
     filename_queue = tf.train.string_input_producer(filenames, shuffle=shuffle)
     reader = tf.TFRecordReader()
     _, serialized_example = reader.read(filename_queue)
@@ -56,88 +71,95 @@ def build_tfrecord_input(conf, training=True):
     load_indx = load_indx[:conf['sequence_length']]
     print 'using frame sequence: ', load_indx
 
-    for i in load_indx:
-        if 'single_view' not in conf:
-            image_main_name = str(i) + '/image_main/encoded'
-        image_aux1_name = str(i) + '/image_aux1/encoded'
-        action_name = str(i) + '/action'
-        endeffector_pos_name = str(i) + '/endeffector_pos'
-        # state_name = 'move/' +str(i) + '/state'
-
-        if 'canon_ex' in conf:
-            init_pix_pos_name = '/init_pix_pos'
-            init_pix_distrib_name = str(i) +'/init_pix_distrib'
-
-        features = {
+    if record_format_version(filenames[0]) == FORMAT_VERSION:
+        image_main_seq, image_aux1_seq, endeffector_pos_seq, action_seq, init_pix_distrib_seq, init_pix_pos_seq = \
+            parse_tfrecord_v2(serialized_example, conf, load_indx, record_codecs(filenames[0]))
+    else:
+        for i in load_indx:
+            if 'single_view' not in conf:
+                image_main_name = str(i) + '/image_main/encoded'
+            image_aux1_name = str(i) + '/image_aux1/encoded'
+            action_name = str(i) + '/action'
+            endeffector_pos_name = str(i) + '/endeffector_pos'
+            # state_name = 'move/' +str(i) + '/state'
 
-                    image_aux1_name: tf.FixedLenFeature([1], tf.string),
-                    action_name: tf.FixedLenFeature([ACION_DIM], tf.float32),
-                    endeffector_pos_name: tf.FixedLenFeature([STATE_DIM], tf.float32),
-        }
-        if 'single_view' not in conf:
-            (features[image_main_name]) = tf.FixedLenFeature([1], tf.string)
+            if 'canon_ex' in conf:
+                init_pix_pos_name = '/init_pix_pos'
+                init_pix_distrib_name = str(i) +'/init_pix_distrib'
 
-        if 'canon_ex' in conf:
-            (features[init_pix_distrib_name]) = tf.FixedLenFeature([1], tf.string)
-            (features[init_pix_pos_name]) = tf.FixedLenFeature([2], tf.float32)
+            features = {
 
-        features = tf.parse_single_example(serialized_example, features=features)
+                        image_aux1_name: tf.FixedLenFeature([1], tf.string),
+                        action_name: tf.FixedLenFeature([ACION_DIM], tf.float32),
+                        endeffector_pos_name: tf.FixedLenFeature([STATE_DIM], tf.float32),
+            }
+            if 'single_view' not in conf:
+                (features[image_main_name]) = tf.FixedLenFeature([1], tf.string)
 
-        COLOR_CHAN = 3
-        if '128x128' in conf:
-            ORIGINAL_WIDTH = 128
-            ORIGINAL_HEIGHT = 128
-            IMG_WIDTH = 128
-            IMG_HEIGHT = 128
-        else:
-            ORIGINAL_WIDTH = 64
-            ORIGINAL_HEIGHT = 64
-            IMG_WIDTH = 64
-            IMG_HEIGHT = 64
-
-        if 'single_view' not in conf:
-            image = tf.decode_raw(features[image_main_name], tf.uint8)
-            image = tf.reshape(image, shape=[1,ORIGINAL_HEIGHT*ORIGINAL_WIDTH*COLOR_CHAN])
+            if 'canon_ex' in conf:
+                (features[init_pix_distrib_name]) = tf.FixedLenFeature([1], tf.string)
+                (features[init_pix_pos_name]) = tf.FixedLenFeature([2], tf.float32)
+
+            features = tf.parse_single_example(serialized_example, features=features)
+
+            COLOR_CHAN = 3
+            if '128x128' in conf:
+                ORIGINAL_WIDTH = 128
+                ORIGINAL_HEIGHT = 128
+                IMG_WIDTH = 128
+                IMG_HEIGHT = 128
+            else:
+                ORIGINAL_WIDTH = 64
+                ORIGINAL_HEIGHT = 64
+                IMG_WIDTH = 64
+                IMG_HEIGHT = 64
+
+            if 'single_view' not in conf:
+                image = tf.decode_raw(features[image_main_name], tf.uint8)
+                image = tf.reshape(image, shape=[1,ORIGINAL_HEIGHT*ORIGINAL_WIDTH*COLOR_CHAN])
+                image = tf.reshape(image, shape=[ORIGINAL_HEIGHT, ORIGINAL_WIDTH, COLOR_CHAN])
+                if IMG_HEIGHT != IMG_WIDTH:
+                    raise ValueError('Unequal height and width unsupported')
+                crop_size = min(ORIGINAL_HEIGHT, ORIGINAL_WIDTH)
+                image = tf.image.resize_image_with_crop_or_pad(image, crop_size, crop_size)
+                image = tf.reshape(image, [1, crop_size, crop_size, COLOR_CHAN])
+                if crop_size != IMG_HEIGHT:
+                    image = tf.image.resize_bicubic(image, [IMG_HEIGHT, IMG_WIDTH])
+                image = tf.cast(image, tf.float32) / 255.0
+                image_main_seq.append(image)
+
+            image = tf.decode_raw(features[image_aux1_name], tf.uint8)
+            image = tf.reshape(image, shape=[1, ORIGINAL_HEIGHT * ORIGINAL_WIDTH * COLOR_CHAN])
             image = tf.reshape(image, shape=[ORIGINAL_HEIGHT, ORIGINAL_WIDTH, COLOR_CHAN])
             if IMG_HEIGHT != IMG_WIDTH:
                 raise ValueError('Unequal height and width unsupported')
             crop_size = min(ORIGINAL_HEIGHT, ORIGINAL_WIDTH)
             image = tf.image.resize_image_with_crop_or_pad(image, crop_size, crop_size)
             image = tf.reshape(image, [1, crop_size, crop_size, COLOR_CHAN])
-            image = tf.image.resize_bicubic(image, [IMG_HEIGHT, IMG_WIDTH])
+            if crop_size != IMG_HEIGHT:
+                image = tf.image.resize_bicubic(image, [IMG_HEIGHT, IMG_WIDTH])
             image = tf.cast(image, tf.float32) / 255.0
-            image_main_seq.append(image)
-
-        image = tf.decode_raw(features[image_aux1_name], tf.uint8)
-        image = tf.reshape(image, shape=[1, ORIGINAL_HEIGHT * ORIGINAL_WIDTH * COLOR_CHAN])
-        image = tf.reshape(image, shape=[ORIGINAL_HEIGHT, ORIGINAL_WIDTH, COLOR_CHAN])
-        if IMG_HEIGHT != IMG_WIDTH:
-            raise ValueError('Unequal height and width unsupported')
-        crop_size = min(ORIGINAL_HEIGHT, ORIGINAL_WIDTH)
-        image = tf.image.resize_image_with_crop_or_pad(image, crop_size, crop_size)
-        image = tf.reshape(image, [1, crop_size, crop_size, COLOR_CHAN])
-        image = tf.image.resize_bicubic(image, [IMG_HEIGHT, IMG_WIDTH])
-        image = tf.cast(image, tf.float32) / 255.0
-        image_aux1_seq.append(image)
-
-        if 'canon_ex' in conf:
-            init_pix_distrib = tf.decode_raw(features[init_pix_distrib_name], tf.uint8)
-            init_pix_distrib = tf.reshape(init_pix_distrib, shape=[1, ORIGINAL_HEIGHT * ORIGINAL_WIDTH])
-            init_pix_distrib = tf.reshape(init_pix_distrib, shape=[ORIGINAL_HEIGHT, ORIGINAL_WIDTH, 1])
-            crop_size = min(ORIGINAL_HEIGHT, ORIGINAL_WIDTH)
-            init_pix_distrib = tf.image.resize_image_with_crop_or_pad(init_pix_distrib, crop_size, crop_size)
-            init_pix_distrib = tf.reshape(init_pix_distrib, [1, crop_size, crop_size, 1])
-            init_pix_distrib = tf.image.resize_bicubic(init_pix_distrib, [IMG_HEIGHT, IMG_WIDTH])
-            init_pix_distrib = tf.cast(init_pix_distrib, tf.float32) / 255.0
-            init_pix_distrib_seq.append(init_pix_distrib)
+            image_aux1_seq.append(image)
 
-            init_pix_pos = tf.reshape(features[init_pix_pos_name], shape=[1, 2])
-            init_pix_pos_seq.append(init_pix_pos)
-
-        endeffector_pos = tf.reshape(features[endeffector_pos_name], shape=[1, STATE_DIM])
-        endeffector_pos_seq.append(endeffector_pos)
-        action = tf.reshape(features[action_name], shape=[1, ACION_DIM])
-        action_seq.append(action)
+            if 'canon_ex' in conf:
+                init_pix_distrib = tf.decode_raw(features[init_pix_distrib_name], tf.uint8)
+                init_pix_distrib = tf.reshape(init_pix_distrib, shape=[1, ORIGINAL_HEIGHT * ORIGINAL_WIDTH])
+                init_pix_distrib = tf.reshape(init_pix_distrib, shape=[ORIGINAL_HEIGHT, ORIGINAL_WIDTH, 1])
+                crop_size = min(ORIGINAL_HEIGHT, ORIGINAL_WIDTH)
+                init_pix_distrib = tf.image.resize_image_with_crop_or_pad(init_pix_distrib, crop_size, crop_size)
+                init_pix_distrib = tf.reshape(init_pix_distrib, [1, crop_size, crop_size, 1])
+                if crop_size != IMG_HEIGHT:
+                    init_pix_distrib = tf.image.resize_bicubic(init_pix_distrib, [IMG_HEIGHT, IMG_WIDTH])
+                init_pix_distrib = tf.cast(init_pix_distrib, tf.float32) / 255.0
+                init_pix_distrib_seq.append(init_pix_distrib)
+
+                init_pix_pos = tf.reshape(features[init_pix_pos_name], shape=[1, 2])
+                init_pix_pos_seq.append(init_pix_pos)
+
+            endeffector_pos = tf.reshape(features[endeffector_pos_name], shape=[1, STATE_DIM])
+            endeffector_pos_seq.append(endeffector_pos)
+            action = tf.reshape(features[action_name], shape=[1, ACION_DIM])
+            action_seq.append(action)
 
     if 'single_view' not in conf:
         image_main_seq = tf.concat(values=image_main_seq, axis=0)
@@ -189,6 +211,120 @@ def build_tfrecord_input(conf, training=True):
         return image_main_batch, image_aux1_batch, action_batch, endeffector_pos_batch
 
 
+def record_specs(conf, v2):
+    """
+    the modalities used with conf, 'image_main', 'image_aux1' (T x H x W x 3 uint8), 'action', 'endeffector_pos',
+    and for 'canon_ex' 'init_pix_distrib' (T x H x W x 1 uint8) and 'init_pix_pos' (2)
+    :return: specs for trajectory_record.parse_trajectory if v2, else for input_pipeline.parse_timesteps_batch
+    """
+    if '128x128' in conf:
+        img_size = 128
+    else: img_size = 64
+    COLOR_CHAN = 3
+
+    specs = {'image_aux1': ('{}/image_aux1/encoded', tf.uint8, [img_size, img_size, COLOR_CHAN]),
+             'action': ('{}/action', tf.float32, [ACION_DIM]),
+             'endeffector_pos': ('{}/endeffector_pos', tf.float32, [STATE_DIM])}
+    if 'single_view' not in conf:
+        specs['image_main'] = ('{}/image_main/encoded', tf.uint8, [img_size, img_size, COLOR_CHAN])
+    if 'canon_ex' in conf:
+        specs['init_pix_distrib'] = ('{}/init_pix_distrib', tf.uint8, [img_size, img_size, 1])
+        specs['init_pix_pos'] = ('/init_pix_pos', tf.float32, [2])
+
+    if v2:
+        return {name: (dtype, [-1] + shape if '{}' in key else shape)
+                for name, (key, dtype, shape) in specs.items()}
+    return specs
+
+
+def build_dataset_input(conf, training=True):
+    """
+    same outputs as build_tfrecord_input, read with the tf.data pipeline of utils_vpred.input_pipeline.
+    The files are split into training and validation set by a hash of their names.
+    """
+    filenames = gfile.Glob(os.path.join(conf['data_dir'], '*.tfrecords'))
+    if not filenames:
+        raise RuntimeError('No data_files files found.')
+
+    if conf['visualize']:
+        print 'using input file', filenames
+        filenames = sorted(filenames)
+        shuffle = False
+    else:
+        filenames = split_filenames(filenames, conf['train_val_split'], training)
+        shuffle = True
+    if 'skip_bad_shards' in conf:
+        filenames = skip_bad_shards(filenames, conf['data_dir'])
+    if not filenames:
+        raise RuntimeError('No data_files files found.')
+
+    load_indx = range(0, 30, conf['skip_frame'])
+    load_indx = load_indx[:conf['sequence_length']]
+    print 'using frame sequence: ', load_indx
+
+    v2 = record_format_version(filenames[0]) == FORMAT_VERSION
+    specs = record_specs(conf, v2)
+    codecs = record_codecs(filenames[0]) if v2 else None
+
+    def parse_batch(serialized_batch):
+        if v2:
+            batch = parse_trajectory_batch(serialized_batch, specs, load_indx, codecs)
+        else:
+            batch = parse_timesteps_batch(serialized_batch, specs, load_indx)
+        # the images are stored at the resolution used for training, no resizing is needed
+        for name in ['image_main', 'image_aux1', 'init_pix_distrib']:
+            if name in batch:
+                batch[name] = tf.cast(batch[name], tf.float32) / 255.0
+        if 'normalize_state_action' in conf:
+            normalize_state_action(batch, conf, 'endeffector_pos')
+        return batch
+
+    return batch_outputs(conf, make_batched_dataset(filenames, conf, parse_batch, shuffle))
+
+
+def batch_outputs(conf, batch):
+    """
+    :param batch: dict name -> batch x time x ... tensor
+    :return: the tensors in the order returned by build_tfrecord_input
+    """
+    if 'ignore_state_action' in conf:
+        return batch['image_main'], batch['image_aux1'], None, None
+    elif 'canon_ex' in conf:
+        seqlen = int(batch['image_aux1'].get_shape()[1])
+        init_pix_pos = tf.tile(tf.expand_dims(batch['init_pix_pos'], 1), [1, seqlen, 1])
+        return batch['image_aux1'], batch['action'], batch['endeffector_pos'], batch['init_pix_distrib'], init_pix_pos
+    elif 'single_view' in conf:
+        return batch['image_aux1'], batch['action'], batch['endeffector_pos']
+    else:
+        return batch['image_main'], batch['image_aux1'], batch['action'], batch['endeffector_pos']
+
+
+def parse_tfrecord_v2(serialized_example, conf, load_indx, codecs=None):
+    """
+    decodes a record written with the compact layout of trajectory_record, see record_specs.
+    The images may be compressed with any of the codecs of trajectory_record
+    :return: the sequences in the same form as the per-timestep parsing
+    """
+    decoded = parse_trajectory(serialized_example, record_specs(conf, v2=True), load_indx, codecs)
+
+    def images(name):
+        # stored at the training resolution, no resizing is needed
+        return [tf.cast(decoded[name], tf.float32) / 255.0]
+
+    image_main_seq, init_pix_distrib_seq, init_pix_pos_seq = [], [], []
+    if 'single_view' not in conf:
+        image_main_seq = images('image_main')
+    image_aux1_seq = images('image_aux1')
+    endeffector_pos_seq = [decoded['endeffector_pos']]
+    action_seq = [decoded['action']]
+
+    if 'canon_ex' in conf:
+        init_pix_distrib_seq = images('init_pix_distrib')
+        init_pix_pos_seq = [tf.tile(tf.reshape(decoded['init_pix_pos'], [1, 2]), [len(load_indx), 1])]
+
+    return image_main_seq, image_aux1_seq, endeffector_pos_seq, action_seq, init_pix_distrib_seq, init_pix_pos_seq
+
+
 ##### code below is used for debugging
 
 def add_visuals_to_batch(image_data, action_data, state_data, action_pos = False):
@@ -2,8 +2,12 @@ import tensorflow as tf
 import imp
 import numpy as np
 from python_visual_mpc.video_prediction.prediction_train_sawyer import Model
+from python_visual_mpc.video_prediction.utils_vpred.score_graph import ScoreGraph
+from python_visual_mpc.video_prediction.utils_vpred.context_inputs import ContextPlaceholders
+from python_visual_mpc.video_prediction.utils_vpred.dataset_stats import StateActionNormalizer
 from PIL import Image
 import os
+import threading
 
 import pdb
 
@@ -34,9 +38,6 @@ def setup_predictor(conf, gpu_id = 0, ngpu=None):
                 print key, ': ', conf[key]
             print '-------------------------------------------------------------------'
 
-            images_pl = tf.placeholder(tf.float32, name='images',
-                                    shape=(conf['batch_size'], conf['sequence_length'], 64, 64, 3))
-
             if 'sawyer' in conf:
                 adim = 4
                 sdim = 3
@@ -47,18 +48,29 @@ def setup_predictor(conf, gpu_id = 0, ngpu=None):
 
             actions_pl = tf.placeholder(tf.float32, name= 'actions',
                                      shape=(conf['batch_size'], conf['sequence_length'], adim))
-            states_pl = tf.placeholder(tf.float32, name='states',
-                                         shape=(conf['batch_size'],conf['context_frames'] , sdim))
+            # the context is the same for all samples, it is broadcast inside the graph
+            context = ContextPlaceholders(conf, sdim)
+            images, states, pix_distrib, _ = context.broadcast(conf['batch_size'])
 
             if 'no_pix_distrib' in conf:
                 pix_distrib = None
-            else:
-                pix_distrib = tf.placeholder(tf.float32, shape=(conf['batch_size'], conf['context_frames'], 64, 64, 1))
 
             print 'Constructing model for control'
             with tf.variable_scope('model', reuse=None) as training_scope:
-                model = Model(conf, images_pl, actions_pl, states_pl,reuse_scope= None, pix_distrib= pix_distrib)
+                model = Model(conf, images, actions_pl, states,reuse_scope= None, pix_distrib= pix_distrib)
+
+
+            if 'score_in_graph' in conf:
+                score_graph = ScoreGraph(conf, model.m.gen_images, model.m.gen_distrib1)
 
+            if 'normalize_state_action' in conf:
+                # the model was trained on standardized actions and states
+                normalizer = StateActionNormalizer(conf)
+
+            if 'cache_context' in conf:
+                context_cache = []
+                # the cache is shared by all callers, e.g. the planning thread of the visual MPC server
+                context_lock = threading.Lock()
 
             sess.run(tf.global_variables_initializer())
 
@@ -68,22 +80,45 @@ def setup_predictor(conf, gpu_id = 0, ngpu=None):
 
 
             def predictor_func(input_images=None, input_one_hot_images1=None,
-                               input_state=None, input_actions=None):
+                               input_state=None, input_actions=None,
+                               distance_grids=None, tstep_weights=None, encode_context=True):
                 """
-                :param one_hot_images: the first two frames
-                :return: the predicted pixcoord at the end of sequence
+                :param input_images: uint8 context frames, context_frames x 64 x 64 x 3, shared by all samples
+                :param input_one_hot_images1: designated pixel distributions of the context steps
+                :param input_state: states of the context steps, context_frames x sdim
+                :param distance_grids: 1 x 64 x 64, only used with 'score_in_graph'
+                :param tstep_weights: weights of the expected distance per timestep, only used with 'score_in_graph'
+                :param encode_context: with 'cache_context', encode the context frames anew instead of reusing the
+                encoding of the previous call, needs to be set whenever the context frames change. The cache holds
+                the context of the last call with encode_context, so callers with different contexts must always set it
+                :return: the predicted pixcoord at the end of sequence, with 'score_in_graph' the scores, the indices
+                of the best samples and their predicted images and distributions
                 """
 
                 itr = 0
 
+                if 'normalize_state_action' in conf:
+                    input_state = normalizer.states(input_state)
+                    input_actions = normalizer.actions(input_actions)
+
                 feed_dict = {
                              model.iter_num: np.float32(itr),
                              model.lr: conf['learning_rate'],
-                             images_pl: input_images,
+                             context.images: input_images,
                              actions_pl: input_actions,
-                             states_pl: input_state,
-                             pix_distrib: input_one_hot_images1
+                             context.states: input_state,
                              }
+                if not 'no_pix_distrib' in conf:
+                    feed_dict[context.pix_distrib1] = input_one_hot_images1
+
+                if 'cache_context' in conf:
+                    with context_lock:
+                        if encode_context or not context_cache:
+                            context_cache[:] = sess.run(model.m.context_enc, {context.images: input_images})
+                        feed_dict.update(zip(model.m.context_enc, context_cache))
+
+                if 'score_in_graph' in conf:
+                    return score_graph.run(sess, feed_dict, distance_grids, tstep_weights)
 
 
                 gen_distrib, gen_images, gen_masks, gen_states = sess.run([model.m.gen_distrib1,
@@ -92,6 +127,8 @@ def setup_predictor(conf, gpu_id = 0, ngpu=None):
                                                                            model.m.gen_states
                                                                            ],
                                                                           feed_dict)
+                if 'normalize_state_action' in conf:
+                    gen_states = [normalizer.denormalize_states(s) for s in gen_states]
                 return gen_images, gen_distrib, None, gen_states, gen_masks
 
 
@@ -5,21 +5,24 @@ import pdb
 
 from PIL import Image
 import os
+import threading
 
 from datetime import datetime
+from python_visual_mpc.video_prediction.utils_vpred.score_graph import ScoreGraph
+from python_visual_mpc.video_prediction.utils_vpred.context_inputs import ContextPlaceholders, \
+    BatchedContextPlaceholders
+from python_visual_mpc.video_prediction.utils_vpred.dataset_stats import StateActionNormalizer
 
 class Tower(object):
-    def __init__(self, conf, gpu_id, start_images, actions, start_states, pix_distrib1,pix_distrib2):
+    def __init__(self, conf, gpu_id, context, actions):
         nsmp_per_gpu = conf['batch_size']/ conf['ngpu']
 
         # picking different subset of the actions for each gpu
         startidx = gpu_id * nsmp_per_gpu
         actions = tf.slice(actions, [startidx, 0, 0], [nsmp_per_gpu, -1, -1])
-        start_images = tf.slice(start_images, [startidx, 0, 0, 0, 0], [nsmp_per_gpu, -1, -1, -1, -1])
-        start_states = tf.slice(start_states, [startidx, 0, 0], [nsmp_per_gpu, -1, -1])
 
-        pix_distrib1 = tf.slice(pix_distrib1, [startidx, 0, 0, 0, 0], [nsmp_per_gpu, -1, -1, -1, -1])
-        pix_distrib2 = tf.slice(pix_distrib2, [startidx, 0, 0, 0, 0], [nsmp_per_gpu, -1, -1, -1, -1])
+        # the context is the same for all samples, it is broadcast on the gpu
+        start_images, start_states, pix_distrib1, pix_distrib2 = context.broadcast(nsmp_per_gpu, startidx)
 
         print 'startindex for gpu {0}: {1}'.format(gpu_id, startidx)
 
@@ -41,6 +44,8 @@ def setup_predictor(conf, gpu_id=0, ngpu=1):
     :param ngpu number of gpus to use
     :return: function which predicts a batch of whole trajectories
     conditioned on the actions
+    with conf['batched_contexts'] = n the samples of one batch can use up to n different contexts,
+    as used by predictor_server.py
     """
 
     from prediction_train_sawyer import Model
@@ -70,21 +75,16 @@ def setup_predictor(conf, gpu_id=0, ngpu=1):
 
     print 'Constructing multi gpu model for control...'
 
-    start_images = tf.placeholder(tf.float32, name='images',  # with zeros extension
-                                    shape=(conf['batch_size'], conf['sequence_length'], 64, 64, 3))
-
     if 'sawyer' in conf:
-        actions = tf.placeholder(tf.float32, name='actions',
-                                        shape=(conf['batch_size'],conf['sequence_length'], 4))
-        start_states = tf.placeholder(tf.float32, name='states',
-                                        shape=(conf['batch_size'],conf['context_frames'], 3))
+        adim, sdim = 4, 3
+    else: adim, sdim = 2, 4
+    actions = tf.placeholder(tf.float32, name='actions', shape=(conf['batch_size'], conf['sequence_length'], adim))
+    if 'batched_contexts' in conf:
+        if 'score_in_graph' in conf or 'cache_context' in conf:
+            raise ValueError('batched_contexts can not be combined with score_in_graph or cache_context')
+        context = BatchedContextPlaceholders(conf, sdim, conf['batched_contexts'])
     else:
-        actions = tf.placeholder(tf.float32, name='actions',
-                                 shape=(conf['batch_size'], conf['sequence_length'], 2))
-        start_states = tf.placeholder(tf.float32, name='states',
-                                      shape=(conf['batch_size'], conf['context_frames'], 4))
-    pix_distrib_1 = tf.placeholder(tf.float32, shape=(conf['batch_size'], conf['context_frames'], 64, 64, 1))
-    pix_distrib_2 = tf.placeholder(tf.float32, shape=(conf['batch_size'], conf['context_frames'], 64, 64, 1))
+        context = ContextPlaceholders(conf, sdim)
 
     # making the towers
     towers = []
@@ -97,8 +97,7 @@ def setup_predictor(conf, gpu_id=0, ngpu=1):
 
 
                     # towers.append(Tower(conf, i_gpu, training_scope, start_images, actions, start_states, pix_distrib_1, pix_distrib_2))
-                    towers.append(Tower(conf, i_gpu, start_images, actions, start_states, pix_distrib_1,
-                                        pix_distrib_2))
+                    towers.append(Tower(conf, i_gpu, context, actions))
                     tf.get_variable_scope().reuse_variables()
 
     sess.run(tf.global_variables_initializer())
@@ -131,24 +130,78 @@ def setup_predictor(conf, gpu_id=0, ngpu=1):
         t_comb_gen_states = [to.model.m.gen_states[t] for to in towers]
         comb_gen_states.append(tf.concat(axis=0, values=t_comb_gen_states))
 
+    if 'score_in_graph' in conf:
+        if 'ndesig' in conf:
+            score_graph = ScoreGraph(conf, comb_gen_img, comb_pix_distrib1, comb_pix_distrib2)
+        else:
+            score_graph = ScoreGraph(conf, comb_gen_img, comb_pix_distrib1)
+
+    if 'cache_context' in conf:
+        # the batch-1 context encodings of all towers, fed back in for all CEM iterations of one MPC step
+        context_enc = [enc for to in towers for enc in to.model.m.context_enc]
+        context_cache = []
+        # the cache is shared by all callers, e.g. the planning thread of the visual MPC server
+        context_lock = threading.Lock()
+
+    if 'normalize_state_action' in conf:
+        # the model was trained on standardized actions and states
+        normalizer = StateActionNormalizer(conf)
 
-    def predictor_func(input_images=None, input_one_hot_images1=None, input_one_hot_images2=None, input_state=None, input_actions=None):
+    def predictor_func(input_images=None, input_one_hot_images1=None, input_one_hot_images2=None, input_state=None, input_actions=None,
+                       distance_grids=None, tstep_weights=None, encode_context=True, context_index=None):
         """
-        :param one_hot_images: the first two frames
+        :param input_images: uint8 context frames, context_frames x 64 x 64 x 3, shared by all samples
+        :param input_state: states of the context steps, context_frames x sdim
+        :param input_one_hot_images1: designated pixel distributions of the context steps, context_frames x 64 x 64 x 1
+        :param input_actions: batch_size x sequence_length x adim
         :param pixcoord: the coords of the disgnated pixel in images coord system
-        :return: the predicted pixcoord at the end of sequence
+        :param distance_grids: ndesig x 64 x 64, only used with 'score_in_graph'
+        :param tstep_weights: weights of the expected distance per timestep, only used with 'score_in_graph'
+        :param encode_context: with 'cache_context', encode the context frames anew instead of reusing the
+        encoding of the previous call, needs to be set whenever the context frames change. The cache holds the
+        context of the last call with encode_context, so callers with different contexts must always set it
+        :param context_index: with 'batched_contexts', the context of every sample, the context inputs then have
+        a leading dimension of size batched_contexts
+        :return: the predicted pixcoord at the end of sequence, with 'score_in_graph' the scores, the indices of the
+        best samples and their predicted images and distributions
         """
 
         t_startiter = datetime.now()
 
+        if 'normalize_state_action' in conf:
+            input_state = normalizer.states(input_state)
+            input_actions = normalizer.actions(input_actions)
+
         feed_dict = {}
         for t in towers:
             feed_dict[t.model.iter_num] = 0
             feed_dict[t.model.lr] = 0.0
 
-        feed_dict[start_images] = input_images
-        feed_dict[start_states] = input_state
+        feed_dict[context.images] = input_images
+        feed_dict[context.states] = input_state
         feed_dict[actions] = input_actions
+        if context_index is not None:
+            feed_dict[context.sample_context] = context_index
+
+        if 'cache_context' in conf:
+            with context_lock:
+                if encode_context or not context_cache:
+                    context_cache[:] = sess.run(context_enc, {context.images: input_images})
+                feed_dict.update(zip(context_enc, context_cache))
+
+        if 'score_in_graph' in conf:
+            feed_dict[context.pix_distrib1] = input_one_hot_images1
+            if 'ndesig' in conf:
+                feed_dict[context.pix_distrib2] = input_one_hot_images2
+            scores, bestindices, best_gen_images, best_gen_distrib1, best_gen_distrib2 = score_graph.run(sess, feed_dict,
+                                                                                                        distance_grids,
+                                                                                                        tstep_weights)
+            print 'time for evaluating {0} actions on {1} gpus : {2}'.format(
+                conf['batch_size'],
+                conf['ngpu'],
+                (datetime.now() - t_startiter).seconds + (datetime.now() - t_startiter).microseconds/1e6)
+
+            return scores, bestindices, best_gen_images, best_gen_distrib1, best_gen_distrib2
 
         if 'no_pix_distrib' in conf:
             gen_images, gen_states = sess.run([comb_gen_img,
@@ -158,10 +211,10 @@ def setup_predictor(conf, gpu_id=0, ngpu=1):
             gen_distrib1 = None
             gen_distrib2 = None
         else:
-            feed_dict[pix_distrib_1] = input_one_hot_images1
+            feed_dict[context.pix_distrib1] = input_one_hot_images1
             if 'ndesig' in conf:
                 print 'evaluating 2 pixdistrib..'
-                feed_dict[pix_distrib_2] = input_one_hot_images2
+                feed_dict[context.pix_distrib2] = input_one_hot_images2
 
                 gen_images, gen_distrib1, gen_distrib2, gen_states = sess.run([comb_gen_img,
                                                                 comb_pix_distrib1,
@@ -180,6 +233,8 @@ def setup_predictor(conf, gpu_id=0, ngpu=1):
             conf['ngpu'],
             (datetime.now() - t_startiter).seconds + (datetime.now() - t_startiter).microseconds/1e6)
 
+        if 'normalize_state_action' in conf:
+            gen_states = [normalizer.denormalize_states(s) for s in gen_states]
         return gen_images, gen_distrib1, gen_distrib2, gen_states, None
 
     return predictor_func
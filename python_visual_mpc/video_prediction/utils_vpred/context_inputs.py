@@ -0,0 +1,81 @@
+import tensorflow as tf
+
+
+def broadcast_batch(tensor, batch_size):
+    """
+    tiles an unbatched tensor along a new leading batch dimension
+    """
+    tensor = tf.expand_dims(tensor, 0)
+    return tf.tile(tensor, [batch_size] + [1] * (len(tensor.get_shape()) - 1))
+
+
+def broadcast_images(context_images, batch_size, sequence_length):
+    """
+    converts the uint8 context frames to float and broadcasts them to the batch,
+    the frames after the context are zero, they are never fed to the network during control
+    :param context_images: uint8 tensor context_frames x 64 x 64 x C
+    :return: float tensor batch_size x sequence_length x 64 x 64 x C
+    """
+    context_frames = int(context_images.get_shape()[0])
+    images = broadcast_batch(tf.cast(context_images, tf.float32) / 255., batch_size)
+    future_shape = [batch_size, sequence_length - context_frames] + [int(d) for d in context_images.get_shape()[1:]]
+    return tf.concat(axis=1, values=[images, tf.zeros(future_shape)])
+
+
+class ContextPlaceholders(object):
+    """
+    placeholders for a single unbatched context, which is shared by all samples of a batch:
+    uint8 context frames, the states of the context steps and the designated pixel distributions
+    """
+    def __init__(self, conf, sdim, img_channels=3, distrib_channels=1):
+        self.images = tf.placeholder(tf.uint8, name='context_images',
+                                     shape=(conf['context_frames'], 64, 64, img_channels))
+        self.states = tf.placeholder(tf.float32, name='context_states',
+                                     shape=(conf['context_frames'], sdim))
+        self.pix_distrib1 = tf.placeholder(tf.float32, name='context_pix_distrib1',
+                                           shape=(conf['context_frames'], 64, 64, distrib_channels))
+        self.pix_distrib2 = tf.placeholder(tf.float32, name='context_pix_distrib2',
+                                           shape=(conf['context_frames'], 64, 64, distrib_channels))
+        self.sequence_length = conf['sequence_length']
+
+    def broadcast(self, batch_size, start=0):
+        """
+        :param start: index of the first sample, only used by BatchedContextPlaceholders
+        :return: images, states, pix_distrib1, pix_distrib2 broadcast to batch_size
+        """
+        return (broadcast_images(self.images, batch_size, self.sequence_length),
+                broadcast_batch(self.states, batch_size),
+                broadcast_batch(self.pix_distrib1, batch_size),
+                broadcast_batch(self.pix_distrib2, batch_size))
+
+
+class BatchedContextPlaceholders(object):
+    """
+    placeholders for up to ncontexts contexts, e.g. of different controllers, every sample of the batch
+    selects its context with sample_context
+    """
+    def __init__(self, conf, sdim, ncontexts, img_channels=3, distrib_channels=1):
+        self.images = tf.placeholder(tf.uint8, name='context_images',
+                                     shape=(ncontexts, conf['context_frames'], 64, 64, img_channels))
+        self.states = tf.placeholder(tf.float32, name='context_states',
+                                     shape=(ncontexts, conf['context_frames'], sdim))
+        self.pix_distrib1 = tf.placeholder(tf.float32, name='context_pix_distrib1',
+                                           shape=(ncontexts, conf['context_frames'], 64, 64, distrib_channels))
+        self.pix_distrib2 = tf.placeholder(tf.float32, name='context_pix_distrib2',
+                                           shape=(ncontexts, conf['context_frames'], 64, 64, distrib_channels))
+        self.sample_context = tf.placeholder(tf.int32, name='sample_context', shape=(conf['batch_size'],))
+        self.sequence_length = conf['sequence_length']
+
+    def broadcast(self, batch_size, start=0):
+        """
+        :return: images, states, pix_distrib1, pix_distrib2 of the samples start to start + batch_size
+        """
+        index = tf.slice(self.sample_context, [start], [batch_size])
+        images = tf.cast(tf.gather(self.images, index), tf.float32) / 255.
+        future_shape = [batch_size, self.sequence_length - int(self.images.get_shape()[1])] + \
+                       [int(d) for d in self.images.get_shape()[2:]]
+        images = tf.concat(axis=1, values=[images, tf.zeros(future_shape)])
+        return (images,
+                tf.gather(self.states, index),
+                tf.gather(self.pix_distrib1, index),
+                tf.gather(self.pix_distrib2, index))
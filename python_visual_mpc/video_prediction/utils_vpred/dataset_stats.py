@@ -0,0 +1,233 @@
+"""
+Statistics and validation of a tfrecords dataset, the shards are scanned in parallel processes.
+
+For every shard and for the whole directory this computes the mean and std of actions and states,
+histograms of the object displacement and of the image brightness, and counts NaNs, all-zero
+frames and trajectories without object displacement. The summary is written to
+dataset_stats.pkl in the data directory, the training input pipeline can use it with
+'normalize_state_action' and 'skip_bad_shards'. A model trained with 'normalize_state_action' gets the
+same standardization in the predictors used for control, the statistics are read from conf['dataset_stats']
+if set, e.g. a copy stored next to the model, otherwise from conf['data_dir'].
+
+usage: python dataset_stats.py pushing_data/<name> [--nworkers 16] [--displacement_threshold 0.1]
+"""
+import argparse
+import cPickle
+import glob
+import os
+import time
+from multiprocessing import Pool, cpu_count
+import numpy as np
+
+from python_visual_mpc.video_prediction.utils_vpred.numpy_tfrecord import read_trajectories
+
+STATS_FILE = 'dataset_stats.pkl'
+DISPLACEMENT_BINS = np.linspace(0., 0.5, 51)
+BRIGHTNESS_BINS = np.linspace(0., 255., 52)
+
+
+class RunningMoments(object):
+    """
+    sums for the per-dimension mean and std, can be merged across shards
+    """
+    def __init__(self):
+        self.n, self.sum, self.sumsq = 0, 0., 0.
+
+    def add(self, x):
+        x = np.asarray(x, dtype=np.float64).reshape(-1, x.shape[-1])
+        x = x[np.all(np.isfinite(x), axis=1)]
+        self.n += x.shape[0]
+        self.sum = self.sum + x.sum(axis=0)
+        self.sumsq = self.sumsq + (x**2).sum(axis=0)
+
+    def merge(self, other):
+        self.n += other.n
+        self.sum = self.sum + other.sum
+        self.sumsq = self.sumsq + other.sumsq
+
+    def mean(self):
+        return self.sum / max(self.n, 1)
+
+    def std(self):
+        return np.sqrt(np.maximum(self.sumsq / max(self.n, 1) - self.mean()**2, 0.))
+
+
+def object_displacement(object_pos):
+    """
+    summed xy displacement of all objects between the first and the last step, as used for
+    'displacement_threshold' during data collection
+    :param object_pos: T x num_obj*3
+    """
+    pos = object_pos.reshape(object_pos.shape[0], -1, 3)[:, :, :2]
+    return np.sum(np.linalg.norm(pos[-1] - pos[0], axis=1))
+
+
+def new_stats():
+    return {'ntraj': 0,
+            'action': RunningMoments(),
+            'state': RunningMoments(),
+            'displacement_hist': np.zeros(len(DISPLACEMENT_BINS) + 1, dtype=np.int64),
+            'brightness_hist': np.zeros(len(BRIGHTNESS_BINS) + 1, dtype=np.int64),
+            'nan_values': 0,
+            'zero_frames': 0,
+            'static_traj': 0}
+
+
+def merge_stats(total, stats):
+    total['ntraj'] += stats['ntraj']
+    total['action'].merge(stats['action'])
+    total['state'].merge(stats['state'])
+    for key in ['displacement_hist', 'brightness_hist', 'nan_values', 'zero_frames', 'static_traj']:
+        total[key] += stats[key]
+
+
+def scan_shard(args):
+    """
+    :return: file name and statistics of one shard
+    """
+    filename, displacement_threshold = args
+    stats = new_stats()
+    for traj in read_trajectories(filename):
+        stats['ntraj'] += 1
+        for name, value in traj.items():
+            if value.dtype == np.uint8 and value.ndim == 4:
+                # frames are T x H x W x C
+                frames = value.reshape(value.shape[0], -1)
+                stats['zero_frames'] += int(np.sum(~np.any(frames, axis=1)))
+                brightness = frames.mean(axis=1)
+                stats['brightness_hist'] += np.bincount(np.digitize(brightness, BRIGHTNESS_BINS),
+                                                        minlength=len(BRIGHTNESS_BINS) + 1)
+            elif value.dtype == np.float32:
+                stats['nan_values'] += int(np.sum(~np.isfinite(value)))
+
+        stats['action'].add(traj['action'])
+        if 'state' in traj:
+            stats['state'].add(traj['state'])
+        elif 'endeffector_pos' in traj:
+            stats['state'].add(traj['endeffector_pos'])
+
+        if 'object_pos' in traj:
+            disp = object_displacement(traj['object_pos'])
+            stats['displacement_hist'][np.digitize([disp], DISPLACEMENT_BINS)[0]] += 1
+            if displacement_threshold is not None and disp <= displacement_threshold:
+                stats['static_traj'] += 1
+    return filename, stats
+
+
+def is_bad_shard(stats):
+    return stats['nan_values'] > 0 or stats['zero_frames'] > 0
+
+
+def summarize(stats):
+    """
+    :return: plain dict of numpy arrays and numbers, independent of this module
+    """
+    return {'ntraj': stats['ntraj'],
+            'action_mean': stats['action'].mean(), 'action_std': stats['action'].std(),
+            'state_mean': stats['state'].mean(), 'state_std': stats['state'].std(),
+            'displacement_hist': stats['displacement_hist'], 'displacement_bins': DISPLACEMENT_BINS,
+            'brightness_hist': stats['brightness_hist'], 'brightness_bins': BRIGHTNESS_BINS,
+            'nan_values': stats['nan_values'], 'zero_frames': stats['zero_frames'],
+            'static_traj': stats['static_traj']}
+
+
+def scan_directory(data_dir, nworkers=None, displacement_threshold=None):
+    """
+    scans all shards of data_dir and writes data_dir/dataset_stats.pkl
+    :return: the summary
+    """
+    filenames = sorted(glob.glob(os.path.join(data_dir, '*.tfrecords')))
+    if not filenames:
+        raise RuntimeError('No data_files files found.')
+    if nworkers is None:
+        nworkers = cpu_count()
+
+    t_start = time.time()
+    total, shards = new_stats(), {}
+    pool = Pool(nworkers)
+    for i, (filename, stats) in enumerate(pool.imap_unordered(
+            scan_shard, [(f, displacement_threshold) for f in filenames])):
+        merge_stats(total, stats)
+        shards[os.path.basename(filename)] = summarize(stats)
+        if (i + 1) % 50 == 0:
+            print 'scanned {} of {} shards, {:.0f} s'.format(i + 1, len(filenames), time.time() - t_start)
+    pool.close()
+    pool.join()
+
+    summary = summarize(total)
+    summary['shards'] = shards
+    summary['bad_shards'] = sorted(name for name, stats in shards.items() if is_bad_shard(stats))
+    summary['displacement_threshold'] = displacement_threshold
+    with open(os.path.join(data_dir, STATS_FILE), 'wb') as f:
+        cPickle.dump(summary, f)
+
+    print '{}: {} trajectories in {} shards, {:.0f} s'.format(data_dir, summary['ntraj'], len(filenames),
+                                                             time.time() - t_start)
+    print 'action mean {} std {}'.format(summary['action_mean'], summary['action_std'])
+    print 'state mean {} std {}'.format(summary['state_mean'], summary['state_std'])
+    print 'NaN values {}, all-zero frames {}, trajectories without displacement {}'.format(
+        summary['nan_values'], summary['zero_frames'], summary['static_traj'])
+    if summary['bad_shards']:
+        print 'bad shards:', summary['bad_shards']
+    return summary
+
+
+def load_stats(data_dir):
+    """
+    :return: the summary written by scan_directory
+    """
+    filename = os.path.join(data_dir, STATS_FILE)
+    if not os.path.exists(filename):
+        raise IOError('no dataset statistics in {}, run dataset_stats.py first'.format(data_dir))
+    with open(filename, 'rb') as f:
+        return cPickle.load(f)
+
+
+class StateActionNormalizer(object):
+    """
+    standardizes actions and states with the statistics of the training set, dimensions without variance are
+    only centered. Works on numpy arrays and on tensors, the last dimension is the action or state dimension.
+    """
+    def __init__(self, conf):
+        if 'dataset_stats' in conf:
+            with open(conf['dataset_stats'], 'rb') as f:
+                stats = cPickle.load(f)
+        else:
+            stats = load_stats(conf['data_dir'])
+        self.action_mean, self.action_std = self._moments(stats, 'action')
+        self.state_mean, self.state_std = self._moments(stats, 'state')
+
+    def _moments(self, stats, key):
+        std = np.where(stats[key + '_std'] > 1e-6, stats[key + '_std'], 1.)
+        return stats[key + '_mean'].astype(np.float32), std.astype(np.float32)
+
+    def actions(self, actions):
+        return (actions - self.action_mean) / self.action_std
+
+    def states(self, states):
+        return (states - self.state_mean) / self.state_std
+
+    def denormalize_states(self, states):
+        return states * self.state_std + self.state_mean
+
+
+def main():
+    parser = argparse.ArgumentParser(description='compute statistics and find bad shards of a dataset')
+    parser.add_argument('data_dir', type=str, help='directory with tfrecords, or e.g. pushing_data/<name> '
+                                                   'to scan all its subdirectories such as train and test')
+    parser.add_argument('--nworkers', type=int, default=cpu_count(), help='number of processes')
+    parser.add_argument('--displacement_threshold', type=float, default=None,
+                        help='count trajectories with at most this summed object displacement')
+    args = parser.parse_args()
+
+    if glob.glob(os.path.join(args.data_dir, '*.tfrecords')):
+        data_dirs = [args.data_dir]
+    else:
+        data_dirs = sorted(d for d in glob.glob(os.path.join(args.data_dir, '*'))
+                           if glob.glob(os.path.join(d, '*.tfrecords')))
+    for data_dir in data_dirs:
+        scan_directory(data_dir, args.nworkers, args.displacement_threshold)
+
+
+if __name__ == '__main__':
+    main()
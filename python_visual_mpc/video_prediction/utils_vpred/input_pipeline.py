@@ -0,0 +1,157 @@
+"""
+tf.data input pipeline for the video prediction training, enabled with 'tf_data' in the conf, requires tensorflow 1.8.
+Files are read in parallel with interleaving, examples are parsed a whole batch at a time and
+batches are prefetched, optionally onto the GPU.
+
+Additional conf options:
+    'seed'               : seed of the file and example shuffling, default 0
+    'shuffle_buffer'     : number of examples in the shuffle buffer, default 4 * batch_size
+    'interleave_files'   : number of files read in parallel, default 8
+    'parse_threads'      : number of batches parsed in parallel, default 4
+    'prefetch_batches'   : number of batches prefetched, default 4
+    'prefetch_to_device' : e.g. '/gpu:0', copy the prefetched batches to this device
+    'uniform_trajectories' : sample trajectories uniformly through the tfrecord_index instead of
+                             streaming whole shards
+    'traj_ids'           : list of trajectory ids which are read in this order, e.g. for visualization
+    'skip_bad_shards'    : leave out the shards with NaNs or all-zero frames found by dataset_stats.py
+    'normalize_state_action' : standardize actions and states with the mean and std from dataset_stats.py,
+                               only supported by this pipeline
+"""
+import os
+import zlib
+import numpy as np
+import tensorflow as tf
+
+from python_visual_mpc.video_prediction.utils_vpred.tfrecord_index import TFRecordIndex
+from python_visual_mpc.video_prediction.utils_vpred.dataset_stats import load_stats, StateActionNormalizer
+
+# the iterator initializers, these have to be run after the session is created
+INPUT_INITIALIZERS = 'input_pipeline_initializers'
+
+
+def split_filenames(filenames, train_val_split, training):
+    """
+    assigns every file to the training or the validation set by a hash of its name, so that the
+    split does not depend on the order of the glob and does not change when files are added
+    """
+    def bucket(filename):
+        return (zlib.crc32(filename.split('/')[-1]) & 0xffffffff) % 1000
+    train = [f for f in filenames if bucket(f) < train_val_split * 1000]
+    if training:
+        split = sorted(train)
+    else: split = sorted(set(filenames) - set(train))
+    if not split:
+        raise RuntimeError('No data_files files found for the {} split of {} files with train_val_split {}.'.format(
+            'training' if training else 'validation', len(filenames), train_val_split))
+    return split
+
+
+def skip_bad_shards(filenames, data_dir):
+    bad_shards = set(load_stats(data_dir)['bad_shards'])
+    kept = [f for f in filenames if os.path.basename(f) not in bad_shards]
+    print 'skipping {} bad shards'.format(len(filenames) - len(kept))
+    return kept
+
+
+def normalize_state_action(batch, conf, state_name='state'):
+    """
+    standardizes batch['action'] and batch[state_name] in place
+    """
+    normalizer = StateActionNormalizer(conf)
+    batch['action'] = normalizer.actions(batch['action'])
+    batch[state_name] = normalizer.states(batch[state_name])
+
+
+def parse_timesteps_batch(serialized_batch, specs, load_indx):
+    """
+    batched parsing of the original layout with one feature per timestep
+    :param specs: dict name -> (key, dtype, shape), key contains '{}' for per-timestep features,
+    uint8 features are raw image strings, float32 features are float lists
+    :return: dict name -> tensor, batch x time x shape for per-timestep features
+    """
+    features = {}
+    for name, (key, dtype, shape) in specs.items():
+        keys = [key.format(i) for i in load_indx] if '{}' in key else [key]
+        for k in keys:
+            if dtype == tf.uint8:
+                features[k] = tf.FixedLenFeature([], tf.string)
+            else:
+                features[k] = tf.FixedLenFeature([int(np.prod(shape))], dtype)
+    features = tf.parse_example(serialized_batch, features=features)
+
+    def decode(k, dtype, shape):
+        if dtype == tf.uint8:
+            return tf.reshape(tf.decode_raw(features[k], tf.uint8), [-1] + shape)
+        return tf.reshape(features[k], [-1] + shape)
+
+    parsed = {}
+    for name, (key, dtype, shape) in specs.items():
+        if '{}' in key:
+            parsed[name] = tf.stack([decode(key.format(i), dtype, shape) for i in load_indx], axis=1)
+        else:
+            parsed[name] = decode(key, dtype, shape)
+    return parsed
+
+
+def indexed_records(filenames, conf, seed):
+    """
+    dataset of serialized records read by random access, either the trajectories conf['traj_ids']
+    in a loop or trajectories drawn uniformly from the given files
+    """
+    index = TFRecordIndex(os.path.dirname(filenames[0]))
+
+    def generator():
+        if 'traj_ids' in conf:
+            while True:
+                for record in index.read_many(conf['traj_ids']):
+                    yield record
+        else:
+            ids = index.subset(filenames)
+            rng = np.random.RandomState(seed)
+            while True:
+                yield index.read(ids[rng.randint(len(ids))])
+
+    return tf.data.Dataset.from_generator(generator, tf.string, tf.TensorShape([]))
+
+
+def make_batched_dataset(filenames, conf, parse_batch, shuffle):
+    """
+    :param parse_batch: function mapping a vector of serialized examples to a dict of batched tensors
+    :return: dict of tensors with a static batch size of conf['batch_size']
+    """
+    if not filenames:
+        raise RuntimeError('No data_files files found.')
+    batch_size = conf['batch_size']
+    def get(key, default):
+        if key in conf:
+            return conf[key]
+        return default
+    seed = get('seed', 0)
+
+    if 'traj_ids' in conf or 'uniform_trajectories' in conf:
+        dataset = indexed_records(filenames, conf, seed)
+    else:
+        dataset = tf.data.Dataset.from_tensor_slices(tf.constant(filenames))
+        if shuffle:
+            # a new, but deterministic file order in every epoch
+            dataset = dataset.shuffle(len(filenames), seed=seed, reshuffle_each_iteration=True)
+        dataset = dataset.repeat()
+        # not sloppy, so that the order of the examples only depends on the seed
+        dataset = dataset.apply(tf.contrib.data.parallel_interleave(
+            tf.data.TFRecordDataset, cycle_length=min(get('interleave_files', 8), len(filenames))))
+        if shuffle:
+            dataset = dataset.shuffle(get('shuffle_buffer', 4 * batch_size), seed=seed)
+    dataset = dataset.batch(batch_size)
+    dataset = dataset.map(parse_batch, num_parallel_calls=get('parse_threads', 4))
+    dataset = dataset.prefetch(get('prefetch_batches', 4))
+    if 'prefetch_to_device' in conf:
+        dataset = dataset.apply(tf.contrib.data.prefetch_to_device(conf['prefetch_to_device']))
+
+    iterator = dataset.make_initializable_iterator()
+    tf.add_to_collection(INPUT_INITIALIZERS, iterator.initializer)
+
+    batch = iterator.get_next()
+    # the dataset repeats indefinitely, so every batch is complete
+    for tensor in batch.values():
+        tensor.set_shape([batch_size] + tensor.get_shape().as_list()[1:])
+    return batch
@@ -0,0 +1,162 @@
+"""
+Decoded, memory-mapped copy of a tfrecord dataset directory such as pushing_data/<name>/train.
+
+convert_dataset decodes every trajectory once into one .npy file per modality,
+N x T x ... (images uint8, everything else float32), plus index.pkl with the shapes and the
+source file of every trajectory. MmapDataset serves random minibatches from these files without
+any decoding, build_mmap_input wraps it for training with the same outputs as the tfrecord readers.
+
+usage: python mmap_dataset.py <tfrecord dir> <cache dir>
+"""
+import argparse
+import cPickle
+import glob
+import os
+import numpy as np
+import tensorflow as tf
+
+from python_visual_mpc.video_prediction.utils_vpred.numpy_tfrecord import tf_record_iterator, parse_example, \
+    features_to_arrays
+from python_visual_mpc.video_prediction.utils_vpred.input_pipeline import split_filenames, INPUT_INITIALIZERS
+
+def convert_dataset(data_dir, cache_dir):
+    """
+    decodes all tfrecords files in data_dir into cache_dir, in the order of the sorted file names
+    """
+    filenames = sorted(glob.glob(os.path.join(data_dir, '*.tfrecords')))
+    if not filenames:
+        raise RuntimeError('No data_files files found.')
+
+    counts = [sum(1 for _ in tf_record_iterator(f)) for f in filenames]
+    ntraj = sum(counts)
+    print 'converting {} trajectories from {} files'.format(ntraj, len(filenames))
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    arrays, sources = {}, []
+    itraj = 0
+    for filename, count in zip(filenames, counts):
+        for serialized_example in tf_record_iterator(filename):
+            traj = features_to_arrays(parse_example(serialized_example))
+            if not arrays:
+                for name, value in traj.items():
+                    dtype = np.uint8 if value.dtype == np.uint8 else np.float32
+                    arrays[name] = np.lib.format.open_memmap(os.path.join(cache_dir, name + '.npy'), mode='w+',
+                                                             dtype=dtype, shape=(ntraj,) + value.shape)
+            for name in arrays:
+                arrays[name][itraj] = traj[name]
+            sources.append(os.path.basename(filename))
+            itraj += 1
+        print 'converted', filename
+
+    index = {'ntraj': ntraj,
+             'shapes': dict((name, a.shape) for name, a in arrays.items()),
+             'sources': sources,
+             'data_dir': data_dir}
+    for a in arrays.values():
+        a.flush()
+    with open(os.path.join(cache_dir, 'index.pkl'), 'wb') as f:
+        cPickle.dump(index, f)
+
+
+class MmapDataset(object):
+    """
+    random minibatches from a converted dataset, the arrays are memory-mapped read-only,
+    so only the frames of the selected trajectories and timesteps are read
+    """
+    def __init__(self, cache_dir, trajectories=None, seed=None):
+        """
+        :param trajectories: indices of the trajectories to sample from, default all
+        """
+        with open(os.path.join(cache_dir, 'index.pkl'), 'rb') as f:
+            self.index = cPickle.load(f)
+        self.arrays = dict((name, np.load(os.path.join(cache_dir, name + '.npy'), mmap_mode='r'))
+                           for name in self.index['shapes'])
+        if trajectories is None:
+            trajectories = np.arange(self.index['ntraj'])
+        self.trajectories = np.asarray(trajectories)
+        self.rng = np.random.RandomState(seed)
+
+    def split(self, train_val_split, training):
+        """
+        :return: the trajectories of the training or validation files, using the same split as the tf.data pipeline
+        """
+        sources = np.array(self.index['sources'])
+        files = split_filenames(sorted(set(sources)), train_val_split, training)
+        return np.where(np.in1d(sources, files))[0]
+
+    def sample_batch(self, batch_size, load_indx, names, use_len=None, tshift=2):
+        """
+        :param load_indx: timesteps of the sequence, e.g. range(0, 30, skip_frame)[:sequence_length]
+        :param use_len: if given, every sample gets a random window of use_len steps of load_indx,
+        starting at a multiple of tshift
+        :return: dict name -> batch_size x len x ... array
+        """
+        traj = np.sort(self.rng.choice(self.trajectories, batch_size))
+        load_indx = np.asarray(load_indx)
+        if use_len is None:
+            tind = np.tile(load_indx, [batch_size, 1])
+        else:
+            nshifts = (len(load_indx) - use_len) / tshift + 1
+            start = self.rng.randint(0, nshifts, batch_size) * tshift
+            tind = load_indx[start[:, None] + np.arange(use_len)]
+        return dict((name, self.arrays[name][traj[:, None], tind]) for name in names)
+
+
+def build_mmap_input(conf, training=True):
+    """
+    feeds random minibatches of the dataset converted to conf['mmap_cache'] into the graph
+    :return: dict name -> tensor, batch x time x ..., images as float in [0, 1]
+    """
+    if 'seed' in conf:
+        seed = conf['seed'] + int(training)
+    else: seed = None
+    dataset = MmapDataset(conf['mmap_cache'], seed=seed)
+    if not conf['visualize']:
+        dataset.trajectories = dataset.split(conf['train_val_split'], training)
+
+    load_indx = range(0, 30, conf['skip_frame'])
+    load_indx = load_indx[:conf['sequence_length']]
+    if 'use_len' in conf:
+        use_len = conf['use_len']
+    else: use_len = None
+    seqlen = use_len or len(load_indx)
+
+    if 'sawyer' in conf:
+        names = ['image_aux1', 'action', 'endeffector_pos']
+        if 'single_view' not in conf:
+            names.append('image_main')
+    else:
+        names = ['image', 'action', 'state']
+        if 'use_object_pos' in conf:
+            names += ['object_pos', 'max_move_pose']
+    shapes = dict((name, [conf['batch_size'], seqlen] + list(dataset.index['shapes'][name][2:])) for name in names)
+    dtypes = dict((name, tf.as_dtype(dataset.arrays[name].dtype)) for name in names)
+
+    def generator():
+        while True:
+            yield dataset.sample_batch(conf['batch_size'], load_indx, names, use_len)
+
+    tfdata = tf.data.Dataset.from_generator(generator, dtypes, dict((n, tf.TensorShape(s)) for n, s in shapes.items()))
+    tfdata = tfdata.prefetch(4)
+    iterator = tfdata.make_initializable_iterator()
+    tf.add_to_collection(INPUT_INITIALIZERS, iterator.initializer)
+
+    batch = iterator.get_next()
+    for name in batch:
+        if batch[name].dtype == tf.uint8:
+            batch[name] = tf.cast(batch[name], tf.float32) / 255.0
+    return batch
+
+
+def main():
+    parser = argparse.ArgumentParser(description='decode a tfrecord dataset into a memory-mapped cache')
+    parser.add_argument('data_dir', type=str, help='e.g. pushing_data/<name>/train')
+    parser.add_argument('cache_dir', type=str, help='output directory')
+    args = parser.parse_args()
+    convert_dataset(args.data_dir, args.cache_dir)
+
+
+if __name__ == '__main__':
+    main()
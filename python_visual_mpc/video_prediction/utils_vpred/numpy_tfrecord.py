@@ -0,0 +1,257 @@
+"""
+Reads the tfrecords files written by save_tf_record into numpy arrays without importing tensorflow.
+
+The tfrecords framing (uint64 length, uint32 crc, data, uint32 crc) and the tf.train.Example
+protobuf are parsed directly, the checksums are not verified. Everything is lazy: files are read
+record by record and trajectories are decoded when the generator reaches them.
+
+usage: python numpy_tfrecord.py <data dir> [--gif <file>]  prints the modalities, optionally writes a preview gif
+"""
+import argparse
+import glob
+import io
+import os
+import struct
+import numpy as np
+from PIL import Image
+
+# wire types of the protobuf encoding
+VARINT, FIXED64, LENGTH_DELIMITED, FIXED32 = 0, 1, 2, 5
+
+# per-timestep keys of the original record layout, name -> (key, dtype)
+MUJOCO_KEYS = {'image': ('move/{}/image/encoded', np.uint8),
+               'action': ('move/{}/action', np.float32),
+               'state': ('move/{}/state', np.float32),
+               'object_pos': ('move/{}/object_pos', np.float32),
+               'max_move_pose': ('move/{}/max_move_pose', np.float32),
+               'touchdata': ('touchdata/{}', np.float32),
+               'retina': ('move/{}/retina/encoded', np.uint8)}
+SAWYER_KEYS = {'image_main': ('{}/image_main/encoded', np.uint8),
+               'image_aux1': ('{}/image_aux1/encoded', np.uint8),
+               'action': ('{}/action', np.float32),
+               'endeffector_pos': ('{}/endeffector_pos', np.float32),
+               'init_pix_distrib': ('{}/init_pix_distrib', np.uint8)}
+# modalities of the compact layout which are not float32
+UINT8_MODALITIES = ['image', 'retina', 'image_main', 'image_aux1', 'init_pix_distrib']
+INT64_MODALITIES = ['initial_retpos']
+
+
+def encode_frame(frame, codec, jpeg_quality=95):
+    """
+    :param frame: H x W x C uint8 image, C is 1 or 3
+    :return: the PNG or JPEG file content
+    """
+    if frame.shape[-1] == 1:
+        frame = frame[..., 0]
+    buf = io.BytesIO()
+    if codec == 'png':
+        Image.fromarray(frame).save(buf, format='PNG')
+    elif codec == 'jpeg':
+        Image.fromarray(frame).save(buf, format='JPEG', quality=jpeg_quality)
+    else:
+        raise ValueError('unknown image codec {}'.format(codec))
+    return buf.getvalue()
+
+
+def decode_frame(encoded, channels=3):
+    """
+    numpy counterpart of the in-graph decoding, used for tooling and benchmarks
+    """
+    frame = np.asarray(Image.open(io.BytesIO(encoded)))
+    return frame.reshape(frame.shape[:2] + (channels,))
+
+
+def tf_record_iterator(filename):
+    """
+    yields the serialized records of a tfrecords file
+    """
+    with open(filename, 'rb') as f:
+        while True:
+            header = f.read(12)
+            if not header:
+                return
+            if len(header) < 12:
+                raise IOError('truncated record header in {}'.format(filename))
+            length = struct.unpack('<Q', header[:8])[0]
+            data = f.read(length)
+            if len(data) < length or len(f.read(4)) < 4:
+                raise IOError('truncated record in {}'.format(filename))
+            yield data
+
+
+def _varint(buf, pos):
+    result, shift = 0, 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _fields(buf, start, end):
+    """
+    yields (field number, wire type, value) of a protobuf message, the value of length delimited
+    fields is the (start, end) range in buf
+    """
+    pos = start
+    while pos < end:
+        key, pos = _varint(buf, pos)
+        field, wire_type = key >> 3, key & 7
+        if wire_type == VARINT:
+            value, pos = _varint(buf, pos)
+        elif wire_type == LENGTH_DELIMITED:
+            length, pos = _varint(buf, pos)
+            value = (pos, pos + length)
+            pos += length
+        elif wire_type == FIXED32:
+            value = (pos, pos + 4)
+            pos += 4
+        elif wire_type == FIXED64:
+            value = (pos, pos + 8)
+            pos += 8
+        else:
+            raise ValueError('unsupported protobuf wire type {}'.format(wire_type))
+        yield field, wire_type, value
+
+
+def _parse_feature(data, buf, start, end):
+    """
+    Feature: oneof bytes_list = 1, float_list = 2, int64_list = 3, each with repeated value = 1
+    :return: list of bytes, float32 array or int64 array
+    """
+    for kind, _, (lstart, lend) in _fields(buf, start, end):
+        if kind == 1:
+            return [data[s:e] for _, _, (s, e) in _fields(buf, lstart, lend)]
+        values = []
+        for _, wire_type, value in _fields(buf, lstart, lend):
+            if kind == 2 and wire_type == LENGTH_DELIMITED:
+                values.append(np.frombuffer(data, '<f4', (value[1] - value[0]) // 4, value[0]))
+            elif kind == 2:
+                values.append(np.frombuffer(data, '<f4', 1, value[0]))
+            elif wire_type == LENGTH_DELIMITED:
+                pos, packed = value[0], []
+                while pos < value[1]:
+                    v, pos = _varint(buf, pos)
+                    packed.append(v)
+                values.append(np.array(packed, dtype=np.uint64).astype(np.int64))
+            else:
+                values.append(np.array([value], dtype=np.uint64).astype(np.int64))
+        dtype = np.float32 if kind == 2 else np.int64
+        if not values:
+            return np.zeros(0, dtype=dtype)
+        return np.concatenate(values).astype(dtype)
+    return []
+
+
+def parse_example(data):
+    """
+    parses a serialized tf.train.Example
+    :return: dict feature name -> list of bytes, float32 array or int64 array
+    """
+    buf = bytearray(data)
+    features = {}
+    # Example: features = 1; Features: map<string, Feature> feature = 1
+    for _, _, (fstart, fend) in _fields(buf, 0, len(buf)):
+        for _, _, (estart, eend) in _fields(buf, fstart, fend):
+            key, value = None, None
+            for num, _, (s, e) in _fields(buf, estart, eend):
+                if num == 1:
+                    key = data[s:e]
+                    if not isinstance(key, str):
+                        key = key.decode('utf-8')
+                else:
+                    value = (s, e)
+            features[key] = _parse_feature(data, buf, *value) if value is not None else []
+    return features
+
+
+def features_to_arrays(features):
+    """
+    converts the features of a trajectory of either record layout into arrays
+    :return: dict name -> T x ... array (per-trajectory values without the time axis)
+    """
+    arrays = {}
+    if 'format_version' in features:
+        names = set(k.rsplit('/', 1)[0] for k in features if k.endswith('/shape'))
+        for name in names:
+            shape = list(features[name + '/shape'])
+            if name + '/frames' in features:
+                arrays[name] = np.stack([decode_frame(f, shape[-1]) for f in features[name + '/frames']])
+                continue
+            if name in UINT8_MODALITIES:
+                dtype = np.uint8
+            elif name in INT64_MODALITIES:
+                dtype = np.int64
+            else: dtype = np.float32
+            arrays[name] = np.frombuffer(features[name + '/data'][0], dtype).reshape(shape)
+        return arrays
+
+    if 'move/0/image/encoded' in features:
+        keys = MUJOCO_KEYS
+    else: keys = SAWYER_KEYS
+
+    for name, (key, dtype) in keys.items():
+        seq = []
+        t = 0
+        while key.format(t) in features:
+            if dtype == np.uint8:
+                # square images, RGB or single channel distributions
+                im = np.frombuffer(features[key.format(t)][0], np.uint8)
+                channels = 1 if name == 'init_pix_distrib' else 3
+                side = int(np.round(np.sqrt(im.size / channels)))
+                seq.append(im.reshape(side, side, channels))
+            else:
+                seq.append(features[key.format(t)])
+            t += 1
+        if seq:
+            arrays[name] = np.stack(seq)
+    if 'initial_retpos' in features:
+        arrays['initial_retpos'] = features['initial_retpos']
+    return arrays
+
+
+def read_trajectories(path):
+    """
+    :param path: a tfrecords file, a directory of tfrecords files or a list of files
+    :return: generator of dicts name -> array, one per trajectory
+    """
+    if isinstance(path, list):
+        filenames = path
+    elif os.path.isdir(path):
+        filenames = sorted(glob.glob(os.path.join(path, '*.tfrecords')))
+    else:
+        filenames = [path]
+
+    for filename in filenames:
+        for record in tf_record_iterator(filename):
+            yield features_to_arrays(parse_example(record))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='inspect a tfrecords dataset without tensorflow')
+    parser.add_argument('path', type=str, help='tfrecords file or directory')
+    parser.add_argument('--ntraj', type=int, default=8, help='number of trajectories to load')
+    parser.add_argument('--gif', type=str, default=None, help='write a preview gif of the trajectories')
+    args = parser.parse_args()
+
+    trajectories = []
+    for traj in read_trajectories(args.path):
+        trajectories.append(traj)
+        if len(trajectories) == args.ntraj:
+            break
+
+    for name, value in sorted(trajectories[0].items()):
+        print name, value.shape, value.dtype
+
+    if args.gif is not None:
+        from python_visual_mpc.video_prediction.utils_vpred.create_gif_lib import assemble_gif, npy_to_gif
+        image_name = 'image' if 'image' in trajectories[0] else 'image_aux1'
+        images = np.stack([traj[image_name] for traj in trajectories], axis=1)  # T x N x H x W x C
+        frames = assemble_gif([list(images)], num_exp=len(trajectories), convert_from_float=False)
+        npy_to_gif(frames, args.gif)
+
+
+if __name__ == '__main__':
+    main()
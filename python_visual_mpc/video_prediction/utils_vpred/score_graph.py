@@ -0,0 +1,68 @@
+import tensorflow as tf
+
+
+def expected_distance_graph(gen_distrib, distance_grid, tstep_weights):
+    """
+    in-graph version of cem_scoring.calc_expected_distance
+    :param gen_distrib: list of T tensors B x 64 x 64 x 1
+    :param distance_grid: tensor 64 x 64
+    :param tstep_weights: tensor of length T
+    :return: expected distance, tensor of length B
+    """
+    distrib = tf.stack(gen_distrib, axis=0)
+    seq_len, batch_size = int(distrib.get_shape()[0]), int(distrib.get_shape()[1])
+    distrib = tf.reshape(distrib, [seq_len, batch_size, -1])
+    distrib /= tf.reduce_sum(distrib, axis=2, keep_dims=True)
+    expected_distance = tf.reduce_sum(distrib * tf.reshape(distance_grid, [1, 1, -1]), axis=2)  # T x B
+    return tf.reduce_sum(expected_distance * tf.expand_dims(tstep_weights, 1), axis=0)
+
+
+class ScoreGraph(object):
+    """
+    Builds the expected-distance cost on top of the predicted distributions, so that a sess.run
+    only has to return the B scores and the top-K predictions instead of all videos
+    """
+    def __init__(self, conf, gen_images, gen_distrib1, gen_distrib2=None):
+        if 'score_topk' in conf:
+            k = conf['score_topk']
+        else: k = 10
+
+        if gen_distrib2 is not None:
+            gen_distrib_list = [gen_distrib1, gen_distrib2]
+        else:
+            gen_distrib_list = [gen_distrib1]
+        ndesig = len(gen_distrib_list)
+
+        self.distance_grids_pl = tf.placeholder(tf.float32, name='distance_grids', shape=(ndesig, 64, 64))
+        self.tstep_weights_pl = tf.placeholder(tf.float32, name='tstep_weights', shape=(len(gen_distrib1),))
+
+        self.scores = 0.
+        for i, gen_distrib in enumerate(gen_distrib_list):
+            self.scores += expected_distance_graph(gen_distrib, self.distance_grids_pl[i], self.tstep_weights_pl)
+
+        # lowest scores first
+        _, self.bestindices = tf.nn.top_k(-self.scores, k=k)
+
+        self.best_gen_images = [tf.gather(im, self.bestindices) for im in gen_images]
+        self.best_gen_distrib1 = [tf.gather(d, self.bestindices) for d in gen_distrib1]
+        if gen_distrib2 is not None:
+            self.best_gen_distrib2 = [tf.gather(d, self.bestindices) for d in gen_distrib2]
+        else:
+            self.best_gen_distrib2 = None
+
+    def fetches(self):
+        fetch_list = [self.scores, self.bestindices, self.best_gen_images, self.best_gen_distrib1]
+        if self.best_gen_distrib2 is not None:
+            fetch_list.append(self.best_gen_distrib2)
+        return fetch_list
+
+    def run(self, sess, feed_dict, distance_grids, tstep_weights):
+        """
+        :return: scores (B), indices of the K best samples, and the images and distributions of the K best samples
+        """
+        feed_dict[self.distance_grids_pl] = distance_grids
+        feed_dict[self.tstep_weights_pl] = tstep_weights
+        results = sess.run(self.fetches(), feed_dict)
+        if self.best_gen_distrib2 is None:
+            results.append(None)
+        return results
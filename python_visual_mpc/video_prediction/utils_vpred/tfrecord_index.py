@@ -0,0 +1,150 @@
+"""
+Random access to the trajectories of a directory of tfrecords shards.
+
+A tfrecords file is a sequence of records framed as
+    uint64 length, uint32 masked crc32c of length, data[length], uint32 masked crc32c of data
+so the byte offsets of all records can be found by reading only the headers.
+The index is stored as .tfrecord_index.npz in the data directory and rebuilt when a shard changes.
+The trajectory id of the i-th record in traj_<a>_to_<b>.tfrecords is a + i.
+"""
+import glob
+import os
+import re
+import struct
+import numpy as np
+
+INDEX_FILE = '.tfrecord_index.npz'
+HEADER_SIZE = 12
+FOOTER_SIZE = 4
+
+
+def scan_records(filename):
+    """
+    :return: list of (offset, length) of the data of every record in the file
+    """
+    records = []
+    filesize = os.path.getsize(filename)
+    with open(filename, 'rb') as f:
+        offset = 0
+        while offset < filesize:
+            f.seek(offset)
+            header = f.read(HEADER_SIZE)
+            if len(header) < HEADER_SIZE:
+                raise IOError('truncated record header in {} at byte {}'.format(filename, offset))
+            length = struct.unpack('<Q', header[:8])[0]
+            records.append((offset + HEADER_SIZE, length))
+            offset += HEADER_SIZE + length + FOOTER_SIZE
+    return records
+
+
+def first_traj_id(filename):
+    """
+    :return: a for traj_<a>_to_<b>.tfrecords, None for other file names
+    """
+    match = re.match(r'traj_(\d+)_to_(\d+)\.tfrecords$', os.path.basename(filename))
+    if match is None:
+        return None
+    return int(match.group(1))
+
+
+class TFRecordIndex(object):
+    def __init__(self, data_dir, rebuild=False):
+        self.data_dir = data_dir
+        self.filenames = sorted(glob.glob(os.path.join(data_dir, '*.tfrecords')))
+        if not self.filenames:
+            raise RuntimeError('No data_files files found.')
+        self._files = {}
+
+        index_file = os.path.join(data_dir, INDEX_FILE)
+        if not rebuild and os.path.exists(index_file):
+            index = np.load(index_file)
+            if self._stamp() == list(index['stamp']):
+                self._set(index['ids'], index['file_ind'], index['offsets'], index['lengths'])
+                return
+        self.build()
+
+    def _stamp(self):
+        # name, size and modification time of every shard, to detect stale indices
+        return ['{}:{}:{}'.format(os.path.basename(f), os.path.getsize(f), int(os.path.getmtime(f)))
+                for f in self.filenames]
+
+    def _set(self, ids, file_ind, offsets, lengths):
+        self.ids, self.file_ind, self.offsets, self.lengths = ids, file_ind, offsets, lengths
+        self._pos = dict((traj_id, i) for i, traj_id in enumerate(ids))
+
+    def build(self):
+        ids, file_ind, offsets, lengths = [], [], [], []
+        next_id = 0
+        for ifile, filename in enumerate(self.filenames):
+            records = scan_records(filename)
+            first = first_traj_id(filename)
+            if first is None:
+                first = next_id
+            ids.extend(range(first, first + len(records)))
+            next_id = first + len(records)
+            file_ind.extend([ifile] * len(records))
+            offsets.extend(r[0] for r in records)
+            lengths.extend(r[1] for r in records)
+
+        self._set(np.array(ids, dtype=np.int64), np.array(file_ind, dtype=np.int32),
+                  np.array(offsets, dtype=np.int64), np.array(lengths, dtype=np.int64))
+        if len(set(ids)) != len(ids):
+            raise ValueError('duplicate trajectory ids in {}'.format(self.data_dir))
+        np.savez(os.path.join(self.data_dir, INDEX_FILE), ids=self.ids, file_ind=self.file_ind,
+                 offsets=self.offsets, lengths=self.lengths, stamp=np.array(self._stamp()))
+        print 'indexed {} trajectories in {} files'.format(len(ids), len(self.filenames))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _file(self, ifile):
+        if ifile not in self._files:
+            self._files[ifile] = open(self.filenames[ifile], 'rb')
+        return self._files[ifile]
+
+    def read(self, traj_id):
+        """
+        :return: the serialized tf.train.Example of the trajectory
+        """
+        i = self._pos[traj_id]
+        f = self._file(self.file_ind[i])
+        f.seek(self.offsets[i])
+        return f.read(self.lengths[i])
+
+    def read_many(self, traj_ids):
+        """
+        reads in file and offset order, returns the records in the order of traj_ids
+        """
+        order = sorted(range(len(traj_ids)), key=lambda k: (self.file_ind[self._pos[traj_ids[k]]],
+                                                            self.offsets[self._pos[traj_ids[k]]]))
+        records = [None] * len(traj_ids)
+        for k in order:
+            records[k] = self.read(traj_ids[k])
+        return records
+
+    def read_range(self, start, end):
+        """
+        :return: the records with start <= trajectory id < end, in id order
+        """
+        return self.read_many(sorted(i for i in self.ids if start <= i < end))
+
+    def subset(self, filenames):
+        """
+        :return: the trajectory ids stored in the given files
+        """
+        names = set(os.path.basename(f) for f in filenames)
+        selected = [i for i, f in enumerate(self.filenames) if os.path.basename(f) in names]
+        return self.ids[np.in1d(self.file_ind, selected)]
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='build the random access index of a tfrecords directory')
+    parser.add_argument('data_dir', type=str, help='e.g. pushing_data/<name>/train')
+    args = parser.parse_args()
+    TFRecordIndex(args.data_dir, rebuild=True)
@@ -0,0 +1,150 @@
+"""
+Version 2 of the trajectory record layout.
+
+Every modality of a trajectory is stored as one contiguous blob across time, together with its shape:
+    '<name>/data'  : bytes, the raw array in C order
+    '<name>/shape' : int64 list, e.g. T x H x W x C for images or T x adim for actions
+Images are stored as uint8, all floating point modalities as float32. Modalities which were not
+recorded are omitted. The key 'format_version' marks records of this layout, records without it
+use the original layout with one feature per timestep ('move/<t>/action', ...).
+
+Image modalities can instead be compressed frame by frame with PNG or JPEG:
+    '<name>/frames' : bytes list, one encoded image per timestep
+    '<name>/shape'  : int64 list, T x H x W x C
+    '<name>/codec'  : bytes, 'png' or 'jpeg'
+"""
+import numpy as np
+import tensorflow as tf
+
+from python_visual_mpc.video_prediction.utils_vpred.numpy_tfrecord import encode_frame, decode_frame
+
+FORMAT_VERSION = 2
+CODECS = ['raw', 'png', 'jpeg']
+
+
+def _bytes_feature(value):
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+
+
+def _int64_feature(value):
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=value))
+
+
+def encode_trajectory(modalities, codecs=None, jpeg_quality=95):
+    """
+    :param modalities: dict name -> numpy array, time is the first axis for per-timestep data
+    :param codecs: dict name -> 'raw', 'png' or 'jpeg' for the image modalities (T x H x W x C uint8),
+    modalities which are not listed are stored raw
+    :return: tf.train.Example
+    """
+    if codecs is None:
+        codecs = {}
+
+    feature = {'format_version': _int64_feature([FORMAT_VERSION])}
+    for name, array in modalities.items():
+        array = np.asarray(array)
+        if array.dtype.kind == 'f':
+            array = array.astype(np.float32)
+        array = np.ascontiguousarray(array)
+        feature[name + '/shape'] = _int64_feature(list(array.shape))
+
+        codec = codecs.get(name, 'raw')
+        if codec == 'raw':
+            feature[name + '/data'] = _bytes_feature(array.tostring())
+        else:
+            assert array.dtype == np.uint8 and array.ndim == 4
+            frames = [encode_frame(frame, codec, jpeg_quality) for frame in array]
+            feature[name + '/frames'] = tf.train.Feature(bytes_list=tf.train.BytesList(value=frames))
+            feature[name + '/codec'] = _bytes_feature(codec)
+    return tf.train.Example(features=tf.train.Features(feature=feature))
+
+
+def _first_example(filename):
+    for serialized_example in tf.python_io.tf_record_iterator(filename):
+        example = tf.train.Example()
+        example.ParseFromString(serialized_example)
+        return example
+    raise ValueError('no records in {}'.format(filename))
+
+
+def record_format_version(filename):
+    """
+    :return: the format version of the first record in the file
+    """
+    feature = _first_example(filename).features.feature
+    if 'format_version' in feature:
+        return feature['format_version'].int64_list.value[0]
+    return 1
+
+
+def record_codecs(filename):
+    """
+    the codecs are fixed per dataset, they are read from the first record when the input graph is built
+    :return: dict name -> codec of the compressed modalities
+    """
+    feature = _first_example(filename).features.feature
+    codecs = {}
+    for key in feature:
+        if key.endswith('/codec'):
+            codecs[key[:-len('/codec')]] = feature[key].bytes_list.value[0]
+    return codecs
+
+
+def _decode_frames(frames, codec, channels):
+    if codec == 'png':
+        decode = lambda f: tf.image.decode_png(f, channels=channels)
+    elif codec == 'jpeg':
+        decode = lambda f: tf.image.decode_jpeg(f, channels=channels)
+    else:
+        raise ValueError('unknown image codec {}'.format(codec))
+    return tf.map_fn(decode, frames, dtype=tf.uint8, back_prop=False)
+
+
+def parse_trajectory(serialized_example, specs, load_indx=None, codecs=None):
+    """
+    decodes the modalities of a version 2 record with a single parse op
+    :param specs: dict name -> (dtype, shape), shape of the whole blob, -1 marks the time axis
+    :param load_indx: if given, only these timesteps are kept of the modalities with a time axis,
+    compressed frames which are not used are not decoded
+    :param codecs: dict name -> codec as returned by record_codecs
+    :return: dict name -> tensor
+    """
+    decoded = parse_trajectory_batch(tf.expand_dims(serialized_example, 0), specs, load_indx, codecs)
+    return {name: tensor[0] for name, tensor in decoded.items()}
+
+
+def parse_trajectory_batch(serialized_batch, specs, load_indx=None, codecs=None):
+    """
+    batched version of parse_trajectory, decodes a vector of serialized records at once
+    :return: dict name -> tensor with a leading batch dimension
+    """
+    if codecs is None:
+        codecs = {}
+
+    features = {}
+    for name in specs:
+        if name in codecs:
+            features[name + '/frames'] = tf.VarLenFeature(tf.string)
+        else:
+            features[name + '/data'] = tf.FixedLenFeature([], tf.string)
+    features = tf.parse_example(serialized_batch, features=features)
+    batch_size = tf.shape(serialized_batch)[0]
+
+    decoded = {}
+    for name, (dtype, shape) in specs.items():
+        per_timestep = shape[0] == -1 and load_indx is not None
+        if name in codecs:
+            frames = tf.sparse_tensor_to_dense(features[name + '/frames'], default_value='')
+            if per_timestep:
+                frames = tf.gather(frames, load_indx, axis=1)
+            frames = _decode_frames(tf.reshape(frames, [-1]), codecs[name], shape[-1])
+            decoded[name] = tf.reshape(frames, [batch_size] + shape)
+        else:
+            tensor = tf.reshape(tf.decode_raw(features[name + '/data'], dtype), [batch_size] + shape)
+            if per_timestep:
+                tensor = tf.gather(tensor, load_indx, axis=1)
+            decoded[name] = tensor
+
+        if per_timestep:
+            decoded[name].set_shape([None, len(load_indx)] + shape[1:])
+    return decoded
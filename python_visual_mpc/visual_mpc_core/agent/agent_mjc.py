@@ -13,6 +13,7 @@ import matplotlib.pyplot as plt
 
 import time
 from python_visual_mpc.visual_mpc_core.infrastructure.trajectory import Trajectory
+from python_visual_mpc.visual_mpc_core.infrastructure.utility.mujoco_render import MujocoRenderer
 from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
 from matplotlib.figure import Figure
 import cv2
@@ -41,23 +42,32 @@ class AgentMuJoCo(object):
         if "varying_mass" in self._hyperparams:
             self.create_xml()
 
-        pdb.set_trace()
-
         self._model= mujoco_py.MjModel(self._hyperparams['filename'])
+
+        # rendered one physics step ahead of the main model, also when both use the same file, as in the datasets
         self.model_nomarkers = mujoco_py.MjModel(self._hyperparams['filename_nomarkers'])
 
-        gofast = True
-        self._small_viewer = mujoco_py.MjViewer(visible=True,
-                                                init_width=self._hyperparams['image_width'],
-                                                init_height=self._hyperparams['image_height'],
-                                                go_fast=gofast)
-        self._small_viewer.start()
-        self._small_viewer.cam.camid = 0
-        if self._hyperparams['additional_viewer']:
-            self._large_viewer = mujoco_py.MjViewer(visible=True, init_width=480,
-                                                    init_height=480, go_fast=gofast)
-            self._large_viewer.start()
-            self._large_viewer.cam.camid = 0
+        # with 'offscreen_render' no window is shown, this allows running on machines without a display
+        offscreen = 'offscreen_render' in self._hyperparams
+        self._small_viewer = MujocoRenderer(self._hyperparams['image_width'], self._hyperparams['image_height'],
+                                            offscreen)
+        self.render_large = self.large_images_needed()
+        if self.render_large:
+            self._large_viewer = MujocoRenderer(480, 480, offscreen)
+
+    def large_images_needed(self):
+        """
+        the 480x480 frames are only rendered when they are consumed: by the gif of the random baseline,
+        by the trajectory visualization ('add_traj') or by the retina images ('large_images_retina')
+        """
+        hp = self._hyperparams
+        if 'large_images_retina' in hp:
+            return True
+        if not hp['data_collection'] and 'add_traj' in hp and hp['add_traj']:
+            return True
+        if 'random_baseline' in hp and not 'novideo' in hp:
+            return True
+        return False
 
 
     def create_xml(self):
@@ -110,7 +120,8 @@ class AgentMuJoCo(object):
 
         if "varying_mass" in self._hyperparams:
             self._small_viewer.finish()
-            self._large_viewer.finish()
+            if self.render_large:
+                self._large_viewer.finish()
 
         policy.finish()
         return traj
@@ -134,10 +145,8 @@ class AgentMuJoCo(object):
         traj = Trajectory(self._hyperparams)
 
         self._small_viewer.set_model(self.model_nomarkers)
-        if self._hyperparams['additional_viewer']:
+        if self.render_large:
             self._large_viewer.set_model(self._model)
-        self._small_viewer.cam.camid = 0
-        self._large_viewer.cam.camid = 0
 
         # apply action of zero for the first few steps, to let the scene settle
         for t in range(self._hyperparams['skip_first']):
@@ -350,13 +359,9 @@ class AgentMuJoCo(object):
         """
         store image at time index t
         """
-        if self._hyperparams['additional_viewer']:
-            self._large_viewer.loop_once()
-
-        img_string, width, height = self._large_viewer.get_image()
-        largeimage = np.fromstring(img_string, dtype='uint8').reshape(
-                (480, 480, self._hyperparams['image_channels']))[::-1, :, :]
-        self.large_images.append(largeimage)
+        if self.render_large:
+            largeimage = self._large_viewer.render(self._hyperparams['image_channels'])
+            self.large_images.append(largeimage)
 
         # collect retina image
         if 'large_images_retina' in self._hyperparams:
@@ -390,10 +395,7 @@ class AgentMuJoCo(object):
         self.model_nomarkers.data.qpos = self._model.data.qpos
         self.model_nomarkers.data.qvel = self._model.data.qvel
         self.model_nomarkers.step()
-        self._small_viewer.loop_once()
-
-        img_string, width, height = self._small_viewer.get_image()
-        img = np.fromstring(img_string, dtype='uint8').reshape((height, width, self._hyperparams['image_channels']))[::-1,:,:]
+        img = self._small_viewer.render(self._hyperparams['image_channels'])
 
         traj._sample_images[t,:,:,:] = img
 
@@ -0,0 +1,69 @@
+""" Vectorized postprocessing and costs of the sampled CEM actions. """
+import numpy as np
+
+
+def clip_dims(dims, low, high):
+    """
+    continuous dimensions, e.g. movements clipped in units of meters
+    :param dims: list of action dimensions the transform applies to
+    """
+    def transform(actions):
+        actions[..., dims] = np.clip(actions[..., dims], low, high)
+    return transform
+
+
+def discrete_dims(dims, low, high):
+    """
+    discrete dimensions, e.g. the number of steps to close or hold the gripper,
+    floored to integers and clamped to [low, high]
+    """
+    def transform(actions):
+        actions[..., dims] = np.clip(np.floor(actions[..., dims]), low, high)
+    return transform
+
+
+def make_transform(spec):
+    """
+    :param spec: tuple (kind, dims, low, high) with kind 'clip' or 'discrete', or a function
+    which modifies an M x nactions x adim array in place
+    """
+    if callable(spec):
+        return spec
+    kind, dims, low, high = spec
+    if kind == 'clip':
+        return clip_dims(dims, low, high)
+    elif kind == 'discrete':
+        return discrete_dims(dims, low, high)
+    else:
+        raise ValueError('unknown action transform {}'.format(kind))
+
+
+class ActionPostprocessor(object):
+    """
+    applies the per-dimension transforms to the whole batch of sampled actions
+    and expands every action to repeat timesteps
+    """
+    def __init__(self, transforms, repeat=1):
+        self.transforms = [make_transform(spec) for spec in transforms]
+        self.repeat = repeat
+
+    def __call__(self, actions):
+        """
+        :param actions: M x nactions x adim, modified in place
+        :return: M x nactions*repeat x adim
+        """
+        for transform in self.transforms:
+            transform(actions)
+        if self.repeat > 1:
+            return np.repeat(actions, self.repeat, axis=1)
+        return actions
+
+
+def action_cost(actions, factor):
+    """
+    sum over time of the squared action magnitudes
+    :param actions: M x T x adim
+    :return: costs, length M
+    """
+    flat = actions.reshape(actions.shape[0], -1)
+    return np.einsum('ij,ij->i', flat, flat) * factor
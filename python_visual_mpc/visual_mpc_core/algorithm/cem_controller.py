@@ -10,6 +10,16 @@ import time
 import imp
 import cPickle
 from python_visual_mpc.video_prediction.utils_vpred.create_gif_lib import *
+from python_visual_mpc.visual_mpc_core.algorithm.cem_scoring import get_tstep_weights, calc_expected_distance, \
+    context_kwargs
+from python_visual_mpc.visual_mpc_core.algorithm.distance_fields import get_distance_field
+from python_visual_mpc.video_prediction.predictor_server import require_outputs
+from python_visual_mpc.visual_mpc_core.algorithm.action_processing import ActionPostprocessor, action_cost
+from python_visual_mpc.visual_mpc_core.algorithm.cem_sampling import make_sampler, warm_start, warm_iterations, \
+    CEMTermination
+from python_visual_mpc.visual_mpc_core.infrastructure.utility.mujoco_render import MujocoRenderer
+from python_visual_mpc.visual_mpc_core.algorithm.mujoco_rollout import RolloutPool, rollout_batch, \
+    make_rollout_conf, reset_model, mujoco_to_imagespace
 from datetime import datetime
 import os
 
@@ -57,7 +67,11 @@ class CEM_controller(Policy):
         if self.use_net:
             self.M = self.netconf['batch_size']
             assert self.nactions * self.repeat == self.netconf['sequence_length']
+            self.tstep_weights = get_tstep_weights(self.policyparams, self.netconf['sequence_length'] - 1)
             self.predictor = predictor
+            # a predictor server only sends the images back if they are needed
+            if self.verbose:
+                require_outputs(self.predictor, ['gen_images'])
             self.K = 10  # only consider K best samples for refitting
         else:
             self.M = self.policyparams['num_samples']
@@ -72,21 +86,24 @@ class CEM_controller(Policy):
 
         self.adim = 2  # action dimension
         self.initial_std = policyparams['initial_std']
-        if 'exp_factor' in policyparams:
-            self.exp_factor = policyparams['exp_factor']
-
-        gofast = True
-        self.viewer = mujoco_py.MjViewer(visible=True, init_width=480,
-                                         init_height=480, go_fast=gofast)
-        self.viewer.start()
-        self.viewer.set_model(self.model)
-        self.viewer.cam.camid = 0
-
-        self.small_viewer = mujoco_py.MjViewer(visible=True, init_width=64,
-                                         init_height=64, go_fast=gofast)
-        self.small_viewer.start()
-        self.small_viewer.set_model(self.model)
-        self.small_viewer.cam.camid = 0
+
+        if 'action_transforms' in self.policyparams:
+            transforms = self.policyparams['action_transforms']
+        else: transforms = []
+        self.postprocess = ActionPostprocessor(transforms, self.repeat)
+        self.sampler = make_sampler(self.policyparams, self.adim * self.nactions)
+        self.warmstart = 'warmstart' in self.policyparams
+        self.termination = CEMTermination(self.policyparams)
+        self.iterations_used = []  # number of CEM iterations of every MPC step
+
+        # the viewers are only needed for rendering the ground truth rollouts in verbose mode
+        self.offscreen = 'offscreen_render' in self.agentparams
+        if self.verbose:
+            self.small_viewer = MujocoRenderer(64, 64, self.offscreen)
+            self.small_viewer.set_model(self.model)
+            if not self.offscreen:
+                self.viewer = MujocoRenderer(480, 480)
+                self.viewer.set_model(self.model)
 
         self.init_model = []
         #history of designated pixels
@@ -108,9 +125,17 @@ class CEM_controller(Policy):
         self.mean =None
         self.sigma =None
 
+        self.rollconf = make_rollout_conf(self.agentparams, self.policyparams)
+        # number of processes for the simulator rollouts, the pool is started on first use
+        if 'rollout_workers' in self.policyparams:
+            self.rollout_workers = self.policyparams['rollout_workers']
+        else: self.rollout_workers = 1
+        self.rollout_pool = None
+
     def reinitialize(self):
         self.use_net = self.policyparams['usenet']
         self.action_list = []
+        self.iterations_used = []
         self.gtruth_images = [np.zeros((self.M, 64, 64, 3)) for _ in range(self.nactions * self.repeat)]
         self.initial_std = self.policyparams['initial_std']
         # history of designated pixels
@@ -126,14 +151,18 @@ class CEM_controller(Policy):
 
 
     def finish(self):
-        self.small_viewer.finish()
-        self.viewer.finish()
+        if self.verbose:
+            self.small_viewer.finish()
+            if not self.offscreen:
+                self.viewer.finish()
+        if self.rollout_pool is not None:
+            self.rollout_pool.close()
+            self.rollout_pool = None
 
     def setup_mujoco(self):
 
         # set initial conditions
-        self.model.data.qpos = self.init_model.data.qpos
-        self.model.data.qvel = self.init_model.data.qvel
+        reset_model(self.model, self.init_model.data.qpos, self.init_model.data.qvel)
 
     def eval_action(self):
         goalpoint = np.array(self.agentparams['goal_point'])
@@ -142,65 +171,45 @@ class CEM_controller(Policy):
         return np.linalg.norm(goalpoint - refpoint)
 
     def calc_action_cost(self, actions):
-        actions_costs = np.zeros(self.M)
-        for smp in range(self.M):
-            force_magnitudes = np.array([np.linalg.norm(actions[smp, t]) for
-                                         t in range(self.nactions * self.repeat)])
-            actions_costs[smp]=np.sum(np.square(force_magnitudes)) * self.action_cost_mult
-        return actions_costs
+        return action_cost(actions, self.action_cost_mult)
 
     def perform_CEM(self,last_frames, last_states, last_action, t):
         # initialize mean and variance
-
-        if 'exp_factor' in self.policyparams:  # if reusing covariance matrix and mean...
-            if t < 2:
-                self.mean = np.zeros(self.adim * self.nactions)
-                self.sigma = np.diag(np.ones(self.adim * self.nactions) * self.initial_std ** 2)
-            else:
-                print 'reusing mean form last MPC step...'
-                # if 'reduce_iter' in self.policyparams:
-                #     self.niter = 2
-
-                pdb.set_trace()
-                mean_old = copy.deepcopy(self.mean)
-
-                self.mean = np.zeros_like(mean_old)
-                self.mean[:-2] = mean_old[2:]
-                self.mean = self.mean.reshape(self.adim * self.nactions)
-
-                sigma_old = copy.deepcopy(self.sigma)
-                self.sigma = np.zeros_like(self.sigma)
-                self.sigma[0:-2,0:-2] = sigma_old[2:,2: ]
-                self.sigma[0:-2, 0:-2] += np.diag(np.ones(self.adim * (self.nactions-1)))*(self.initial_std/5)**2
-                self.sigma[-1,-1] = self.initial_std**2
-                self.sigma[-2,-2] = self.initial_std**2
-
-                # self.sigma = np.diag(np.ones(self.adim * self.nactions) * self.initial_std ** 2)
+        if self.warmstart and t > 1:
+            print 'reusing mean and covariance from last MPC step...'
+            # every action of the plan covers repeat steps, the plan of step 1 starts with a whole action
+            warm_start(self.sampler, self.policyparams, self.adim, np.zeros(self.adim),
+                       np.ones(self.adim) * self.initial_std ** 2, self.initial_std, shift=(t - 1) % self.repeat == 0)
+            self.mean, self.sigma = self.sampler.mean, self.sampler.sigma
+            niter = warm_iterations(self.policyparams, self.niter)
         else:
             self.mean = np.zeros(self.adim * self.nactions)
             self.sigma = np.diag(np.ones(self.adim * self.nactions) * self.initial_std ** 2)
-
+            self.sampler.set(self.mean, self.sigma)
+            niter = self.niter
 
         print '------------------------------------------------'
         print 'starting CEM cylce'
+        self.termination.start()
 
         # last_action = np.expand_dims(last_action, axis=0)
         # last_action = np.repeat(last_action, self.netconf['batch_size'], axis=0)
         # last_action = last_action.reshape(self.netconf['batch_size'], 1, self.adim)
 
-        for itr in range(self.niter):
+        for itr in range(niter):
             print '------------'
             print 'iteration: ', itr
             t_startiter = datetime.now()
 
-            actions = np.random.multivariate_normal(self.mean, self.sigma, self.M)
+            actions = self.sampler.sample(self.M)
             actions = actions.reshape(self.M, self.nactions, self.adim)
-            # import pdb; pdb.set_trace()
+            # the transforms are applied in place, so the simulator rollouts see the same actions
+            actions_withrepeat = self.postprocess(actions)
 
             if self.verbose or not self.use_net:
                 scores = self.take_mujoco_smp(actions, itr)
 
-            actions = np.repeat(actions, self.repeat, axis=1)
+            actions = actions_withrepeat
 
             t_start = datetime.now()
 
@@ -225,8 +234,8 @@ class CEM_controller(Policy):
             # print 'bestaction:', self.bestaction
 
             arr_best_actions = actions_flat[self.indices]  # only take the K best actions
-            self.sigma = np.cov(arr_best_actions, rowvar= False, bias= False)
-            self.mean = np.mean(arr_best_actions, axis= 0)
+            self.sampler.fit(arr_best_actions)
+            self.mean, self.sigma = self.sampler.mean, self.sampler.sigma
 
             print 'iter {0}, bestscore {1}'.format(itr, scores[self.indices[0]])
             print 'action cost of best action: ', actioncosts[self.indices[0]]
@@ -234,20 +243,51 @@ class CEM_controller(Policy):
             print 'overall time for iteration {}'.format(
                 (datetime.now() - t_startiter).seconds + (datetime.now() - t_startiter).microseconds / 1e6)
 
-    def take_mujoco_smp(self, actions, itr):
+            if self.termination.done(itr, scores[self.indices], self.sampler):
+                print 'stopping CEM after iteration {}: {}'.format(itr, self.termination.reason)
+                break
+        self.iterations_used.append(itr + 1)
+        if self.use_net:
+            self.record_last_iteration()
 
-        scores = np.empty(self.M, dtype=np.float64)
-        for smp in range(self.M):
-            self.setup_mujoco()
-            accum_score = self.sim_rollout(actions[smp], smp, itr)
+    def record_last_iteration(self):
+        """
+        records the predictions of the best sample of the last CEM iteration, which is only known after the
+        termination check, video_pred keeps them of every iteration
+        """
+        if 'predictor_propagation' in self.policyparams:
+            self.rec_input_distrib.append(self.best_prop_distrib)
+        if self.verbose:
+            self.save_verbose(*self.last_predictions)
 
-            if 'rew_all_steps' in self.policyparams:
-                scores[smp] = accum_score
-            else:
-                scores[smp] = self.eval_action()
+    def take_mujoco_smp(self, actions, itr):
+        qpos = self.init_model.data.qpos
+        qvel = self.init_model.data.qvel
+
+        if self.verbose or self.rollout_workers == 1:
+            # rendering the ground truth images requires the viewers of this process
+            if self.verbose:
+                step_callback = self.render_gtruth
+            else: step_callback = None
+            scores, ball_pix, target_pix = rollout_batch(self.model, qpos, qvel, actions, self.rollconf,
+                                                         step_callback)
+        else:
+            if self.rollout_pool is None:
+                self.rollout_pool = RolloutPool(self.agentparams['filename'], self.rollout_workers)
+            scores, ball_pix, target_pix = self.rollout_pool.rollout(qpos, qvel, actions, self.rollconf)
+
+        if not self.use_net:
+            self.pred_pos[:, itr] = ball_pix
+            if self.policyparams['low_level_ctrl']:
+                self.rec_target_pos[:, itr] = target_pix
 
         return scores
 
+    def render_gtruth(self, smp, t):
+        if not self.offscreen:
+            self.viewer.render()
+
+        self.gtruth_images[t][smp] = self.small_viewer.render()
 
     def mujoco_one_hot_images(self):
         one_hot_images = np.zeros((1, self.netconf['context_frames'], 64, 64, 1), dtype=np.float32)
@@ -350,146 +390,75 @@ class CEM_controller(Policy):
 
         else: input_distrib = self.mujoco_one_hot_images()
 
-        last_states = np.expand_dims(last_states, axis=0)
-
-        last_states = np.repeat(last_states, self.netconf['batch_size'], axis=0)
-
-        input_distrib = np.repeat(input_distrib, self.netconf['batch_size'], axis=0)
-
-        last_frames = np.expand_dims(last_frames, axis=0)
-        last_frames = np.repeat(last_frames, self.netconf['batch_size'], axis=0)
-        app_zeros = np.zeros(shape=(self.netconf['batch_size'], self.netconf['sequence_length']-
-                                    self.netconf['context_frames'], 64, 64, 3))
-        last_frames = np.concatenate((last_frames, app_zeros), axis=1)
-        last_frames = last_frames.astype(np.float32)/255.
+        # the uint8 context frames, states and input distribution are passed unbatched,
+        # the predictor broadcasts them to all samples
+        input_distrib = input_distrib[0]
 
         gen_images, gen_distrib1, _,gen_states, gen_masks,  = self.predictor(input_images=last_frames,
                                                             input_state=last_states,
                                                             input_actions=actions,
-                                                            input_one_hot_images1=input_distrib)
+                                                            input_one_hot_images1=input_distrib,
+                                                            **context_kwargs(self.netconf, itr))
 
         for tstep in range(self.netconf['sequence_length']-1):
             for smp in range(self.M):
                 self.pred_pos[smp, itr, tstep+1] = self.mujoco_to_imagespace(gen_states[tstep][smp, :2], numpix=480)
 
         goalpoint = self.mujoco_to_imagespace(self.agentparams['goal_point'])
-        distance_grid = np.empty((64,64))
-        for i in range(64):
-            for j in range(64):
-                pos = np.array([i,j])
-                distance_grid[i,j] = np.linalg.norm(goalpoint - pos)
-
-        expected_distance = np.zeros(self.netconf['batch_size'])
-        if 'rew_all_steps' in self.policyparams:
-            for tstep in range(self.netconf['sequence_length']-1):
-                t_mult = 1
-                if 'finalweight' in self.policyparams:
-                    if tstep == self.netconf['sequence_length']-2:
-                        t_mult = self.policyparams['finalweight']
-
-                for b in range(self.netconf['batch_size']):
-                    gen = gen_distrib1[tstep][b].squeeze() / np.sum(gen_distrib1[tstep][b])
-                    expected_distance[b] += np.sum(np.multiply(gen, distance_grid)) * t_mult
-        else:
-            for b in range(self.netconf['batch_size']):
-                gen = gen_distrib1[-1][b].squeeze()/ np.sum(gen_distrib1[-1][b])
-                expected_distance[b] = np.sum(np.multiply(gen, distance_grid))
+        distance_grid = get_distance_field(goalpoint, self.policyparams)
 
+        expected_distance = calc_expected_distance(gen_distrib1, distance_grid, self.tstep_weights)
+
+        # kept for every iteration, record_last_iteration uses the ones of the last iteration
         # for predictor_propagation only!!
         if 'predictor_propagation' in self.policyparams:
             assert not 'correctorconf' in self.policyparams
-            if itr == (self.policyparams['iterations']-1):
-                # pick the prop distrib from the action actually chosen after the last iteration (i.e. self.indices[0])
-                self.indices = expected_distance.argsort()[:self.K]
-                self.rec_input_distrib.append(gen_distrib1[2][self.indices[0]].reshape(1, 64, 64, 1))
-
-        # compare prediciton with simulation
-        if self.verbose and itr == self.policyparams['iterations']-1:
-            print 'creating visuals for best sampled actions at last iteration...'
-
-            # concat_masks = [np.stack(gen_masks[t], axis=1) for t in range(14)]
-
-            file_path = self.netconf['current_dir'] + '/verbose'
-
-            bestindices = expected_distance.argsort()[:self.K]
-
-            def best(inputlist):
-                outputlist = [np.zeros_like(a)[:self.K] for a in inputlist]
-
-                for ind in range(self.K):
-                    for tstep in range(len(inputlist)):
-                        outputlist[tstep][ind] = inputlist[tstep][bestindices[ind]]
-                return outputlist
-
-            self.gtruth_images = [img.astype(np.float) / 255. for img in self.gtruth_images]  #[1:]
-            cPickle.dump(best(gen_distrib1), open(file_path + '/gen_distrib.pkl', 'wb'))
-            cPickle.dump(best(gen_images), open(file_path + '/gen_images.pkl', 'wb'))
-            # cPickle.dump(best(concat_masks), open(file_path + '/gen_masks.pkl', 'wb'))
-            cPickle.dump(best(self.gtruth_images), open(file_path + '/gtruth_images.pkl', 'wb'))
-            print 'written files to:' + file_path
-            comp_pix_distrib(file_path, name='check_eval_t{}'.format(self.t), masks=False, examples=self.K)
+            # pick the prop distrib from the action actually chosen after the last iteration (i.e. self.indices[0])
+            bestind = expected_distance.argsort()[0]
+            self.best_prop_distrib = gen_distrib1[2][bestind].reshape(1, 64, 64, 1)
 
-            f = open(file_path + '/actions_last_iter_t{}'.format(self.t), 'w')
-            sorted = expected_distance.argsort()
-            for i in range(actions.shape[0]):
-                f.write('index: {0}, score: {1}, rank: {2}'.format(i, expected_distance[i], np.where(sorted == i)[0][0]))
-                f.write('action {}\n'.format(actions[i]))
+        if self.verbose:
+            self.last_predictions = (gen_images, gen_distrib1, expected_distance, actions)
 
         return expected_distance
 
-    def sim_rollout(self, actions, smp, itr):
-        accum_score = 0
-
-        if self.policyparams['low_level_ctrl']:
-            rollout_ctrl = self.policyparams['low_level_ctrl']['type'](None, self.policyparams['low_level_ctrl'])
-            roll_target_pos = copy.deepcopy(self.init_model.data.qpos[:2].squeeze())
-
-        for hstep in range(self.nactions):
-            currentaction = actions[hstep]
-
-            if self.policyparams['low_level_ctrl']:
-                roll_target_pos += currentaction
-
-            for r in range(self.repeat):
-                t = hstep*self.repeat + r
-                # print 'time ',t, ' target pos rollout: ', roll_target_pos
+    def save_verbose(self, gen_images, gen_distrib1, expected_distance, actions):
+        """
+        compare the predictions of the best samples with the simulation
+        """
+        print 'creating visuals for best sampled actions at last iteration...'
 
-                if not self.use_net:
-                    ball_coord = self.model.data.qpos[:2].squeeze()
-                    self.pred_pos[smp, itr, t] = mujoco_to_imagespace(ball_coord, numpix=480)
-                    if self.policyparams['low_level_ctrl']:
-                        self.rec_target_pos[smp, itr, t] = mujoco_to_imagespace(roll_target_pos, numpix=480)
+        # concat_masks = [np.stack(gen_masks[t], axis=1) for t in range(14)]
 
-                if self.policyparams['low_level_ctrl'] == None:
-                    force = currentaction
-                else:
-                    qpos = self.model.data.qpos[:2].squeeze()
-                    qvel = self.model.data.qvel[:2].squeeze()
-                    force = rollout_ctrl.act(qpos, qvel, None, t, roll_target_pos)
+        file_path = self.netconf['current_dir'] + '/verbose'
 
-                for _ in range(self.agentparams['substeps']):
-                    self.model.data.ctrl = force
-                    self.model.step()  # simulate the model in mujoco
+        bestindices = expected_distance.argsort()[:self.K]
 
-                accum_score += self.eval_action()
+        def best(inputlist):
+            outputlist = [np.zeros_like(a)[:self.K] for a in inputlist]
 
-                if self.verbose:
-                    self.viewer.loop_once()
+            for ind in range(self.K):
+                for tstep in range(len(inputlist)):
+                    outputlist[tstep][ind] = inputlist[tstep][bestindices[ind]]
+            return outputlist
 
-                    self.small_viewer.loop_once()
-                    img_string, width, height = self.small_viewer.get_image()
-                    img = np.fromstring(img_string, dtype='uint8').reshape(
-                        (height, width, 3))[::-1, :, :]
-                    self.gtruth_images[t][smp] = img
-                    # self.check_conversion()
+        self.gtruth_images = [img.astype(np.float) / 255. for img in self.gtruth_images]  #[1:]
+        cPickle.dump(best(gen_distrib1), open(file_path + '/gen_distrib.pkl', 'wb'))
+        cPickle.dump(best(gen_images), open(file_path + '/gen_images.pkl', 'wb'))
+        # cPickle.dump(best(concat_masks), open(file_path + '/gen_masks.pkl', 'wb'))
+        cPickle.dump(best(self.gtruth_images), open(file_path + '/gtruth_images.pkl', 'wb'))
+        print 'written files to:' + file_path
+        comp_pix_distrib(file_path, name='check_eval_t{}'.format(self.t), masks=False, examples=self.K)
 
-        return accum_score
+        f = open(file_path + '/actions_last_iter_t{}'.format(self.t), 'w')
+        sorted = expected_distance.argsort()
+        for i in range(actions.shape[0]):
+            f.write('index: {0}, score: {1}, rank: {2}'.format(i, expected_distance[i], np.where(sorted == i)[0][0]))
+            f.write('action {}\n'.format(actions[i]))
 
     def check_conversion(self):
         # check conversion
-        img_string, width, height = self.viewer.get_image()
-        img = np.fromstring(img_string, dtype='uint8').reshape(
-            (height, width, 3))[::-1, :, :]
+        img = np.array(self.viewer.render())
 
         refpoint = self.model.data.site_xpos[0, :2]
         refpoint = self.mujoco_to_imagespace(refpoint, numpix=480)
@@ -546,11 +515,12 @@ class CEM_controller(Policy):
                 print 'using actions of first plan, no replanning!!'
                 if t == 1:
                     self.perform_CEM(last_images, last_states, last_action, t)
-                else:
-                    # only showing last iteration
-                    self.pred_pos = self.pred_pos[:,-1].reshape((self.M, 1, self.repeat * self.nactions, 2))
-                    self.rec_target_pos = self.rec_target_pos[:, -1].reshape((self.M, 1, self.repeat * self.nactions, 2))
-                    self.bestindices_of_iter = self.bestindices_of_iter[-1, :].reshape((1, self.K))
+                elif t == 2:
+                    # only showing the last iteration of the first plan
+                    last_itr = self.iterations_used[-1] - 1
+                    self.pred_pos = self.pred_pos[:, last_itr:last_itr + 1]
+                    self.rec_target_pos = self.rec_target_pos[:, last_itr:last_itr + 1]
+                    self.bestindices_of_iter = self.bestindices_of_iter[last_itr:last_itr + 1]
                 action = self.bestaction_withrepeat[t - 1]
 
             else:
@@ -573,32 +543,3 @@ class CEM_controller(Policy):
 
         return force, self.pred_pos, self.bestindices_of_iter, self.rec_target_pos
 
-
-def mujoco_to_imagespace(mujoco_coord, numpix = 64, truncate = False):
-    """
-    convert form Mujoco-Coord to numpix x numpix image space:
-    :param numpix: number of pixels of square image
-    :param mujoco_coord:
-    :return: pixel_coord
-    """
-    viewer_distance = .75  # distance from camera to the viewing plane
-    window_height = 2 * np.tan(75 / 2 / 180. * np.pi) * viewer_distance  # window height in Mujoco coords
-    pixelheight = window_height / numpix  # height of one pixel
-    pixelwidth = pixelheight
-    window_width = pixelwidth * numpix
-    middle_pixel = numpix / 2
-    pixel_coord = np.rint(np.array([-mujoco_coord[1], mujoco_coord[0]]) /
-                          pixelwidth + np.array([middle_pixel, middle_pixel]))
-    pixel_coord = pixel_coord.astype(int)
-
-    if truncate:
-        if np.any(pixel_coord < 0) or np.any(pixel_coord > numpix -1):
-            print '###################'
-            print 'designated pixel is outside the field!! Resetting it to be inside...'
-            print 'truncating...'
-            if np.any(pixel_coord < 0):
-                pixel_coord[pixel_coord < 0] = 0
-            if np.any(pixel_coord > numpix-1):
-                pixel_coord[pixel_coord > numpix-1]  = numpix-1
-
-    return pixel_coord
\ No newline at end of file
@@ -8,6 +8,13 @@ import cPickle
 from datetime import datetime
 
 from python_visual_mpc.video_prediction.utils_vpred.create_gif_lib import *
+from python_visual_mpc.visual_mpc_core.algorithm.cem_scoring import get_tstep_weights, calc_expected_distance, \
+    context_kwargs
+from python_visual_mpc.visual_mpc_core.algorithm.distance_fields import get_distance_field
+from python_visual_mpc.video_prediction.predictor_server import require_outputs
+from python_visual_mpc.visual_mpc_core.algorithm.action_processing import ActionPostprocessor, action_cost
+from python_visual_mpc.visual_mpc_core.algorithm.cem_sampling import make_sampler, warm_start, warm_iterations, \
+    CEMTermination
 
 from PIL import Image
 import pdb
@@ -44,11 +51,15 @@ class CEM_controller():
             self.netconf = hyperparams.configuration
             self.M = self.netconf['batch_size']
             assert self.naction_steps * self.repeat == self.netconf['sequence_length']
+            self.tstep_weights = get_tstep_weights(self.policyparams, self.netconf['sequence_length'] - 1)
         else:
             self.netconf = {}
             self.M = 1
 
         self.predictor = predictor
+        # a predictor server only sends the images back if they are needed
+        if self.verbose or 'store_video_prediction' in self.agentparams:
+            require_outputs(self.predictor, ['gen_images'])
 
         self.K = 10  # only consider K best samples for refitting
 
@@ -61,6 +72,19 @@ class CEM_controller():
         self.adim = 4  # action dimensions: deltax, delty, close_nstep, hold_nstep
         self.initial_std = policyparams['initial_std']
 
+        # movements are clipped in units of meters, the gripper steps are integers in [0, 4]
+        if 'action_transforms' in self.policyparams:
+            transforms = self.policyparams['action_transforms']
+        else: transforms = [('discrete', [2, 3], 0, 4), ('clip', [0, 1], -.07, .07)]
+        self.postprocess = ActionPostprocessor(transforms, self.repeat)
+        self.sampler = make_sampler(self.policyparams, self.adim * self.naction_steps)
+        self.warmstart = 'warmstart' in self.policyparams
+        self.termination = CEMTermination(self.policyparams)
+        self.iterations_used = []  # number of CEM iterations of every MPC step
+        # (completed iterations, best score, best first action, propagated distribution of the best sample or None)
+        # of the running optimization, replaced after every iteration so that it can be read from other threads
+        self.plan_status = None
+
         # predicted positions
         self.pred_pos = np.zeros((self.M, self.niter, self.repeat * self.naction_steps, 2))
         self.rec_target_pos = np.zeros((self.M, self.niter, self.repeat * self.naction_steps, 2))
@@ -80,60 +104,39 @@ class CEM_controller():
         self.goal_image = None
 
     def calc_action_cost(self, actions):
-        actions_costs = np.zeros(self.M)
-        for smp in range(self.M):
-            force_magnitudes = np.array([np.linalg.norm(actions[smp, t]) for
-                                         t in range(self.naction_steps * self.repeat)])
-            actions_costs[smp]=np.sum(np.square(force_magnitudes)) * self.action_cost_factor
-        return actions_costs
-
-
-    def discretize(self, actions):
-        for b in range(self.M):
-            for a in range(self.naction_steps):
-                actions[b, a, 2] = np.floor(actions[b, a, 2])
-                if actions[b, a, 2] < 0:
-                    actions[b, a, 2] = 0
-                if actions[b, a, 2] > 4:
-                    actions[b, a, 2] = 4
-
-                actions[b, a, 3] = np.floor(actions[b, a, 3])
-                if actions[b, a, 3] < 0:
-                    actions[b, a, 3] = 0
-                if actions[b, a, 3] > 4:
-                    actions[b, a, 3] = 4
-        return actions
-
-    def truncate_movement(self, actions):
-        actions[:,:,:2] = np.clip(actions[:,:,:2], -.07, .07)  # clip in units of meters
-        return actions
+        return action_cost(actions, self.action_cost_factor)
 
     def perform_CEM(self,last_frames, last_states, t):
-        # initialize mean and variance
-        self.mean = np.zeros(self.adim * self.naction_steps)
-        #initialize mean and variance of the discrete actions to their mean and variance used during data collection
-        self.sigma = np.diag(np.ones(self.adim * self.naction_steps) * self.initial_std ** 2)
-        # reducing the variance for goup and close actiondims
-        diagonal = copy.deepcopy(np.diag(self.sigma))
-        diagonal[2::4] = 1
-        diagonal[3::4] = 1
-        self.sigma[np.diag_indices_from(self.sigma)] = diagonal
-
+        # variance of a single action, for the discrete actions the variance used during data collection
+        action_var = np.array([self.initial_std ** 2, self.initial_std ** 2, 1, 1])
+
+        if self.warmstart and t > 1:
+            print 'reusing mean and covariance from last MPC step...'
+            # every action of the plan covers repeat steps, the plan of step 1 starts with a whole action
+            warm_start(self.sampler, self.policyparams, self.adim, np.zeros(self.adim), action_var, self.initial_std,
+                       shift=(t - 1) % self.repeat == 0)
+            self.mean, self.sigma = self.sampler.mean, self.sampler.sigma
+            niter = warm_iterations(self.policyparams, self.niter)
+        else:
+            # initialize mean and variance
+            self.mean = np.zeros(self.adim * self.naction_steps)
+            self.sigma = np.diag(np.tile(action_var, self.naction_steps))
+            self.sampler.set(self.mean, self.sigma)
+            niter = self.niter
 
         print '------------------------------------------------'
         print 'starting CEM cylce'
+        self.plan_status = None
+        self.termination.start()
 
-        for itr in range(self.niter):
+        for itr in range(niter):
             print '------------'
             print 'iteration: ', itr
             t_startiter = datetime.now()
 
-            actions = np.random.multivariate_normal(self.mean, self.sigma, self.M)
+            actions = self.sampler.sample(self.M)
             actions = actions.reshape(self.M, self.naction_steps, self.adim)
-            actions = self.discretize(actions)
-            actions = self.truncate_movement(actions)
-
-            actions = np.repeat(actions, self.repeat, axis=1)
+            actions = self.postprocess(actions)
 
             if 'random_policy' in self.policyparams:
                 print 'sampling random actions'
@@ -166,8 +169,8 @@ class CEM_controller():
             # print 'bestaction:', self.bestaction
 
             arr_best_actions = actions_flat[self.indices]  # only take the K best actions
-            self.sigma = np.cov(arr_best_actions, rowvar= False, bias= False)
-            self.mean = np.mean(arr_best_actions, axis= 0)
+            self.sampler.fit(arr_best_actions)
+            self.mean, self.sigma = self.sampler.mean, self.sampler.sigma
 
             print 'iter {0}, bestscore {1}'.format(itr, scores[self.indices[0]])
             print 'action cost of best action: ', actioncosts[self.indices[0]]
@@ -175,10 +178,47 @@ class CEM_controller():
             print 'overall time for iteration {}'.format(
                 (datetime.now() - t_startiter).seconds + (datetime.now() - t_startiter).microseconds / 1e6)
 
+            if 'predictor_propagation' in self.policyparams:
+                prop_distrib = self.best_prop_distrib
+            else: prop_distrib = None
+            self.plan_status = (itr + 1, scores[self.indices[0]], self.bestaction[0].copy(), prop_distrib)
+
+            if self.termination.done(itr, scores[self.indices], self.sampler):
+                print 'stopping CEM after iteration {}: {}'.format(itr, self.termination.reason)
+                break
+        self.iterations_used.append(itr + 1)
+        self.record_last_iteration(itr)
+
+    def record_last_iteration(self, itr):
+        """
+        records the predictions of the best sample of the last CEM iteration, which is only known after the
+        termination check, the scoring functions keep them of every iteration
+        """
+        if 'predictor_propagation' in self.policyparams:
+            if 'ndesig' in self.policyparams:
+                self.rec_input_distrib1.append(self.best_prop_distrib[0])
+                self.rec_input_distrib2.append(self.best_prop_distrib[1])
+            else:
+                self.rec_input_distrib.append(self.best_prop_distrib)
+        # ray_video_pred only returns the best distribution, there are no predictions to save
+        if self.verbose and 'multmachine' not in self.policyparams:
+            best_gen_images, best_gen_distrib1, best_gen_distrib2 = self.best_predictions
+            self.save_verbose(best_gen_images, best_gen_distrib1, best_gen_distrib2, itr)
+
+    def replace_last_record(self, prop_distrib):
+        """
+        replaces the propagated distribution recorded for the last MPC step, e.g. by the one of the plan status
+        which was executed when the optimization was stopped at a deadline
+        """
+        if 'ndesig' in self.policyparams:
+            self.rec_input_distrib1[-1], self.rec_input_distrib2[-1] = prop_distrib
+        else:
+            self.rec_input_distrib[-1] = prop_distrib
+
     def switch_on_pix(self, desig):
-        one_hot_images = np.zeros((self.netconf['batch_size'], self.netconf['context_frames'], 64, 64, 1), dtype=np.float32)
+        one_hot_images = np.zeros((self.netconf['context_frames'], 64, 64, 1), dtype=np.float32)
         # switch on pixels
-        one_hot_images[:, :, desig[0], desig[1]] = 1
+        one_hot_images[:, desig[0], desig[1]] = 1
         print 'using desig pix',desig[0], desig[1]
 
         return one_hot_images
@@ -194,8 +234,6 @@ class CEM_controller():
     def ray_video_pred(self, last_frames, last_states, actions, itr):
         input_distrib = self.make_input_distrib(itr)
 
-        input_distrib = input_distrib[0]
-
         best_gen_distrib, scores = self.predictor(input_images=last_frames,
                                                   input_states=last_states,
                                                   input_actions=actions,
@@ -204,25 +242,15 @@ class CEM_controller():
 
         if 'predictor_propagation' in self.policyparams:
             # for predictor_propagation only!!
-            if itr == (self.policyparams['iterations'] - 1):
-                self.rec_input_distrib.append(np.repeat(best_gen_distrib, self.netconf['batch_size'], 0))
+            self.best_prop_distrib = best_gen_distrib
 
         return scores
 
     def video_pred(self, last_frames, last_states, actions, itr):
-
-        last_states = np.expand_dims(last_states, axis=0)
-        last_states = np.repeat(last_states, self.netconf['batch_size'], axis=0)
-
-        if 'single_view' in self.netconf:
-            img_channels = 3
-        else: img_channels = 6
-        last_frames = np.expand_dims(last_frames, axis=0)
-        last_frames = np.repeat(last_frames, self.netconf['batch_size'], axis=0)
-        app_zeros = np.zeros(shape=(self.netconf['batch_size'], self.netconf['sequence_length']-
-                                    self.netconf['context_frames'], 64, 64, img_channels))
-        last_frames = np.concatenate((last_frames, app_zeros), axis=1)
-        last_frames = last_frames.astype(np.float32)/255.
+        # the uint8 context frames, states and input distributions are passed unbatched,
+        # the predictor broadcasts them to all samples
+        if 'score_in_graph' in self.netconf:
+            return self.video_pred_score_in_graph(last_frames, last_states, actions, itr)
 
         if 'ndesig' in self.policyparams:
             input_distrib1, input_distrib2 = self.make_input_distrib(itr)
@@ -230,10 +258,10 @@ class CEM_controller():
                                                                                 input_state=last_states,
                                                                                 input_actions=actions,
                                                                                 input_one_hot_images1=input_distrib1,
-                                                                                input_one_hot_images2=input_distrib2)
+                                                                                input_one_hot_images2=input_distrib2,
+                                                                                **context_kwargs(self.netconf, itr))
 
-            distance_grid1 = self.get_distancegrid(self.goal_pix[0])
-            distance_grid2 = self.get_distancegrid(self.goal_pix[1])
+            distance_grid1, distance_grid2 = self.get_distancegrid(self.goal_pix)
 
             _, scores1 = self.calc_scores(gen_distrib1, distance_grid1)
             print 'best score1', np.min(scores1)
@@ -249,7 +277,8 @@ class CEM_controller():
             gen_images, gen_distrib, _, gen_states, _ = self.predictor(input_images=last_frames,
                                                                     input_state=last_states,
                                                                     input_actions=actions,
-                                                                    input_one_hot_images1=input_distrib)
+                                                                    input_one_hot_images1=input_distrib,
+                                                                    **context_kwargs(self.netconf, itr))
 
             distance_grid = self.get_distancegrid(self.goal_pix[0])
             if 'singlepoint_prob_eval' in self.policyparams:
@@ -257,39 +286,21 @@ class CEM_controller():
             else:
                 desig_pix_cost, scores = self.calc_scores(gen_distrib, distance_grid)
 
+        # kept for every iteration, record_last_iteration uses the ones of the last iteration
+        bestindices = scores.argsort()[:self.K]
+        bestind = bestindices[0]
+
         # for predictor_propagation only!!
         if 'predictor_propagation' in self.policyparams:
             assert not 'correctorconf' in self.policyparams
-            if itr == (self.policyparams['iterations'] - 1):
-                if 'ndesig' in self.policyparams:
-                    # pick the prop distrib from the action actually chosen after the last iteration (i.e. self.indices[0])
-                    bestind = scores.argsort()[0]
-                    best_gen_distrib1 = gen_distrib1[2][bestind].reshape(1, 64, 64, 1)
-                    self.rec_input_distrib1.append(np.repeat(best_gen_distrib1, self.netconf['batch_size'], 0))
-
-                    # pick the prop distrib from the action actually chosen after the last iteration (i.e. self.indices[0])
-                    best_gen_distrib2 = gen_distrib2[2][bestind].reshape(1, 64, 64, 1)
-                    self.rec_input_distrib2.append(np.repeat(best_gen_distrib2, self.netconf['batch_size'], 0))
-                else:
-                    # pick the prop distrib from the action actually chosen after the last iteration (i.e. self.indices[0])
-                    bestind = scores.argsort()[0]
-                    best_gen_distrib = gen_distrib[2][bestind].reshape(1, 64, 64, 1)
-                    self.rec_input_distrib.append(np.repeat(best_gen_distrib, self.netconf['batch_size'], 0))
-
-        bestindices = scores.argsort()[:self.K]
-
-
-        if self.verbose and itr == self.policyparams['iterations']-1:
-            # print 'creating visuals for best sampled actions at last iteration...'
-            if self.save_subdir != None:
-                file_path = self.netconf['current_dir']+ '/'+ self.save_subdir +'/verbose'
+            # pick the prop distrib from the action actually chosen after the last iteration (i.e. self.indices[0])
+            if 'ndesig' in self.policyparams:
+                self.best_prop_distrib = (gen_distrib1[2][bestind].reshape(1, 64, 64, 1),
+                                          gen_distrib2[2][bestind].reshape(1, 64, 64, 1))
             else:
-                file_path = self.netconf['current_dir'] + '/verbose'
-
-
-            if not os.path.exists(file_path):
-                os.makedirs(file_path)
+                self.best_prop_distrib = gen_distrib[2][bestind].reshape(1, 64, 64, 1)
 
+        if self.verbose:
             def best(inputlist):
                 outputlist = [np.zeros_like(a)[:self.K] for a in inputlist]
                 for ind in range(self.K):
@@ -297,60 +308,87 @@ class CEM_controller():
                         outputlist[tstep][ind] = inputlist[tstep][bestindices[ind]]
                 return outputlist
 
+            if 'ndesig' in self.policyparams:
+                self.best_predictions = (best(gen_images), best(gen_distrib1), best(gen_distrib2))
+            else:
+                self.best_predictions = (best(gen_images), best(gen_distrib), None)
+
+        if 'store_video_prediction' in self.agentparams:
+            self.terminal_pred = gen_images[-1][bestind].copy()
+
+        return scores
+
+    def save_verbose(self, best_gen_images, best_gen_distrib1, best_gen_distrib2, itr):
+        """
+        write the predictions of the K best samples
+        """
+        # print 'creating visuals for best sampled actions at last iteration...'
+        if self.save_subdir != None:
+            file_path = self.netconf['current_dir']+ '/'+ self.save_subdir +'/verbose'
+        else:
+            file_path = self.netconf['current_dir'] + '/verbose'
 
-            cPickle.dump(best(gen_images), open(file_path + '/gen_image_t{}.pkl'.format(self.t), 'wb'))
+        if not os.path.exists(file_path):
+            os.makedirs(file_path)
 
+        cPickle.dump(best_gen_images, open(file_path + '/gen_image_t{}.pkl'.format(self.t), 'wb'))
+
+        if 'ndesig' in self.policyparams:
+            cPickle.dump(best_gen_distrib1, open(file_path + '/gen_distrib1_t{}.pkl'.format(self.t), 'wb'))
+            cPickle.dump(best_gen_distrib2, open(file_path + '/gen_distrib2_t{}.pkl'.format(self.t), 'wb'))
+        else:
+            cPickle.dump(best_gen_distrib1, open(file_path + '/gen_distrib_t{}.pkl'.format(self.t), 'wb'))
+
+        print 'written files to:' + file_path
+        if not 'no_instant_gif' in self.policyparams:
+            create_video_pixdistrib_gif(file_path, self.netconf, t=self.t, n_exp=10,
+                                        suppress_number=True, suffix='iter{}_t{}'.format(itr, self.t))
+
+    def video_pred_score_in_graph(self, last_frames, last_states, actions, itr):
+        """
+        the predictor computes the scores inside the graph and only returns the predictions of the best samples
+        """
+        pred_kwargs = context_kwargs(self.netconf, itr)
+        if 'ndesig' in self.policyparams:
+            input_distrib1, pred_kwargs['input_one_hot_images2'] = self.make_input_distrib(itr)
+            distance_grids = self.get_distancegrid(self.goal_pix)
+        else:
+            input_distrib1 = self.make_input_distrib(itr)
+            distance_grids = self.get_distancegrid(self.goal_pix[:1])
+
+        scores, bestindices, best_gen_images, best_gen_distrib1, best_gen_distrib2 = self.predictor(
+                                                                        input_images=last_frames,
+                                                                        input_state=last_states,
+                                                                        input_actions=actions,
+                                                                        input_one_hot_images1=input_distrib1,
+                                                                        distance_grids=distance_grids,
+                                                                        tstep_weights=self.tstep_weights,
+                                                                        **pred_kwargs)
+
+        # kept for every iteration, record_last_iteration uses the ones of the last iteration
+        if 'predictor_propagation' in self.policyparams:
+            # best_gen_distrib are sorted, index 0 is the action actually chosen after the last iteration
             if 'ndesig' in self.policyparams:
-                cPickle.dump(best(gen_distrib1), open(file_path + '/gen_distrib1_t{}.pkl'.format(self.t), 'wb'))
-                cPickle.dump(best(gen_distrib2), open(file_path + '/gen_distrib2_t{}.pkl'.format(self.t), 'wb'))
+                self.best_prop_distrib = (best_gen_distrib1[2][0].reshape(1, 64, 64, 1),
+                                          best_gen_distrib2[2][0].reshape(1, 64, 64, 1))
             else:
-                cPickle.dump(best(gen_distrib), open(file_path + '/gen_distrib_t{}.pkl'.format(self.t), 'wb'))
+                self.best_prop_distrib = best_gen_distrib1[2][0].reshape(1, 64, 64, 1)
 
-            print 'written files to:' + file_path
-            if not 'no_instant_gif' in self.policyparams:
-                create_video_pixdistrib_gif(file_path, self.netconf, t=self.t, n_exp=10,
-                                            suppress_number=True, suffix='iter{}_t{}'.format(itr, self.t))
+        if self.verbose:
+            self.best_predictions = (best_gen_images, best_gen_distrib1, best_gen_distrib2)
 
-        bestindex = scores.argsort()[0]
-        if 'store_video_prediction' in self.agentparams and\
-                itr == (self.policyparams['iterations']-1):
-            self.terminal_pred = gen_images[-1][bestindex]
+        if 'store_video_prediction' in self.agentparams:
+            self.terminal_pred = best_gen_images[-1][0]
 
         return scores
 
     def calc_scores(self, gen_distrib, distance_grid):
-        expected_distance = np.zeros(self.netconf['batch_size'])
         desig_pix_cost = np.zeros(self.netconf['batch_size'])
-        if 'rew_all_steps' in self.policyparams:
-            for tstep in range(self.netconf['sequence_length'] - 1):
-                t_mult = 1
-                if 'finalweight' in self.policyparams:
-                    if tstep == self.netconf['sequence_length'] - 2:
-                        t_mult = self.policyparams['finalweight']
-
-                for b in range(self.netconf['batch_size']):
-                    gen = gen_distrib[tstep][b].squeeze() / np.sum(gen_distrib[tstep][b])
-                    expected_distance[b] += np.sum(np.multiply(gen, distance_grid)) * t_mult
-            scores = expected_distance
-        else:
-            for b in range(self.netconf['batch_size']):
-                gen = gen_distrib[-1][b].squeeze() / np.sum(gen_distrib[-1][b])
-                expected_distance[b] = np.sum(np.multiply(gen, distance_grid))
-            scores = expected_distance
+        scores = calc_expected_distance(gen_distrib, distance_grid, self.tstep_weights)
         return desig_pix_cost, scores
 
     def get_distancegrid(self, goal_pix):
-        distance_grid = np.empty((64, 64))
-        for i in range(64):
-            for j in range(64):
-                pos = np.array([i, j])
-                distance_grid[i, j] = np.linalg.norm(goal_pix - pos)
-
-        print 'making distance grid with goal_pix', goal_pix
-        # plt.imshow(distance_grid, zorder=0, cmap=plt.get_cmap('jet'), interpolation='none')
-        # plt.show()
-        # pdb.set_trace()
-        return distance_grid
+        return get_distance_field(goal_pix, self.policyparams)
 
     def make_input_distrib(self, itr):
         if 'ndesig' in self.policyparams:
@@ -372,11 +410,9 @@ class CEM_controller():
         if self.t < self.netconf['context_frames']:
             input_distrib = self.switch_on_pix(desig)
             if itr == 0:
-                rec_input_distrib.append(input_distrib[:, 1])
+                rec_input_distrib.append(input_distrib[1:2])
         else:
-            input_distrib = [rec_input_distrib[-2], rec_input_distrib[-1]]
-            input_distrib = [np.expand_dims(elem, axis=1) for elem in input_distrib]
-            input_distrib = np.concatenate(input_distrib, axis=1)
+            input_distrib = np.concatenate([rec_input_distrib[-2], rec_input_distrib[-1]], axis=0)
         return input_distrib
 
     def act(self, traj, t, desig_pix = None, goal_pix= None):
@@ -403,10 +439,11 @@ class CEM_controller():
                 print 'using actions of first plan, no replanning!!'
                 if t == 1:
                     self.perform_CEM(last_images, last_states, t)
-                else:
-                    # only showing last iteration
-                    self.pred_pos = self.pred_pos[:,-1].reshape((self.M, 1, self.repeat * self.naction_steps, 2))
-                    self.bestindices_of_iter = self.bestindices_of_iter[-1, :].reshape((1, self.K))
+                elif t == 2:
+                    # only showing the last iteration of the first plan
+                    last_itr = self.iterations_used[-1] - 1
+                    self.pred_pos = self.pred_pos[:, last_itr:last_itr + 1]
+                    self.bestindices_of_iter = self.bestindices_of_iter[last_itr:last_itr + 1]
                 action = self.bestaction_withrepeat[t - 1]
 
             else:
@@ -0,0 +1,243 @@
+""" Gaussian sampling distributions of the CEM controllers with selectable covariance models. """
+import time
+import numpy as np
+
+
+class CEMSampler(object):
+    """
+    mean and covariance of the flattened action sequences, nactions*adim dimensions
+
+    cov_model:
+    'full'    : full covariance, optionally shrunk towards its diagonal, sampled with a cached Cholesky factor
+    'diag'    : independent dimensions
+    'lowrank' : rank r factor plus diagonal, W W^T + diag(d), sampling costs O(D*r) per sample
+    """
+    def __init__(self, dim, cov_model='full', shrinkage=0., rank=2, min_var=1e-6):
+        if cov_model not in ['full', 'diag', 'lowrank']:
+            raise ValueError('unknown covariance model {}'.format(cov_model))
+        self.dim = dim
+        self.cov_model = cov_model
+        self.shrinkage = shrinkage
+        self.rank = rank
+        self.min_var = min_var
+
+        self.mean = np.zeros(dim)
+        self.var = np.ones(dim)  # diagonal part
+        self.factor = np.zeros((dim, 0))  # low-rank part
+        self._chol = None
+        self._sigma = None
+
+        self.elites = None  # elites of the last refit
+        self.injected = None  # samples returned by the next call of sample
+
+    def set(self, mean, sigma):
+        """
+        :param sigma: D x D covariance matrix
+        """
+        self.mean = np.asarray(mean, dtype=np.float64)
+        sigma = np.asarray(sigma, dtype=np.float64)
+        if self.cov_model == 'diag':
+            self.var = np.maximum(np.diag(sigma), self.min_var)
+        elif self.cov_model == 'lowrank':
+            self._set_lowrank(sigma)
+        else:
+            self._sigma = sigma
+        self._chol = None
+
+    def _set_lowrank(self, sigma):
+        eigval, eigvec = np.linalg.eigh(sigma)
+        top = eigval.argsort()[::-1][:self.rank]
+        top = top[eigval[top] > self.min_var]
+        self.factor = eigvec[:, top] * np.sqrt(eigval[top])
+        self.var = np.maximum(np.diag(sigma) - np.sum(self.factor**2, axis=1), self.min_var)
+
+    @property
+    def sigma(self):
+        """
+        the covariance as a full matrix
+        """
+        if self.cov_model == 'full':
+            return self._sigma
+        return np.dot(self.factor, self.factor.T) + np.diag(self.var)
+
+    def trace(self):
+        """
+        total variance of the distribution
+        """
+        if self.cov_model == 'full':
+            return np.trace(self._sigma)
+        return np.sum(self.var) + np.sum(self.factor**2)
+
+    def cholesky(self):
+        if self._chol is None:
+            self._chol = np.linalg.cholesky(self._sigma + self.min_var * np.eye(self.dim))
+        return self._chol
+
+    def sample(self, nsamples):
+        """
+        :return: nsamples x D
+        """
+        noise = np.random.standard_normal((nsamples, self.dim))
+        if self.cov_model == 'full':
+            samples = self.mean + np.dot(noise, self.cholesky().T)
+        else:
+            samples = self.mean + noise * np.sqrt(self.var)
+            if self.factor.shape[1] > 0:
+                samples += np.dot(np.random.standard_normal((nsamples, self.factor.shape[1])), self.factor.T)
+        if self.injected is not None:
+            n = min(len(self.injected), nsamples)
+            samples[:n] = self.injected[:n]
+            self.injected = None
+        return samples
+
+    def fit(self, elites):
+        """
+        refits mean and covariance to the elite samples, K x D
+        """
+        self.elites = elites
+        self.mean = np.mean(elites, axis=0)
+        centered = elites - self.mean
+        nelites = max(elites.shape[0] - 1, 1)
+        if self.cov_model == 'diag':
+            self.var = np.maximum(np.sum(centered**2, axis=0) / nelites, self.min_var)
+        elif self.cov_model == 'lowrank':
+            # principal directions of the elites from the thin svd, K x D instead of a D x D eigendecomposition
+            _, s, vt = np.linalg.svd(centered / np.sqrt(nelites), full_matrices=False)
+            r = min(self.rank, len(s))
+            self.factor = vt[:r].T * s[:r]
+            self.var = np.maximum(np.sum(centered**2, axis=0) / nelites - np.sum(self.factor**2, axis=1),
+                                  self.min_var)
+        else:
+            sigma = np.dot(centered.T, centered) / nelites
+            if self.shrinkage > 0:
+                sigma = (1 - self.shrinkage) * sigma + self.shrinkage * np.diag(np.diag(sigma))
+            self._sigma = sigma
+        self._chol = None
+
+    def shift(self, step_dim, tail_mean, tail_var, added_var=0., ninject=0):
+        """
+        warm start for the next MPC step: drops the first action of the distribution and appends
+        a new last action with mean tail_mean and variance tail_var (both of length step_dim)
+        :param added_var: variance added to the shifted dimensions, so the search does not collapse
+        :param ninject: number of the previous elites which are shifted the same way and
+        returned by the next call of sample
+        """
+        keep = self.dim - step_dim
+        mean = np.empty(self.dim)
+        mean[:keep] = self.mean[step_dim:]
+        mean[keep:] = tail_mean
+        self.mean = mean
+
+        if self.cov_model == 'full':
+            sigma = np.zeros((self.dim, self.dim))
+            sigma[:keep, :keep] = self._sigma[step_dim:, step_dim:] + added_var * np.eye(keep)
+            sigma[keep:, keep:] = np.diag(tail_var)
+            self._sigma = sigma
+        else:
+            var = np.empty(self.dim)
+            var[:keep] = self.var[step_dim:] + added_var
+            var[keep:] = tail_var
+            self.var = var
+            factor = np.zeros_like(self.factor)
+            factor[:keep] = self.factor[step_dim:]
+            self.factor = factor
+        self._chol = None
+
+        if ninject > 0 and self.elites is not None:
+            elites = self.elites[:ninject]
+            injected = np.empty((len(elites), self.dim))
+            injected[:, :keep] = elites[:, step_dim:]
+            injected[:, keep:] = tail_mean + np.sqrt(tail_var) * np.random.standard_normal((len(elites), step_dim))
+            self.injected = injected
+
+
+def make_sampler(policyparams, dim):
+    """
+    :param policyparams: uses 'cov_model', 'cov_shrinkage' and 'cov_rank'
+    """
+    kwargs = {}
+    if 'cov_model' in policyparams:
+        kwargs['cov_model'] = policyparams['cov_model']
+    if 'cov_shrinkage' in policyparams:
+        kwargs['shrinkage'] = policyparams['cov_shrinkage']
+    if 'cov_rank' in policyparams:
+        kwargs['rank'] = policyparams['cov_rank']
+    return CEMSampler(dim, **kwargs)
+
+
+def warm_start(sampler, policyparams, step_dim, tail_mean, tail_var, initial_std, shift=True):
+    """
+    shifts the distribution of the last MPC step by one action
+    :param policyparams: uses 'warmstart_std', the std added to the shifted actions, default initial_std/5,
+    and 'warmstart_elites', the number of previous elites which are sampled again, default 0
+    :param shift: False when the first action of the last plan is still being executed, e.g. with repeat > 1
+    between two action boundaries, then the distribution is only widened
+    """
+    if not shift:
+        step_dim, tail_mean, tail_var = 0, tail_mean[:0], tail_var[:0]
+    if 'warmstart_std' in policyparams:
+        added_std = policyparams['warmstart_std']
+    else: added_std = initial_std / 5.
+    if 'warmstart_elites' in policyparams:
+        ninject = policyparams['warmstart_elites']
+    else: ninject = 0
+    sampler.shift(step_dim, tail_mean, tail_var, added_std ** 2, ninject)
+
+
+def warm_iterations(policyparams, niter):
+    """
+    :return: number of CEM iterations once warm started, 'warmstart_iterations' or niter
+    """
+    if 'warmstart_iterations' in policyparams:
+        return min(policyparams['warmstart_iterations'], niter)
+    return niter
+
+
+class CEMTermination(object):
+    """
+    convergence criteria of one CEM optimization, the policyparams used are
+    'term_score_improvement' : stop when the mean elite score improved by less than this
+    'term_cov_trace'         : stop when the trace of the covariance is below this
+    'plan_deadline'          : seconds per MPC step, stop when the next iteration would not finish in time
+    stop() ends the optimization after the running iteration, e.g. from another thread
+    """
+    def __init__(self, policyparams):
+        if 'term_score_improvement' in policyparams:
+            self.min_improvement = policyparams['term_score_improvement']
+        else: self.min_improvement = None
+        if 'term_cov_trace' in policyparams:
+            self.min_trace = policyparams['term_cov_trace']
+        else: self.min_trace = None
+        if 'plan_deadline' in policyparams:
+            self.deadline = policyparams['plan_deadline']
+        else: self.deadline = None
+        self.stop_requested = False
+
+    def start(self):
+        self.t_start = time.time()
+        self.last_score = None
+        self.reason = None
+        self.stop_requested = False
+
+    def stop(self):
+        self.stop_requested = True
+
+    def done(self, itr, elite_scores, sampler):
+        """
+        called after the refit of iteration itr
+        :return: True if no further iteration shall be run
+        """
+        elite_score = np.mean(elite_scores)
+        if self.stop_requested:
+            self.reason = 'stop requested'
+        elif self.min_improvement is not None and self.last_score is not None \
+                and self.last_score - elite_score < self.min_improvement:
+            self.reason = 'elite score improvement {}'.format(self.last_score - elite_score)
+        elif self.min_trace is not None and sampler.trace() < self.min_trace:
+            self.reason = 'covariance trace {}'.format(sampler.trace())
+        elif self.deadline is not None:
+            elapsed = time.time() - self.t_start
+            if elapsed + elapsed / (itr + 1) > self.deadline:
+                self.reason = 'deadline, {:.2f} s elapsed'.format(elapsed)
+        self.last_score = elite_score
+        return self.reason is not None
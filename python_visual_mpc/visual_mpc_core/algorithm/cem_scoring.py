@@ -0,0 +1,62 @@
+""" Batched scoring of predicted pixel distributions for the CEM controllers. """
+import numpy as np
+
+
+def get_tstep_weights(policyparams, n_tsteps):
+    """
+    weighting of the expected distance at each predicted timestep
+    :param policyparams: uses 'rew_all_steps' and 'finalweight'
+    :param n_tsteps: number of predicted timesteps (sequence_length - 1)
+    :return: weight vector of length n_tsteps
+    """
+    tstep_weights = np.zeros(n_tsteps)
+    if 'rew_all_steps' in policyparams:
+        tstep_weights[:] = 1.
+        if 'finalweight' in policyparams:
+            tstep_weights[-1] = policyparams['finalweight']
+    else:
+        tstep_weights[-1] = 1.
+    return tstep_weights
+
+
+def context_kwargs(netconf, itr):
+    """
+    with 'cache_context' the predictor encodes the context frames only at the first CEM iteration of an MPC step
+    :return: keyword arguments for the predictor call of CEM iteration itr
+    """
+    if 'cache_context' in netconf:
+        return {'encode_context': itr == 0}
+    return {}
+
+
+def stack_distrib(gen_distrib):
+    """
+    :param gen_distrib: list of T arrays of shape B x 64 x 64 (x 1) as returned by the predictor
+    :return: array T x B x 64 x 64
+    """
+    gen_distrib = np.stack(gen_distrib, axis=0)
+    if gen_distrib.ndim == 5:
+        gen_distrib = gen_distrib[..., 0]
+    return gen_distrib
+
+
+def calc_expected_distance(gen_distrib, distance_grid, tstep_weights):
+    """
+    computes the weighted sum over time of the expected distances for the whole batch at once
+    :param gen_distrib: list of T arrays B x 64 x 64 x 1 or a stacked array T x B x 64 x 64
+    :param distance_grid: 64 x 64 distances to the goal pixel
+    :param tstep_weights: weight vector of length T
+    :return: expected distances, length B
+    """
+    if not isinstance(gen_distrib, np.ndarray):
+        gen_distrib = stack_distrib(gen_distrib)
+
+    # skip timesteps which do not contribute to the score
+    used_t = np.nonzero(tstep_weights)[0]
+    gen_distrib = gen_distrib[used_t]
+
+    flat_distrib = gen_distrib.reshape(gen_distrib.shape[0], gen_distrib.shape[1], -1)
+    normalizer = np.sum(flat_distrib, axis=2)
+    expected_distance = np.dot(flat_distrib, distance_grid.reshape(-1)) / normalizer  # T x B
+
+    return np.dot(tstep_weights[used_t], expected_distance)
@@ -0,0 +1,123 @@
+""" Precomputed distance fields to the goal pixel, cached across CEM iterations and MPC steps. """
+import numpy as np
+import heapq
+from collections import OrderedDict
+
+
+def euclidean_field(goal_pix, resolution=64):
+    rows, cols = np.indices((resolution, resolution))
+    return np.sqrt((rows - goal_pix[0])**2 + (cols - goal_pix[1])**2)
+
+
+def obstacle_field(goal_pix, obstacle_mask):
+    """
+    geodesic distance to the goal pixel on the 8-connected pixel grid, not passing through obstacles
+    :param obstacle_mask: boolean array resolution x resolution, True where the pixel is blocked
+    :return: distance field, blocked and unreachable pixels get the largest finite distance
+    """
+    resolution = obstacle_mask.shape[0]
+    field = np.full((resolution, resolution), np.inf)
+    goal = (int(goal_pix[0]), int(goal_pix[1]))
+    field[goal] = 0.
+    neighbours = [(dr, dc, np.sqrt(dr**2 + dc**2)) for dr in (-1, 0, 1) for dc in (-1, 0, 1) if dr or dc]
+
+    heap = [(0., goal)]
+    while heap:
+        dist, (r, c) = heapq.heappop(heap)
+        if dist > field[r, c]:
+            continue
+        for dr, dc, step in neighbours:
+            nr, nc = r + dr, c + dc
+            if 0 <= nr < resolution and 0 <= nc < resolution and not obstacle_mask[nr, nc]:
+                if dist + step < field[nr, nc]:
+                    field[nr, nc] = dist + step
+                    heapq.heappush(heap, (dist + step, (nr, nc)))
+
+    field[np.isinf(field)] = np.max(field[np.isfinite(field)])
+    return field
+
+
+def make_distance_field(goal_pix, resolution=64, metric='euclidean', clip=None, obstacle_mask=None):
+    """
+    :param metric: one of 'euclidean', 'squared', 'clipped' or 'obstacle'
+    :param clip: maximum distance when using 'clipped'
+    :param obstacle_mask: resolution x resolution boolean mask when using 'obstacle'
+    :return: resolution x resolution array
+    """
+    if metric == 'euclidean':
+        return euclidean_field(goal_pix, resolution)
+    elif metric == 'squared':
+        return euclidean_field(goal_pix, resolution)**2
+    elif metric == 'clipped':
+        return np.minimum(euclidean_field(goal_pix, resolution), clip)
+    elif metric == 'obstacle':
+        assert obstacle_mask.shape == (resolution, resolution)
+        return obstacle_field(goal_pix, obstacle_mask)
+    else:
+        raise ValueError('unknown distance metric {}'.format(metric))
+
+
+class DistanceFieldCache(object):
+    """
+    LRU cache of distance fields keyed by (goal_pix, resolution, metric, metric options)
+    """
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self._fields = OrderedDict()
+
+    def _key(self, goal_pix, resolution, metric, clip, obstacle_mask):
+        if obstacle_mask is not None:
+            mask_key = hash(np.asarray(obstacle_mask, dtype=np.bool).tostring())
+        else: mask_key = None
+        return (int(goal_pix[0]), int(goal_pix[1]), resolution, metric, clip, mask_key)
+
+    def get(self, goal_pix, resolution=64, metric='euclidean', clip=None, obstacle_mask=None):
+        key = self._key(goal_pix, resolution, metric, clip, obstacle_mask)
+        if key in self._fields:
+            field = self._fields.pop(key)
+        else:
+            field = make_distance_field(goal_pix, resolution, metric, clip, obstacle_mask)
+            field.setflags(write=False)
+            if len(self._fields) >= self.maxsize:
+                self._fields.popitem(last=False)
+        self._fields[key] = field
+        return field
+
+    def get_stacked(self, goal_pix_list, resolution=64, metric='euclidean', clip=None, obstacle_mask=None):
+        """
+        :param goal_pix_list: ndesig x 2 goal pixels
+        :return: ndesig x resolution x resolution array
+        """
+        return np.stack([self.get(g, resolution, metric, clip, obstacle_mask) for g in goal_pix_list], axis=0)
+
+    def clear(self):
+        self._fields.clear()
+
+
+# shared by all controllers within one process, the goal pixel is fixed over a whole trajectory
+distance_field_cache = DistanceFieldCache()
+
+
+def get_distance_field(goal_pix, policyparams, resolution=64):
+    """
+    returns the cached distance field using the metric selected in policyparams:
+    'distance_metric' (default 'euclidean'), 'distance_clip' and 'obstacle_mask'
+    :param goal_pix: a single goal pixel, or ndesig x 2 goal pixels to get a stacked ndesig x res x res array
+    """
+    if 'distance_metric' in policyparams:
+        metric = policyparams['distance_metric']
+    else: metric = 'euclidean'
+
+    if 'distance_clip' in policyparams:
+        clip = policyparams['distance_clip']
+    else: clip = None
+    if metric == 'clipped' and clip is None:
+        raise ValueError("distance_metric 'clipped' requires 'distance_clip' in policyparams")
+
+    if 'obstacle_mask' in policyparams:
+        obstacle_mask = policyparams['obstacle_mask']
+    else: obstacle_mask = None
+
+    if np.asarray(goal_pix).ndim == 2:
+        return distance_field_cache.get_stacked(goal_pix, resolution, metric, clip, obstacle_mask)
+    return distance_field_cache.get(goal_pix, resolution, metric, clip, obstacle_mask)
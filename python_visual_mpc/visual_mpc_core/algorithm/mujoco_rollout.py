@@ -0,0 +1,180 @@
+""" Rollouts of sampled action sequences in MuJoCo, either serially or on a pool of model replicas. """
+import numpy as np
+import copy
+from multiprocessing import Pool
+import mujoco_py
+
+
+def reset_model(model, qpos, qvel):
+    """
+    resets the complete simulation state (including warmstart accelerations, ctrl and time)
+    so that a rollout only depends on qpos, qvel and the actions
+    """
+    model.resetData()
+    model.data.qpos = qpos
+    model.data.qvel = qvel
+
+
+def goal_distance(model, goal_point):
+    refpoint = model.data.site_xpos[0, :2]
+    return np.linalg.norm(goal_point - refpoint)
+
+
+def make_rollout_conf(agentparams, policyparams):
+    """
+    collects the parameters needed for a rollout, the result is sent to the pool workers
+    """
+    if 'goal_point' in agentparams:
+        goal_point = np.array(agentparams['goal_point'])
+    else: goal_point = None
+
+    return {'nactions': policyparams['nactions'],
+            'repeat': policyparams['repeat'],
+            'substeps': agentparams['substeps'],
+            'low_level_ctrl': policyparams['low_level_ctrl'],
+            'goal_point': goal_point,
+            'rew_all_steps': 'rew_all_steps' in policyparams}
+
+
+def rollout(model, qpos, qvel, actions, rollconf, step_callback=None):
+    """
+    simulates one action sequence starting from qpos, qvel
+    :param actions: nactions x adim
+    :param step_callback: called as step_callback(t) after every timestep, e.g. for rendering
+    :return: score, ball and low-level-controller target positions in 480x480 pixel space, T x 2 each
+    """
+    reset_model(model, qpos, qvel)
+    low_level_ctrl = rollconf['low_level_ctrl']
+    T = rollconf['nactions'] * rollconf['repeat']
+    ball_pix = np.zeros((T, 2), dtype=np.int64)
+    target_pix = np.zeros((T, 2), dtype=np.int64)
+
+    accum_score = 0
+    if low_level_ctrl:
+        rollout_ctrl = low_level_ctrl['type'](None, low_level_ctrl)
+        roll_target_pos = copy.deepcopy(np.asarray(qpos)[:2].squeeze())
+
+    for hstep in range(rollconf['nactions']):
+        currentaction = actions[hstep]
+
+        if low_level_ctrl:
+            roll_target_pos += currentaction
+
+        for r in range(rollconf['repeat']):
+            t = hstep*rollconf['repeat'] + r
+
+            ball_pix[t] = mujoco_to_imagespace(model.data.qpos[:2].squeeze(), numpix=480)
+            if low_level_ctrl:
+                target_pix[t] = mujoco_to_imagespace(roll_target_pos, numpix=480)
+
+            if low_level_ctrl == None:
+                force = currentaction
+            else:
+                force = rollout_ctrl.act(model.data.qpos[:2].squeeze(), model.data.qvel[:2].squeeze(),
+                                         None, t, roll_target_pos)
+
+            for _ in range(rollconf['substeps']):
+                model.data.ctrl = force
+                model.step()  # simulate the model in mujoco
+
+            accum_score += goal_distance(model, rollconf['goal_point'])
+
+            if step_callback is not None:
+                step_callback(t)
+
+    if rollconf['rew_all_steps']:
+        score = accum_score
+    else:
+        score = goal_distance(model, rollconf['goal_point'])
+
+    return score, ball_pix, target_pix
+
+
+def rollout_batch(model, qpos, qvel, actions, rollconf, step_callback=None):
+    """
+    :param actions: N x nactions x adim
+    :param step_callback: called as step_callback(smp, t)
+    :return: scores N, ball and target positions N x T x 2
+    """
+    T = rollconf['nactions'] * rollconf['repeat']
+    scores = np.empty(actions.shape[0], dtype=np.float64)
+    ball_pix = np.zeros((actions.shape[0], T, 2), dtype=np.int64)
+    target_pix = np.zeros((actions.shape[0], T, 2), dtype=np.int64)
+
+    for smp in range(actions.shape[0]):
+        if step_callback is not None:
+            smp_callback = lambda t: step_callback(smp, t)
+        else: smp_callback = None
+        scores[smp], ball_pix[smp], target_pix[smp] = rollout(model, qpos, qvel, actions[smp], rollconf,
+                                                              smp_callback)
+    return scores, ball_pix, target_pix
+
+
+# model replica of a pool worker process
+_worker_model = None
+
+
+def _init_worker(filename):
+    global _worker_model
+    _worker_model = mujoco_py.MjModel(filename)
+
+
+def _rollout_chunk(args):
+    qpos, qvel, actions, rollconf = args
+    return rollout_batch(_worker_model, qpos, qvel, actions, rollconf)
+
+
+class RolloutPool(object):
+    """
+    process pool in which every worker holds its own replica of the MuJoCo model,
+    a batch of action sequences is split into contiguous chunks, one per worker.
+    Since every rollout starts from a complete reset, the results are identical to rollout_batch
+    """
+    def __init__(self, filename, nworkers):
+        self.nworkers = nworkers
+        self.pool = Pool(nworkers, initializer=_init_worker, initargs=(filename,))
+
+    def rollout(self, qpos, qvel, actions, rollconf):
+        """
+        :return: scores N, ball and target positions N x T x 2, in the order of actions
+        """
+        qpos, qvel = np.array(qpos), np.array(qvel)
+        chunks = [c for c in np.array_split(np.arange(actions.shape[0]), self.nworkers) if c.size > 0]
+        results = self.pool.map(_rollout_chunk, [(qpos, qvel, actions[c], rollconf) for c in chunks])
+
+        scores, ball_pix, target_pix = zip(*results)
+        return np.concatenate(scores), np.concatenate(ball_pix), np.concatenate(target_pix)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+def mujoco_to_imagespace(mujoco_coord, numpix = 64, truncate = False):
+    """
+    convert form Mujoco-Coord to numpix x numpix image space:
+    :param numpix: number of pixels of square image
+    :param mujoco_coord:
+    :return: pixel_coord
+    """
+    viewer_distance = .75  # distance from camera to the viewing plane
+    window_height = 2 * np.tan(75 / 2 / 180. * np.pi) * viewer_distance  # window height in Mujoco coords
+    pixelheight = window_height / numpix  # height of one pixel
+    pixelwidth = pixelheight
+    window_width = pixelwidth * numpix
+    middle_pixel = numpix / 2
+    pixel_coord = np.rint(np.array([-mujoco_coord[1], mujoco_coord[0]]) /
+                          pixelwidth + np.array([middle_pixel, middle_pixel]))
+    pixel_coord = pixel_coord.astype(int)
+
+    if truncate:
+        if np.any(pixel_coord < 0) or np.any(pixel_coord > numpix -1):
+            print '###################'
+            print 'designated pixel is outside the field!! Resetting it to be inside...'
+            print 'truncating...'
+            if np.any(pixel_coord < 0):
+                pixel_coord[pixel_coord < 0] = 0
+            if np.any(pixel_coord > numpix-1):
+                pixel_coord[pixel_coord > numpix-1]  = numpix-1
+
+    return pixel_coord
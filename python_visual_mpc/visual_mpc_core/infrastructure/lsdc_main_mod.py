@@ -8,7 +8,6 @@ import imp
 import os
 import os.path
 import sys
-import copy
 import argparse
 import threading
 import time
@@ -56,7 +55,7 @@ class LSDCMain(object):
         else:
             self.policy = config['policy']['type'](config['agent'], config['policy'])
 
-        self.trajectory_list = []
+        self.writer = None
         self.im_score_list = []
 
         try:
@@ -64,11 +63,23 @@ class LSDCMain(object):
         except:
             pass
 
-    def run(self):
+    def run(self, start_index=None, end_index=None):
+        """
+        collects the trajectories start_index to end_index-1, by default the range given in the config
+        """
+        if start_index is None:
+            start_index = self._hyperparams['start_index']
+        if end_index is None:
+            end_index = self._hyperparams['end_index']
 
-        for i in range(self._hyperparams['start_index'],self._hyperparams['end_index']):
+        for i in range(start_index, end_index):
             self._take_sample(i)
 
+        # write the remaining trajectories which did not fill a whole file
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
 
     def _take_sample(self, sample_index):
         """
@@ -93,27 +104,24 @@ class LSDCMain(object):
 
     def save_data(self, traj, sample_index):
         """
-        saves all the images of a sample-trajectory in a separate dataset within the same hdf5-file
+        streams the sample trajectory to the tfrecords file which is currently written
         Args:
-            image_data: the numpy structure
+            traj: the sample trajectory, it is not modified after this call
             sample_index: sample number
         """
-        
-        traj = copy.deepcopy(traj)
-        self.trajectory_list.append(traj)
-        if 'traj_per_file' in self._hyperparams:
-            traj_per_file = self._hyperparams['traj_per_file']
-        else:
-            traj_per_file = 256
-        print 'traj_per_file', traj_per_file
-        if len(self.trajectory_list) == traj_per_file:
-            filename = 'traj_{0}_to_{1}'\
-                .format(sample_index - traj_per_file + 1, sample_index)
+        if self.writer is None:
+            if 'traj_per_file' in self._hyperparams:
+                traj_per_file = self._hyperparams['traj_per_file']
+            else:
+                traj_per_file = 256
+            if 'max_bytes_per_file' in self._hyperparams:
+                max_bytes = self._hyperparams['max_bytes_per_file']
+            else: max_bytes = None
 
-            from utility.save_tf_record import save_tf_record
-            save_tf_record(self._data_files_dir, filename, self.trajectory_list, self.agentparams)
+            from utility.save_tf_record import StreamingTFRecordWriter
+            self.writer = StreamingTFRecordWriter(self._data_files_dir, self.agentparams, traj_per_file, max_bytes)
 
-            self.trajectory_list = []
+        self.writer.write(traj, sample_index)
 
 
 def main():
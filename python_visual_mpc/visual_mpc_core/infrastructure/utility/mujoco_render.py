@@ -0,0 +1,96 @@
+""" Rendering of MuJoCo models into numpy arrays, with an offscreen mode for machines without a display. """
+import atexit
+import os
+import subprocess
+import time
+import numpy as np
+import mujoco_py
+
+# Xvfb process started by this module, shared by all renderers of the process
+_virtual_display = None
+
+
+def _stop_display():
+    if _virtual_display is not None and _virtual_display.poll() is None:
+        _virtual_display.terminate()
+        _virtual_display.wait()
+
+
+def _start_xvfb(display_num, timeout=10.):
+    """
+    :return: the Xvfb process once its socket exists, None if the display is taken
+    """
+    if os.path.exists('/tmp/.X{}-lock'.format(display_num)):
+        return None
+    process = subprocess.Popen(['Xvfb', ':{}'.format(display_num), '-screen', '0', '1024x768x24'],
+                               stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+    t_start = time.time()
+    while time.time() - t_start < timeout:
+        if process.poll() is not None:
+            return None  # another process took the display in the meantime
+        if os.path.exists('/tmp/.X11-unix/X{}'.format(display_num)):
+            return process
+        time.sleep(0.05)
+    process.terminate()
+    process.wait()
+    raise RuntimeError('Xvfb on :{} did not start within {} s'.format(display_num, timeout))
+
+
+def ensure_display(display_num=None, max_tries=20):
+    """
+    starts a virtual framebuffer X server when no DISPLAY is set, e.g. on headless cluster nodes.
+    Requires the Xvfb binary, the server is shared by all renderers of the process and terminated at exit.
+    """
+    global _virtual_display
+    if 'DISPLAY' in os.environ or _virtual_display is not None:
+        return
+    if display_num is None:
+        # one display per process, so that parallel data collection workers do not collide
+        display_num = 100 + os.getpid() % 10000
+    for num in range(display_num, display_num + max_tries):
+        _virtual_display = _start_xvfb(num)
+        if _virtual_display is not None:
+            break
+    else:
+        raise RuntimeError('no free X display in :{} to :{}'.format(display_num, display_num + max_tries - 1))
+    atexit.register(_stop_display)
+    print 'no DISPLAY set, started Xvfb on :{}'.format(num)
+    os.environ['DISPLAY'] = ':{}'.format(num)
+
+
+class MujocoRenderer(object):
+    """
+    Wraps a MjViewer of a fixed resolution.
+    With offscreen=True the window is hidden and frames are only rendered into the back buffer
+    and read back, without swapping buffers or polling window events
+    """
+    def __init__(self, width, height, offscreen=False):
+        self.offscreen = offscreen
+        if offscreen:
+            ensure_display()
+        self.viewer = mujoco_py.MjViewer(visible=not offscreen, init_width=width,
+                                         init_height=height, go_fast=True)
+        self.viewer.start()
+        self.viewer.cam.camid = 0
+
+    def set_model(self, model):
+        self.viewer.set_model(model)
+        self.viewer.cam.camid = 0
+
+    def render(self, channels=3):
+        """
+        :return: height x width x channels uint8 image, a vertically flipped read-only view on the
+        pixel buffer returned by the viewer (no copy is made)
+        """
+        if self.offscreen:
+            self.viewer.render()
+        else:
+            self.viewer.loop_once()
+        img_string, width, height = self.viewer.get_image()
+        return np.frombuffer(img_string, dtype=np.uint8).reshape((height, width, channels))[::-1]
+
+    def get_depth(self):
+        return self.viewer.get_depth()
+
+    def finish(self):
+        self.viewer.finish()
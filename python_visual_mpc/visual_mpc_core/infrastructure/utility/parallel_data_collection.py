@@ -1,7 +1,9 @@
-from multiprocessing import Pool
+from multiprocessing import Pool, cpu_count
 import argparse
 import imp
 import os
+import re
+import time
 from python_visual_mpc.visual_mpc_core.infrastructure.lsdc_main_mod import LSDCMain
 import copy
 import random
@@ -9,18 +11,145 @@ import numpy as np
 import shutil
 import pdb
 
-def worker(conf):
-    print 'started process with PID:', os.getpid()
-    print 'making trajectories {0} to {1}'.format(
-        conf['start_index'],
-        conf['end_index'],
-    )
+# LSDCMain of a worker process, created for the first chunk and reused for the following ones
+_lsdc = None
+
+
+def chunk_worker(args):
+    """
+    collects the trajectories start to end-1 and marks the chunk as done
+    :return: pid of the worker, start, end and the duration in seconds
+    """
+    conf, start, end = args
+    global _lsdc
+    if _lsdc is None:
+        print 'started process with PID:', os.getpid()
+        random.seed(None)
+        np.random.seed(None)
+        _lsdc = LSDCMain(conf)
+
+    print 'making trajectories {0} to {1}'.format(start, end - 1)
+    t_start = time.time()
+    _lsdc.run(start, end)
+    duration = time.time() - t_start
+
+    open(done_file(conf['common']['data_files_dir'], start, end), 'w').write('{}\n'.format(duration))
+    return os.getpid(), start, end, duration
+
+
+def done_file(data_dir, start, end):
+    return os.path.join(data_dir, '.done_traj_{0}_to_{1}'.format(start, end - 1))
+
+
+def list_shards(data_dir):
+    """
+    :return: list of (first index, last index, filename) of the finished tfrecords shards, sorted by first index
+    """
+    shards = []
+    for name in os.listdir(data_dir):
+        match = re.match(r'traj_(\d+)_to_(\d+)\.tfrecords$', name)
+        if match:
+            shards.append((int(match.group(1)), int(match.group(2)), os.path.join(data_dir, name)))
+    return sorted(shards)
+
+
+def clean_interrupted_chunks(data_dir, todo):
+    """
+    removes the temporary files of interrupted writers and the shards of chunks which are not marked as done,
+    these chunks are collected again
+    """
+    if not os.path.exists(data_dir):
+        return
+    for name in os.listdir(data_dir):
+        if name.startswith('.traj_') and name.endswith('_incomplete'):
+            os.remove(os.path.join(data_dir, name))
+    for first, last, filename in list_shards(data_dir):
+        if any(start <= first < end for start, end in todo):
+            print 'removing {} of an interrupted chunk'.format(filename)
+            os.remove(filename)
+
+
+def move_test_split(data_dir, test_dir, start, end):
+    """
+    moves the shards of the trajectories start to end-1 to test_dir, independent of how many trajectories the
+    writer put into each shard. The writer is closed at the end of every chunk, so no shard spans two chunks.
+    """
+    if not os.path.exists(test_dir):
+        os.makedirs(test_dir)
+    for first, last, filename in list_shards(data_dir):
+        if start <= first < end:
+            shutil.move(filename, os.path.join(test_dir, os.path.basename(filename)))
+
+
+def make_chunks(start_index, end_index, chunk_size):
+    """
+    splits the trajectory indices into chunks of chunk_size, the last chunk contains the remainder
+    """
+    return [(s, min(s + chunk_size, end_index)) for s in range(start_index, end_index, chunk_size)]
+
+
+class ThroughputReport(object):
+    """
+    prints the progress after every finished chunk and a per-worker summary at the end
+    """
+    def __init__(self, n_traj):
+        self.n_traj = n_traj
+        self.n_done = 0
+        self.t_start = time.time()
+        self.per_worker = {}
+
+    def add(self, pid, start, end, duration):
+        ntraj = end - start
+        self.n_done += ntraj
+        done, busy = self.per_worker.get(pid, (0, 0.))
+        self.per_worker[pid] = (done + ntraj, busy + duration)
+
+        elapsed = time.time() - self.t_start
+        rate = self.n_done / elapsed
+        print 'worker {0} finished trajectories {1} to {2} with {3:.3f} traj/s'.format(pid, start, end - 1,
+                                                                                   ntraj / duration)
+        print 'done {0} of {1} trajectories, {2:.3f} traj/s overall, remaining time {3:.0f} s'.format(
+            self.n_done, self.n_traj, rate, (self.n_traj - self.n_done) / rate)
+
+    def summary(self):
+        print 'throughput per worker:'
+        for pid, (done, busy) in sorted(self.per_worker.items()):
+            print 'worker {0}: {1} trajectories, {2:.3f} traj/s'.format(pid, done, done / busy)
+        print 'total time {:.0f} s'.format(time.time() - self.t_start)
+
+
+def collect_data(config, n_worker):
+    """
+    hands out chunks of traj_per_file trajectories from a shared queue, so that a worker which is slowed down
+    e.g. by rejected trajectories does not hold back the others. Chunks which are already marked as done in
+    data_files_dir are skipped, so an interrupted run can be restarted with the same command.
+    """
+    data_dir = config['common']['data_files_dir']
+    if 'traj_per_file' in config:
+        chunk_size = config['traj_per_file']
+    else:
+        chunk_size = 256
 
-    random.seed(None)
-    np.random.seed(None)
+    chunks = make_chunks(config['start_index'], config['end_index'], chunk_size)
+    todo = [c for c in chunks if not os.path.exists(done_file(data_dir, c[0], c[1]))]
+    clean_interrupted_chunks(data_dir, todo)
+    print '{0} of {1} chunks already done, collecting {2} chunks with {3} workers'.format(
+        len(chunks) - len(todo), len(chunks), len(todo), n_worker)
+
+    tasks = [(config, start, end) for start, end in todo]
+    report = ThroughputReport(sum([end - start for start, end in todo]))
+
+    if n_worker > 1:
+        p = Pool(n_worker)
+        for result in p.imap_unordered(chunk_worker, tasks):
+            report.add(*result)
+        p.close()
+        p.join()
+    else:
+        for task in tasks:
+            report.add(*chunk_worker(task))
 
-    lsdc = LSDCMain(conf)
-    lsdc.run()
+    report.summary()
 
 
 def bench_worker(conf):
@@ -40,7 +169,9 @@ class Modhyper(object):
 def main():
     parser = argparse.ArgumentParser(description='run parllel data collection')
     parser.add_argument('experiment', type=str, help='experiment name')
-    parser.add_argument('--parallel', type=str, help='use multiple threads or not', default=True)
+    parser.add_argument('--parallel', type=str, help='use multiple threads or not', default='True')
+    parser.add_argument('--nworkers', type=int, help='number of worker processes, defaults to the number of cores',
+                        default=cpu_count())
 
     args = parser.parse_args()
     exp_name = args.experiment
@@ -48,7 +179,7 @@ def main():
 
 
     if parallel == 'True':
-        n_worker = 10
+        n_worker = args.nworkers
         parallel = True
         print 'using ', n_worker, ' workers'
     if parallel == 'False':
@@ -77,6 +208,19 @@ def main():
         mod_hyper = Modhyper(mod_hyperparams)
         mod_hyper.config['bench_dir'] = experimentdir
 
+    if not do_benchmark:
+        collect_data(hyperparams.config, n_worker)
+
+        # move the first trajectories from train to test
+        conf = hyperparams.common
+        test_dir = '/'.join(str.split(conf['data_files_dir'], '/')[:-1]) + '/test'
+        if 'traj_per_file' in hyperparams.config:
+            ntest = hyperparams.config['traj_per_file']
+        else: ntest = 256
+        start = hyperparams.config['start_index']
+        move_test_split(conf['data_files_dir'], test_dir, start, start + ntest)
+        return
+
     traj_per_worker = int(n_traj / np.float32(n_worker))
     start_idx = [traj_per_worker * i for i in range(n_worker)]
     end_idx =  [traj_per_worker * (i+1)-1 for i in range(n_worker)]
@@ -85,32 +229,17 @@ def main():
 
 
     for i in range(n_worker):
-        if do_benchmark:
-            modconf = copy.deepcopy(mod_hyper)
-            modconf.config['start_index'] = start_idx[i]
-            modconf.config['end_index'] = end_idx[i]
-        else:
-            modconf = copy.deepcopy(hyperparams.config)
-            modconf['start_index'] = start_idx[i]
-            modconf['end_index'] = end_idx[i]
+        modconf = copy.deepcopy(mod_hyper)
+        modconf.config['start_index'] = start_idx[i]
+        modconf.config['end_index'] = end_idx[i]
 
         conflist.append(modconf)
 
-    if do_benchmark:
-        use_worker = bench_worker
-    else: use_worker = worker
-
     if parallel:
         p = Pool(n_worker)
-        p.map(use_worker, conflist)
+        p.map(bench_worker, conflist)
     else:
-        use_worker(conflist[0])
-
-    # move first file from train to test
-    conf = hyperparams.common
-    file = conf['data_files_dir']+ '/traj_0_to_255.tfrecords'
-    dest_file = '/'.join(str.split(conf['data_files_dir'], '/')[:-1]) + '/test/traj_0_to_255.tfrecords'
-    shutil.move(file, dest_file)
+        bench_worker(conflist[0])
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -1,23 +1,15 @@
 filename = "/home/frederik/Dokumente/lsdc/experiments/lsdc_exp/data_files/tfrecords/traj_no0.tfrecords"
 # filename = "/tmp/data/train.tfrecords"
 print filename
-import tensorflow as tf
-
-for serialized_example in tf.python_io.tf_record_iterator(filename):
-    example = tf.train.Example()
-    example.ParseFromString(serialized_example)
-
-    # label = example.features.feature['label']
-    #
-    # print label
-
-
-    for index in range(30):
-        # traverse the Example format to get data
-        action = example.features.feature['move/' + str(index) + '/action']
-        state = example.features.feature['move/' + str(index) + '/state']
-        image = example.features.feature['move/' + str(index) + '/image/encoded']
-
-        # print state
-        print action
-        # print image
+from python_visual_mpc.video_prediction.utils_vpred.numpy_tfrecord import read_trajectories
+
+for traj in read_trajectories(filename):
+    # traverse the trajectory, works for both record layouts and without tensorflow
+    action = traj['action']
+    state = traj['state']
+    image = traj['image']
+
+    for index in range(action.shape[0]):
+        # print state[index]
+        print action[index]
+        # print image[index]
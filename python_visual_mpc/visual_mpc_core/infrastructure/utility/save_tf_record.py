@@ -1,7 +1,11 @@
 import os
+import sys
+import threading
+import Queue
 import tensorflow as tf
 import numpy as np
 import pdb
+from python_visual_mpc.video_prediction.utils_vpred.trajectory_record import encode_trajectory
 
 
 def _float_feature(value):
@@ -15,55 +19,191 @@ def _int64_feature(value):
   return tf.train.Feature(int64_list=tf.train.Int64List(value=value))
 
 
-def save_tf_record(dir, filename, trajectory_list, params):
+def traj_to_example(traj, params):
     """
-    saves data_files from one sample trajectory into one tf-record file
+    converts one sample trajectory into a tf.train.Example,
+    using the compact layout of trajectory_record if 'record_v2' or 'image_codec' is set in params
     """
-
-    filename = os.path.join(dir, filename + '.tfrecords')
-    print('Writing', filename)
-    writer = tf.python_io.TFRecordWriter(filename)
+    if 'record_v2' in params or 'image_codec' in params:
+        return traj_to_example_v2(traj, params)
 
     feature = {}
 
-    for tr in range(len(trajectory_list)):
-
-        traj = trajectory_list[tr]
+    if 'store_video_prediction' in params:
+        sequence_length = len(traj.final_predicted_images)
+    else:
+        sequence_length = traj._sample_images.shape[0]
 
+    for tind in range(sequence_length):
         if 'store_video_prediction' in params:
-            sequence_length = len(traj.final_predicted_images)
+            image_raw = traj.final_predicted_images[tind].tostring()
         else:
-            sequence_length = traj._sample_images.shape[0]
+            image_raw = traj._sample_images[tind].tostring()
 
-        for tind in range(sequence_length):
-            if 'store_video_prediction' in params:
-                image_raw = traj.final_predicted_images[tind].tostring()
-            else:
-                image_raw = traj._sample_images[tind].tostring()
+        feature['move/' + str(tind) + '/action']= _float_feature(traj.U[tind,:].tolist())
+        feature['move/' + str(tind) + '/state'] = _float_feature(traj.X_Xdot_full[tind,:].tolist())
+        feature['move/' + str(tind) + '/image/encoded'] = _bytes_feature(image_raw)
+        feature['touchdata/' + str(tind)] = _float_feature(traj.touchdata[tind, :].tolist())
 
-            feature['move/' + str(tind) + '/action']= _float_feature(traj.U[tind,:].tolist())
-            feature['move/' + str(tind) + '/state'] = _float_feature(traj.X_Xdot_full[tind,:].tolist())
-            feature['move/' + str(tind) + '/image/encoded'] = _bytes_feature(image_raw)
-            feature['touchdata/' + str(tind)] = _float_feature(traj.touchdata[tind, :].tolist())
+        if hasattr(traj, 'Object_pose'):
+            Object_pos_flat = traj.Object_pose[tind].flatten()
+            feature['move/' + str(tind) + '/object_pos'] = _float_feature(Object_pos_flat.tolist())
 
-            if hasattr(traj, 'Object_pose'):
-                Object_pos_flat = traj.Object_pose[tind].flatten()
-                feature['move/' + str(tind) + '/object_pos'] = _float_feature(Object_pos_flat.tolist())
+            max_move_pose = traj.max_move_pose[tind].flatten()
+            feature['move/' + str(tind) + '/max_move_pose'] = _float_feature(max_move_pose.tolist())
 
-                max_move_pose = traj.max_move_pose[tind].flatten()
-                feature['move/' + str(tind) + '/max_move_pose'] = _float_feature(max_move_pose.tolist())
+        if hasattr(traj, 'large_images_retina'):
+            image_raw = traj.large_images_retina[tind].tostring()
+            feature['move/' + str(tind) + '/retina/encoded'] = _bytes_feature(image_raw)
+            feature['initial_retpos'] = _int64_feature(traj.initial_ret_pos.tolist())
 
-            if hasattr(traj, 'large_images_retina'):
-                image_raw = traj.large_images_retina[tind].tostring()
-                feature['move/' + str(tind) + '/retina/encoded'] = _bytes_feature(image_raw)
-                feature['initial_retpos'] = _int64_feature(traj.initial_ret_pos.tolist())
+    return tf.train.Example(features=tf.train.Features(feature=feature))
 
-        example = tf.train.Example(features=tf.train.Features(feature=feature))
-        writer.write(example.SerializeToString())
+
+def traj_to_example_v2(traj, params):
+    """
+    one blob per modality, touchdata is only stored when touch sensing is enabled.
+    The images are compressed with params['image_codec'] ('raw', 'png' or 'jpeg'), using 'jpeg_quality'
+    """
+    if 'store_video_prediction' in params:
+        images = np.stack(traj.final_predicted_images, axis=0)
+    else:
+        images = traj._sample_images
+    sequence_length = images.shape[0]
+
+    modalities = {'image': images,
+                  'action': traj.U[:sequence_length],
+                  'state': traj.X_Xdot_full[:sequence_length]}
+
+    if 'touch' in params:
+        modalities['touchdata'] = traj.touchdata[:sequence_length]
+
+    if hasattr(traj, 'Object_pose'):
+        modalities['object_pos'] = traj.Object_pose[:sequence_length].reshape(sequence_length, -1)
+        modalities['max_move_pose'] = traj.max_move_pose[:sequence_length]
+
+    if hasattr(traj, 'large_images_retina'):
+        modalities['retina'] = traj.large_images_retina[:sequence_length]
+        modalities['initial_retpos'] = traj.initial_ret_pos.astype(np.int64)
+
+    if 'image_codec' in params:
+        image_codec = params['image_codec']
+    else: image_codec = 'raw'
+    if 'jpeg_quality' in params:
+        jpeg_quality = params['jpeg_quality']
+    else: jpeg_quality = 95
+
+    codecs = {'image': image_codec, 'retina': image_codec}
+    return encode_trajectory(modalities, codecs, jpeg_quality)
+
+
+def save_tf_record(dir, filename, trajectory_list, params):
+    """
+    saves data_files from one sample trajectory into one tf-record file
+    """
+
+    filename = os.path.join(dir, filename + '.tfrecords')
+    print('Writing', filename)
+    writer = tf.python_io.TFRecordWriter(filename)
+
+    for traj in trajectory_list:
+        writer.write(traj_to_example(traj, params).SerializeToString())
 
     writer.close()
 
 
+class StreamingTFRecordWriter(object):
+    """
+    Appends trajectories to the currently open tfrecords file as soon as they are collected.
+    Serialization and writing happen on a background thread which is fed through a bounded queue,
+    so the simulation only blocks when it is more than queue_size trajectories ahead.
+    A file is closed when it contains traj_per_file trajectories or max_bytes bytes, it is written
+    under a temporary name and renamed to traj_<first>_to_<last>.tfrecords once it is complete.
+    """
+    def __init__(self, dir, params, traj_per_file=256, max_bytes=None, queue_size=8):
+        self.dir = dir
+        self.params = params
+        self.traj_per_file = traj_per_file
+        self.max_bytes = max_bytes
+
+        self._queue = Queue.Queue(maxsize=queue_size)
+        self._error = None
+        self._writer = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, traj, sample_index):
+        """
+        the trajectory must not be modified afterwards, it is serialized asynchronously
+        """
+        self._check_error()
+        self._queue.put((traj, sample_index))
+
+    def close(self):
+        """
+        writes the remaining trajectories and closes the last file
+        """
+        self._queue.put(None)
+        self._thread.join()
+        self._check_error()
+
+    def _check_error(self):
+        if self._error is not None:
+            exc_type, exc_value, exc_traceback = self._error
+            raise exc_type, exc_value, exc_traceback
+
+    def _run(self):
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    break
+                traj, sample_index = item
+                self._append(traj_to_example(traj, self.params).SerializeToString(), sample_index)
+            self._close_file()
+        except Exception:
+            self._error = sys.exc_info()
+            self._discard_file()
+            # keep consuming so that write() does not block forever
+            while self._queue.get() is not None:
+                pass
+
+    def _append(self, record, sample_index):
+        if self._writer is None:
+            self._first_index = sample_index
+            self._tmp_filename = os.path.join(self.dir, '.traj_{0}_incomplete'.format(sample_index))
+            self._writer = tf.python_io.TFRecordWriter(self._tmp_filename)
+            self._ntraj, self._nbytes = 0, 0
+
+        self._writer.write(record)
+        self._ntraj += 1
+        self._nbytes += len(record)
+        self._last_index = sample_index
+
+        if self._ntraj == self.traj_per_file or (self.max_bytes is not None and self._nbytes >= self.max_bytes):
+            self._close_file()
+
+    def _close_file(self):
+        if self._writer is None:
+            return
+        self._writer.close()
+        filename = os.path.join(self.dir, 'traj_{0}_to_{1}.tfrecords'.format(self._first_index, self._last_index))
+        os.rename(self._tmp_filename, filename)
+        print('Wrote', filename)
+        self._writer = None
+
+    def _discard_file(self):
+        if self._writer is None:
+            return
+        try:
+            self._writer.close()
+        finally:
+            self._writer = None
+            if os.path.exists(self._tmp_filename):
+                os.remove(self._tmp_filename)
+
+
 def save_tf_record_gtruthpred(dir, filename, trajectory_list, params):
     """
     save both groundtruth and predicted videos from CEM trjaectory